@@ -0,0 +1,232 @@
+"""
+対話なしで各ステージを個別に実行するエントリポイント（バッチ実行・CI用）。
+
+    python headless.py encode            # H.264圧縮 (h264_outputs/res.mp4)
+    python headless.py segment           # MP4セグメントの作成
+    python headless.py package [--clear] # HLSの生成
+    python headless.py package --regenerate  # インデックスからプレイリストだけを書き直す
+    python headless.py serve             # HLSサーバー（ブラウザは開かない）
+    python headless.py monitor           # ネットワークモニタ
+    python headless.py stream            # リアルタイム配信（デコード→エンコード→HLS）
+    python headless.py coldstart         # 各ステージのコールドスタート時間を計測
+
+main.pyと同じパスとconfig.jsonの設定を使い、input()による確認は行わない。
+cv2・numpy・matplotlib・psutilなどの重いモジュールは、実行するステージの関数の中でのみimportする。
+このファイル自体は標準ライブラリとsrc.utilsだけを読み込むため、spawnで起動される子プロセスも軽い。
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+_STARTED = time.perf_counter()
+
+from src.utils import load_config
+
+INPUT_VIDEO = "Assets/input_video-1.mp4"
+SEGMENT_DIR = "segments/segmented_video"
+HLS_DIR = "segments/hls_file"
+RES_PATH = "h264_outputs/res.mp4"
+MONITOR_URL = "http://localhost:8080/master.m3u8"
+
+# 各ステージが読み込むモジュール（--import-onlyとcoldstartで使用）
+STAGE_MODULES = {
+    "encode": ["src.server.media_probe", "src.server.h264_compression", "src.server.encode_cache"],
+    "segment": ["src.server.media_probe", "src.server.mp4_creater", "src.server.encode_cache"],
+    "package": ["src.server.media_probe", "main_system"],
+    "serve": ["src.client.client_operator"],
+    "monitor": ["src.monitor_videostreaming"],
+    "stream": ["src.server.media_probe", "src.server.server_operator"],
+}
+
+
+def probe_input(input_video):
+    """
+    入力動画のフレーム数と解像度を取得する（結果はキャッシュされる）。
+    """
+    from src.server.media_probe import probe_media
+    info = probe_media(input_video)
+    if info is None or not info["frame_count"]:
+        sys.exit(f"Error: Unable to open video file {input_video}")
+    return info["frame_count"], info["width"], info["height"]
+
+
+def run_encode(args, config):
+    from src.server.h264_compression import compress_video_to_h264
+    from src.server.encode_cache import load_encode_cache
+    _, width, height = probe_input(args.input)
+    compress_video_to_h264(args.input, width, height, cache=load_encode_cache(config))
+
+
+def run_segment(args, config):
+    from src.server.mp4_creater import mp4_create
+    from src.server.encode_cache import load_encode_cache
+    from src.server.segment_index import load_segment_index
+    frames, width, height = probe_input(args.input)
+    mp4_create(args.input, frames, RES_PATH, width, height, cache=load_encode_cache(config),
+               segment_mode=args.segment_mode,
+               max_buffer_bytes=config.get("frame_buffer", {}).get("max_bytes", 256 * 1024 ** 2),
+               segment_db=load_segment_index(config))
+
+
+def run_package(args, config):
+    from src.server.media_probe import get_video_bitrate
+    from src.server.hls_server import regenerate_playlists, use_segment_index
+    from src.server.segment_index import load_segment_index
+    from main_system import hls_file_create
+    from src.client.cleanup_segments import clear_hls_segments
+    segment_db = load_segment_index(config)
+    if args.regenerate:
+        if segment_db is None:
+            sys.exit("--regenerate requires the segment index (config.json: segment_index.enabled).")
+        use_segment_index(segment_db)
+        print(f"Regenerated {regenerate_playlists(HLS_DIR)} playlists from {segment_db.path}")
+        return
+    if args.clear:
+        clear_hls_segments(HLS_DIR, segment_db)
+    hls_file_create(SEGMENT_DIR, get_video_bitrate(RES_PATH))
+
+
+def run_serve(args, config):
+    from src.client.client_operator import start_video_playback
+    proxy = None
+    if config.get("network_shaping", {}).get("enabled", False):
+        # プレイヤーの接続はネットワーク制限プロキシを経由させる
+        from src.shaping_proxy import create_shaping_proxy
+        proxy = create_shaping_proxy(config)
+        proxy.start()
+    try:
+        start_video_playback(HLS_DIR, open_browser=args.open_browser)
+    finally:
+        if proxy is not None:
+            proxy.stop()
+
+
+def run_monitor(args, config):
+    import queue
+    from src.utils import get_network_interfaces
+    from src.monitor_videostreaming import start_monitor_network
+    interface = args.interface
+    if interface is None:
+        interfaces = get_network_interfaces()
+        if not interfaces:
+            sys.exit("No network interfaces detected. Pass --interface.")
+        interface = interfaces[0]
+    start_monitor_network(args.url, interface, queue.Queue())
+
+
+def run_stream(args, config):
+    from src.server.server_operator import start_video_streaming
+    frames, width, height = probe_input(args.input)
+    start_video_streaming(args.input, frames, RES_PATH, width, height)
+
+
+def run_coldstart(args, config):
+    """
+    各ステージを新しいプロセスで--import-only実行し、コールドスタート時間を計測する。
+    """
+    stages = args.stages.split(",") if args.stages else list(STAGE_MODULES)
+    results = {}
+    for stage in stages:
+        samples = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), stage, "--import-only"],
+                                     capture_output=True, text=True)
+            wall_ms = (time.perf_counter() - started) * 1000
+            if process.returncode != 0:
+                break
+            report = json.loads(process.stdout.strip().splitlines()[-1])
+            samples.append((wall_ms, report["import_ms"]))
+        if not samples:
+            # 依存モジュールがインストールされていないなど
+            error = (process.stderr.strip().splitlines() or ["unknown error"])[-1]
+            results[stage] = {"error": error}
+            print(f"{stage:8s} failed: {error}")
+            continue
+        wall_ms, import_ms = min(samples)
+        results[stage] = {"wall_ms": round(wall_ms, 1), "import_ms": round(import_ms, 1), "modules": report["modules"]}
+        print(f"{stage:8s} process {wall_ms:7.1f} ms  imports {import_ms:7.1f} ms  ({report['modules']} modules)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    slow = [stage for stage, result in results.items()
+            if args.budget and "wall_ms" in result and result["wall_ms"] > args.budget]
+    if slow:
+        print(f"Cold start over budget ({args.budget} ms): {', '.join(slow)}")
+        sys.exit(1)
+
+
+STAGES = {
+    "encode": run_encode,
+    "segment": run_segment,
+    "package": run_package,
+    "serve": run_serve,
+    "monitor": run_monitor,
+    "stream": run_stream,
+    "coldstart": run_coldstart,
+}
+
+
+def import_only(stage):
+    """
+    ステージのモジュールを読み込むだけで終了し、所要時間をJSONで出力する。
+    """
+    import importlib
+    for module in STAGE_MODULES[stage]:
+        importlib.import_module(module)
+    print(json.dumps({
+        "stage": stage,
+        "import_ms": (time.perf_counter() - _STARTED) * 1000,
+        "modules": len(sys.modules)
+    }))
+
+
+def main(argv=None):
+    config = load_config()
+    headless = config.get("headless", {})
+
+    parser = argparse.ArgumentParser(description="Run a single pipeline stage without prompts.")
+    parser.add_argument("stage", choices=list(STAGES))
+    parser.add_argument("--input", default=headless.get("input_video", INPUT_VIDEO), help="Input video.")
+    parser.add_argument("--segment-mode", choices=["copy", "encode"], default=headless.get("segment_mode", "copy"))
+    parser.add_argument("--clear", action="store_true", help="Delete existing HLS files before packaging.")
+    parser.add_argument("--regenerate", action="store_true",
+                        help="Rewrite the playlists from the segment index without encoding.")
+    parser.add_argument("--open-browser", action="store_true", default=headless.get("open_browser", False),
+                        help="Open the player page when serving.")
+    parser.add_argument("--url", default=MONITOR_URL, help="URL probed by the monitor.")
+    parser.add_argument("--interface", default=headless.get("interface"),
+                        help="Interface sampled by the monitor (default: the first detected one).")
+    parser.add_argument("--import-only", action="store_true", help="Import the stage's modules and exit.")
+    parser.add_argument("--timing", action="store_true", help="Print the cold start time before running.")
+    parser.add_argument("--stages", help="coldstart: comma-separated stages to measure.")
+    parser.add_argument("--repeat", type=int, default=3, help="coldstart: runs per stage (the fastest is kept).")
+    parser.add_argument("--budget", type=float, default=headless.get("coldstart_budget_ms"),
+                        help="coldstart: fail if a stage takes longer than this many ms.")
+    parser.add_argument("--output", help="coldstart: write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    if args.import_only:
+        if args.stage not in STAGE_MODULES:
+            parser.error(f"--import-only is not available for {args.stage}")
+        import_only(args.stage)
+        return
+
+    if args.timing and args.stage in STAGE_MODULES:
+        import importlib
+        for module in STAGE_MODULES[args.stage]:
+            importlib.import_module(module)
+        print(f"[headless] {args.stage} cold start: {(time.perf_counter() - _STARTED) * 1000:.0f} ms "
+              f"({len(sys.modules)} modules)")
+
+    STAGES[args.stage](args, config)
+
+
+if __name__ == "__main__":
+    main()
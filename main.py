@@ -1,12 +1,8 @@
 import multiprocessing
 import atexit
 import signal
-import cv2
-import matplotlib
-matplotlib.use('Agg')  # 非GUIバックエンドを使用
-from src.server.server_function import get_video_frame_count
+from src.server.media_probe import get_video_bitrate, probe_media
 from src.client.browser_launcher import close_chrome, handle_exit
-from src.server.hls_server import get_video_bitrate
 from main_system import admin_judge, mp4_file_create_selection, network_interface, hls_file_delete_and_create_slection, h264_compressing_selection, videostreaming_selection
 
 # 管理者権限でスクリプトを再実行
@@ -24,16 +20,15 @@ if __name__ == "__main__":
     res_path = "h264_outputs/res.mp4"
     m3u8_playlist_url = "segments/hls_file/master.m3u8"
     monitor_queue = multiprocessing.Queue()
-    input_frame = int(get_video_frame_count(input_video))
-    video_bitrate = get_video_bitrate(res_path)
-    cap = cv2.VideoCapture(input_video) # cv2.VideoCaptureで動画のプロパティを取得
-    if not cap.isOpened():
+    # 動画のフレーム数・幅・高さを1回のffprobeで取得（結果はキャッシュされる）
+    input_info = probe_media(input_video)
+    if input_info is None or not input_info["frame_count"]:
         print(f"Error: Unable to open video file {input_video}")
         exit(1)
-    # 動画の幅と高さを取得
-    window_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) 
-    window_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    cap.release()  # リソースを解放
+    input_frame = int(input_info["frame_count"])
+    window_width = input_info["width"]
+    window_height = input_info["height"]
+    video_bitrate = get_video_bitrate(res_path)
 
     # Step1: ネットワークインターフェイスを取得し、ネットワーク環境を動的に制限する
     interface = network_interface()
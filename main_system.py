@@ -1,18 +1,19 @@
 import os
-import json
 import time
 import ctypes
 import sys
 import multiprocessing
 from src.network_controller import NetworkController
-from src.utils import get_network_interfaces
-from src.server.mp4_creater import mp4_create
+from src.utils import get_network_interfaces, load_config
 from src.client.cleanup_segments import clear_hls_segments
-from src.server.hls_server import create_hls_with_dynamic_bitrate
+from src.server.hls_parallel import create_hls_parallel
+from src.server.ladder import build_ladder
 from src.server.h264_compression import compress_video_to_h264
-from src.server.server_operator import start_video_streaming
-from src.client.client_operator import start_video_playback
-from src.monitor_videostreaming import start_monitor_network
+from src.server.encode_cache import load_encode_cache
+from src.server.hls_server import use_segment_index
+from src.server.segment_index import load_segment_index
+# cv2/numpy/matplotlib/psutilを読み込むモジュールは、使用する関数の中でimportする
+# (spawnで起動する子プロセスは、ターゲットの関数があるモジュールだけを読み込む)
 
 def network_interface():
     print("Available network interfaces:")
@@ -45,8 +46,7 @@ def network_interface():
     print(f"Selected interface: {interface}")
 
     # 設定値を読み込む
-    with open("src/config.json", "r") as config_file:
-        config = json.load(config_file)
+    config = load_config()
 
     # ネットワーク設定を適用
     controller = NetworkController(interface)
@@ -55,11 +55,16 @@ def network_interface():
     return interface
 
 def mp4_file_create_selection(input_video, input_frame, res_path, window_width, window_height):
+    from src.server.mp4_creater import mp4_create
     while True:
         user_input = input("\nDo you want to create or recreate MP4 segments? (y/n): ").strip().lower()
         if user_input == 'y':
             try:
-                mp4_create(input_video, input_frame, res_path, window_width, window_height)
+                config = load_config()
+                mp4_create(input_video, input_frame, res_path, window_width, window_height,
+                           cache=load_encode_cache(config),
+                           max_buffer_bytes=config.get("frame_buffer", {}).get("max_bytes", 256 * 1024 ** 2),
+                           segment_db=load_segment_index(config))
                 print('MP4 Segments Creating done')
                 break
             except Exception as e:
@@ -71,41 +76,45 @@ def mp4_file_create_selection(input_video, input_frame, res_path, window_width,
         else:
             print("Invalid input. Please enter 'y' or 'n'.")
 
+def hls_file_create(segment_dir, video_bitrate):
+    """
+    セグメントディレクトリ内の全MP4セグメントを並列にHLS化する。
+    スレッド予算はconfig.jsonの"hls_packaging"で指定する。
+    config.jsonの"ladder"が"per-title"の場合は、圧縮済みの動画全体を解析してラダーを決める。
+    """
+    hls_output_dir = "segments/hls_file"
+    resolutions = [(640, 360), (1280, 720), (1920, 1080)]  # 解像度リスト
+    config = load_config()
+    packaging_config = config.get("hls_packaging", {})
+    renditions = build_ladder("h264_outputs/res.mp4", config.get("ladder", {}))
+    # セグメント番号・MP4セグメントの一覧・プレイリストをインデックスで管理する
+    use_segment_index(load_segment_index(config))
+
+    try:
+        create_hls_parallel(
+            segment_dir, hls_output_dir, resolutions, video_bitrate,
+            total_threads=packaging_config.get("total_threads"),
+            threads_per_job=packaging_config.get("threads_per_job"),
+            cache=load_encode_cache(config),
+            renditions=renditions,
+            segment_format=packaging_config.get("segment_format", "ts")
+        )
+    except Exception as e:
+        print(f'Video Encoding for HLS failed: {e}')
+
 def hls_file_delete_and_create_slection(hls_dir, segment_dir, video_bitrate):
     if os.path.exists(hls_dir):
         while True:
             user_input = input("\nThe HLS File already exists. Do you want to delete it? (y/n): ").strip().lower()
             if user_input == 'y':
                 try:
-                    clear_hls_segments(hls_dir)
+                    clear_hls_segments(hls_dir, load_segment_index(load_config()))
                     print('clear_hls_segments done')
 
                     while True:
                         user_input = input("\nThe HLS File was deleted. Do you want to create it now? (y/n): ").strip().lower()
                         if user_input == 'y':
-                            # セグメントディレクトリ内の動画ファイルを取得
-                            segment_files = [
-                                f for f in os.listdir(segment_dir)
-                                if f.endswith(".mp4")
-                            ]
-                            segment_count = len(segment_files)
-                            if segment_count == 0:
-                                print("No segment files found in the segment directory.")
-                                break
-
-                            print(f"Found {segment_count} segment files. Starting HLS generation...")
-                            for segment_index, segment_file in enumerate(sorted(segment_files)):
-                                try:
-                                    segment_path = os.path.join(segment_dir, segment_file)
-                                    hls_output_dir = "segments/hls_file"
-                                    resolutions = [(640, 360), (1280, 720), (1920, 1080)]  # 解像度リスト
-                                    
-                                    # HLS生成
-                                    create_hls_with_dynamic_bitrate(segment_path, hls_output_dir, resolutions, video_bitrate)
-                                    print(f"HLSファイルを生成しました: {hls_output_dir} for segment {segment_index + 1}/{segment_count}")
-
-                                except Exception as e:
-                                    print(f'Video Encoding for HLS failed for {segment_file}: {e}')
+                            hls_file_create(segment_dir, video_bitrate)
                             break
 
                         elif user_input == 'n':
@@ -126,29 +135,7 @@ def hls_file_delete_and_create_slection(hls_dir, segment_dir, video_bitrate):
         while True:
             user_input = input("\nThe HLS File was not exist. Do you want to create it now? (y/n): ").strip().lower()
             if user_input == 'y':
-                # セグメントディレクトリ内の動画ファイルを取得
-                segment_files = [
-                    f for f in os.listdir(segment_dir)
-                    if f.endswith(".mp4")
-                ]
-                segment_count = len(segment_files)
-                if segment_count == 0:
-                    print("No segment files found in the segment directory.")
-                    break
-
-                print(f"Found {segment_count} segment files. Starting HLS generation...")
-                for segment_index, segment_file in enumerate(sorted(segment_files)):
-                    try:
-                        segment_path = os.path.join(segment_dir, segment_file)
-                        hls_output_dir = "segments/hls_file"
-                        resolutions = [(640, 360), (1280, 720), (1920, 1080)]  # 解像度リスト
-                        
-                        # HLS生成
-                        create_hls_with_dynamic_bitrate(segment_path, hls_output_dir, resolutions, video_bitrate)
-                        print(f"HLSファイルを生成しました: {hls_output_dir} for segment {segment_index + 1}/{segment_count}")
-
-                    except Exception as e:
-                        print(f'Video Encoding for HLS failed for {segment_file}: {e}')
+                hls_file_create(segment_dir, video_bitrate)
                 break
 
             elif user_input == 'n':
@@ -164,7 +151,7 @@ def h264_compressing_selection(res_path, input_video, window_width, window_heigh
             if user_input == 'y':
                 try:
                     # フォビエイテッド圧縮を実行
-                    res_path = compress_video_to_h264(input_video, window_width, window_height)
+                    res_path = compress_video_to_h264(input_video, window_width, window_height, cache=load_encode_cache(load_config()))
                 except Exception as e:
                     print(f"Error during H.264 Compression: {e}")
                     break
@@ -176,7 +163,7 @@ def h264_compressing_selection(res_path, input_video, window_width, window_heigh
                 print("Invalid input. Please enter 'y' or 'n'.")
     else:
         try:
-            res_path = compress_video_to_h264(input_video, window_width, window_height)
+            res_path = compress_video_to_h264(input_video, window_width, window_height, cache=load_encode_cache(load_config()))
             print("H.264 Compression done")
         except Exception as e:
             print(f"H.264 Compressioon failed: {e}")
@@ -185,6 +172,10 @@ def videostreaming_selection(input_video, input_frame, res_path,
                              window_width, window_height, hls_dir, 
                              interface, monitor_queue, m3u8_playlist_url
                              ):
+    from src.server.server_operator import start_video_streaming
+    from src.client.client_operator import start_video_playback
+    from src.monitor_videostreaming import start_monitor_network
+
     try:
         video_streaming_process = multiprocessing.Process(
             target=start_video_streaming,
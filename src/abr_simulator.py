@@ -0,0 +1,499 @@
+"""
+帯域幅トレースを使ったオフラインのABR（アダプティブビットレート）シミュレータ。
+
+生成済みのmaster.m3u8と各解像度のプレイリスト、実際の.tsファイルのサイズからビットレートラダーを読み込み、
+帯域幅トレースを再生してABRアルゴリズムごとの起動遅延・停止時間・切り替え回数・平均ビットレートを求める。
+ブラウザやネットワーク制限を使わずに、ラダーや配信方法の比較ができる。
+
+セグメントの取得は順番に行う必要があるためセグメント方向はループだが、
+トレース×ラダーの全組み合わせはNumPyの配列として同時に計算する。
+
+使い方:
+    python -m src.abr_simulator --hls-dir segments/hls_file --synthetic 1000 --mean-kbps 2000
+    python -m src.abr_simulator --hls-dir ladder_a --hls-dir ladder_b --trace traces/*.txt --output abr.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import numpy as np
+
+
+class Ladder:
+    def __init__(self, name, bitrates, sizes, durations, resolutions):
+        """
+        Args:
+            name (str): ラダーの名前（ディレクトリ名など）。
+            bitrates (np.ndarray): 各レベルの実測平均ビットレート（kbps）、昇順。形状 (levels,)。
+            sizes (np.ndarray): セグメントサイズ（ビット）。形状 (levels, segments)。
+            durations (np.ndarray): セグメントの長さ（秒）。形状 (segments,)。
+            resolutions (list): 各レベルの解像度の文字列 ("640x360" など)。
+        """
+        self.name = name
+        self.bitrates = bitrates
+        self.sizes = sizes
+        self.durations = durations
+        self.resolutions = resolutions
+
+
+def parse_media_playlist(path):
+    """
+    メディアプレイリストからセグメントのURI・長さ・サイズを取得する。
+    fMP4の単一ファイル(EXT-X-BYTERANGE)の場合はバイト範囲の長さをサイズとする。
+
+    Returns:
+        list: [(セグメントのパス, 長さ(秒), サイズ(バイト) または None), ...]
+    """
+    base_dir = os.path.dirname(path)
+    segments = []
+    duration = None
+    length = None
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",")[0])
+            elif line.startswith("#EXT-X-BYTERANGE:"):
+                length = int(line[len("#EXT-X-BYTERANGE:"):].split("@")[0])
+            elif line and not line.startswith("#") and duration is not None:
+                segments.append((os.path.join(base_dir, line), duration, length))
+                duration = None
+                length = None
+    return segments
+
+
+def parse_master_playlist(path):
+    """
+    マスタープレイリストからバリアントの一覧を取得する。
+
+    Returns:
+        list: [{"bandwidth": int, "resolution": str, "path": str}, ...]
+    """
+    base_dir = os.path.dirname(path)
+    variants = []
+    attributes = None
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXT-X-STREAM-INF:"):
+                attributes = {}
+                for item in line[len("#EXT-X-STREAM-INF:"):].split(","):
+                    if "=" in item:
+                        key, value = item.split("=", 1)
+                        attributes[key.strip()] = value.strip().strip('"')
+            elif line and not line.startswith("#") and attributes is not None:
+                variants.append({
+                    "bandwidth": int(attributes.get("BANDWIDTH", 0)),
+                    "resolution": attributes.get("RESOLUTION", ""),
+                    "path": os.path.join(base_dir, line),
+                })
+                attributes = None
+    return variants
+
+
+def load_ladder(hls_dir, name=None):
+    """
+    HLSの出力ディレクトリからラダーを読み込む。セグメント数が異なるレベルは最も短いものに揃える。
+
+    Args:
+        hls_dir (str): master.m3u8 のあるディレクトリ。
+        name (str): ラダーの名前。省略時はディレクトリ名。
+
+    Returns:
+        Ladder: 読み込んだラダー。
+    """
+    variants = parse_master_playlist(os.path.join(hls_dir, "master.m3u8"))
+    if not variants:
+        raise ValueError(f"No variants found in {hls_dir}/master.m3u8")
+
+    levels = []
+    for variant in variants:
+        segments = [(duration, size if size is not None else os.path.getsize(path))
+                    for path, duration, size in parse_media_playlist(variant["path"]) if os.path.exists(path)]
+        if segments:
+            levels.append((variant, segments))
+    if not levels:
+        raise ValueError(f"No segments found for the variants in {hls_dir}")
+
+    count = min(len(segments) for _, segments in levels)
+    sizes = np.array([[size * 8 for _, size in segments[:count]] for _, segments in levels], dtype=np.float64)
+    durations = np.array([duration for duration, _ in levels[0][1][:count]], dtype=np.float64)
+    bitrates = sizes.sum(axis=1) / durations.sum() / 1000
+
+    order = np.argsort(bitrates)
+    return Ladder(name or os.path.basename(os.path.normpath(hls_dir)), bitrates[order], sizes[order], durations,
+                  [levels[i][0]["resolution"] for i in order])
+
+
+def load_trace(path, interval=1.0):
+    """
+    帯域幅トレースを読み込み、1秒ごとの帯域幅（kbps）の配列にする。
+
+    対応する形式:
+    ・1列: 1秒ごとの帯域幅（kbps）。
+    ・2列: "時刻(秒) 帯域幅(kbps)"。次の時刻まで同じ帯域幅が続くものとして1秒ごとに変換する。
+    ・メトリクスストアのディレクトリ (NetworkMonitorの出力): recv_avg (kB/s) を使用する。
+
+    Returns:
+        np.ndarray: 1秒ごとの帯域幅（kbps）。
+    """
+    if os.path.isdir(path):
+        from src.metrics_store import load_metrics
+        table = load_metrics(path)
+        values = np.nan_to_num(np.asarray(table["recv_avg"], dtype=np.float64)) * 8 * 1.024
+        return np.repeat(values, max(1, int(round(interval))))
+
+    rows = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip().replace(",", " ")
+            if line and not line.startswith("#"):
+                try:
+                    rows.append([float(value) for value in line.split()])
+                except ValueError:
+                    continue  # ヘッダ行
+    if not rows:
+        raise ValueError(f"Empty trace: {path}")
+
+    if len(rows[0]) == 1:
+        return np.array([row[0] for row in rows], dtype=np.float64)
+
+    times = np.array([row[0] for row in rows], dtype=np.float64)
+    values = np.array([row[1] for row in rows], dtype=np.float64)
+    seconds = np.arange(int(np.ceil(times[-1])) + 1)
+    return values[np.clip(np.searchsorted(times, seconds, side="right") - 1, 0, len(values) - 1)]
+
+
+def generate_traces(count, seconds=600, mean_kbps=2000.0, variability=0.5, seed=0):
+    """
+    対数正規のランダムウォークで合成トレースを生成する。
+
+    Args:
+        count (int): トレース数。
+        seconds (int): 各トレースの長さ（秒）。
+        mean_kbps (float): 平均帯域幅（kbps）。
+        variability (float): 変動の大きさ（対数の標準偏差）。
+        seed (int): 乱数のシード。
+
+    Returns:
+        np.ndarray: 形状 (count, seconds) の帯域幅（kbps）。
+    """
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, variability / np.sqrt(10), size=(count, seconds))
+    # 平均回帰するランダムウォーク（AR(1)）
+    log_level = np.zeros((count, seconds))
+    for t in range(1, seconds):
+        log_level[:, t] = 0.9 * log_level[:, t - 1] + steps[:, t]
+    traces = np.exp(log_level)
+    return traces / traces.mean(axis=1, keepdims=True) * mean_kbps
+
+
+def stack_traces(traces):
+    """長さの異なるトレースを、短いものを繰り返して同じ長さの2次元配列にする。"""
+    length = max(len(trace) for trace in traces)
+    return np.stack([np.resize(np.asarray(trace, dtype=np.float64), length) for trace in traces])
+
+
+class TraceClock:
+    """
+    1秒ごとの帯域幅のトレースで、時刻tから指定ビット数を取得し終わる時刻をバッチで計算する。
+    トレースの終わりに達した場合は先頭に戻って繰り返す。
+    """
+
+    def __init__(self, traces):
+        """
+        Args:
+            traces (np.ndarray): 形状 (batch, seconds) の帯域幅（kbps）。
+        """
+        self.bits_per_second = np.asarray(traces, dtype=np.float64) * 1000
+        self.batch, self.length = self.bits_per_second.shape
+        self.cumulative = np.concatenate(
+            [np.zeros((self.batch, 1)), np.cumsum(self.bits_per_second, axis=1)], axis=1
+        )
+        self.total = self.cumulative[:, -1]
+        if np.any(self.total <= 0):
+            raise ValueError("Every trace needs non-zero bandwidth.")
+        # 行ごとのsearchsortedを1回で行うため、行ごとにオフセットを足して全体を単調増加にする
+        self.offsets = (np.arange(self.batch) * (self.total.max() + 1))[:, None]
+        self.flat = (self.cumulative + self.offsets).ravel()
+        self.rows = np.arange(self.batch)
+
+    def bits_until(self, t):
+        """時刻0からtまでに取得できるビット数。"""
+        cycles, position = np.divmod(t, self.length)
+        second = np.minimum(position.astype(np.int64), self.length - 1)
+        within = self.cumulative[self.rows, second] + self.bits_per_second[self.rows, second] * (position - second)
+        return cycles * self.total + within
+
+    def finish_time(self, t, bits):
+        """時刻tから取得を始めたとき、bitsビットを取得し終わる時刻。"""
+        target = self.bits_until(t) + bits
+        cycles, remainder = np.divmod(target, self.total)
+        index = np.searchsorted(self.flat, remainder + self.offsets[:, 0], side="left") - self.rows * (self.length + 1)
+        index = np.clip(index, 1, self.length)
+        second = index - 1
+        rate = self.bits_per_second[self.rows, second]
+        partial = np.where(rate > 0, (remainder - self.cumulative[self.rows, second]) / np.where(rate > 0, rate, 1), 0)
+        return cycles * self.length + second + partial
+
+
+class ThroughputRule:
+    """直近の取得スループットの調和平均に安全係数を掛け、それ以下の最大のレベルを選ぶ。"""
+    name = "throughput"
+
+    def __init__(self, safety=0.9, window=5):
+        self.safety = safety
+        self.window = window
+
+    def select(self, state):
+        history = state.throughput[:, -self.window:]
+        counts = np.minimum(state.samples, self.window)
+        valid = np.arange(history.shape[1])[None, :] >= history.shape[1] - counts[:, None]
+        inverse = np.where(valid, 1.0 / np.where(valid, history, 1), 0).sum(axis=1)
+        estimate = np.where(counts > 0, counts / np.where(inverse > 0, inverse, 1), 0) * self.safety
+        return highest_level_below(state.bitrates, estimate)
+
+
+class BufferBasedRule:
+    """
+    BBA-0: バッファがreservoir未満なら最低レベル、reservoir+cushion以上なら最高レベル、
+    その間はバッファ量に比例したビットレート以下の最大のレベルを選ぶ。
+    """
+    name = "buffer"
+
+    def __init__(self, reservoir=5.0, cushion=10.0):
+        self.reservoir = reservoir
+        self.cushion = cushion
+
+    def select(self, state):
+        lowest = np.nanmin(state.bitrates, axis=1)
+        highest = np.nanmax(state.bitrates, axis=1)
+        fraction = np.clip((state.buffer - self.reservoir) / self.cushion, 0, 1)
+        return highest_level_below(state.bitrates, lowest + fraction * (highest - lowest))
+
+
+class BolaRule:
+    """
+    BOLA-BASIC: 効用 v_m = ln(S_m / S_min) に対して (V (v_m + γp) - Q) / S_m を最大にするレベルを選ぶ。
+    Qはバッファ量（セグメント数）、Vはバッファ上限で最高レベルが選ばれるように決める。
+    """
+    name = "bola"
+
+    def __init__(self, gamma_p=5.0):
+        self.gamma_p = gamma_p
+
+    def select(self, state):
+        sizes = state.next_sizes
+        valid = np.isfinite(sizes)
+        smallest = np.nanmin(np.where(valid, sizes, np.nan), axis=1, keepdims=True)
+        utility = np.log(np.where(valid, sizes, 1) / smallest)
+        max_utility = np.nanmax(np.where(valid, utility, np.nan), axis=1)
+        max_segments = state.max_buffer / state.duration
+        control = (max_segments - 1) / (max_utility + self.gamma_p)
+        queue = (state.buffer / state.duration)[:, None]
+        score = (control[:, None] * (utility + self.gamma_p) - queue) / np.where(valid, sizes, 1)
+        return np.argmax(np.where(valid, score, -np.inf), axis=1)
+
+
+ALGORITHMS = {rule.name: rule for rule in (ThroughputRule, BufferBasedRule, BolaRule)}
+
+
+def highest_level_below(bitrates, limit):
+    """
+    limit以下で最大のビットレートのレベルを返す（どれも超える場合は最低レベル）。
+
+    Args:
+        bitrates (np.ndarray): 形状 (batch, levels)。昇順、使用しないレベルはNaN。
+        limit (np.ndarray): 形状 (batch,)。
+    """
+    allowed = np.nan_to_num(bitrates, nan=np.inf) <= limit[:, None]
+    return np.maximum(allowed.sum(axis=1) - 1, 0)
+
+
+class PlayerState:
+    """ABRアルゴリズムに渡すプレイヤーの状態（全てバッチ方向の配列）。"""
+
+    def __init__(self, batch, bitrates, max_buffer, history):
+        self.buffer = np.zeros(batch)
+        self.throughput = np.zeros((batch, history))
+        self.samples = np.zeros(batch, dtype=np.int64)
+        self.last_level = np.full(batch, -1)
+        self.bitrates = bitrates
+        self.max_buffer = max_buffer
+        self.next_sizes = None
+        self.duration = None
+
+
+def simulate(ladders, traces, algorithm, max_buffer=30.0, startup_buffer=None, rtt=0.05, history=10):
+    """
+    全てのラダー×トレースの組み合わせについて再生をシミュレーションする。
+
+    Args:
+        ladders (list): Ladderのリスト。
+        traces (np.ndarray): 形状 (traces, seconds) の帯域幅（kbps）。
+        algorithm: select(state) を持つABRアルゴリズム。
+        max_buffer (float): バッファの上限（秒）。超える場合は取得を待つ。
+        startup_buffer (float): 再生を開始するバッファ量（秒）。省略時は最初のセグメント1つ分。
+        rtt (float): セグメントごとのリクエストの往復遅延（秒）。
+        history (int): 保持するスループットの履歴の数。
+
+    Returns:
+        dict: 各指標の形状 (ladders, traces) の配列。
+            startup_delay, stall_time, stall_count, switches, average_bitrate（kbps）, levels_used。
+    """
+    traces = np.atleast_2d(np.asarray(traces, dtype=np.float64))
+    ladder_count, trace_count = len(ladders), len(traces)
+    batch = ladder_count * trace_count
+    ladder_index = np.repeat(np.arange(ladder_count), trace_count)
+    clock = TraceClock(np.tile(traces, (ladder_count, 1)))
+
+    # ラダーごとにレベル数・セグメント数が異なるため、NaN/infで埋めて揃える
+    level_count = max(len(ladder.bitrates) for ladder in ladders)
+    segment_count = min(len(ladder.durations) for ladder in ladders)
+    sizes = np.full((ladder_count, level_count, segment_count), np.inf)
+    bitrates = np.full((ladder_count, level_count), np.nan)
+    durations = np.zeros((ladder_count, segment_count))
+    for i, ladder in enumerate(ladders):
+        levels = len(ladder.bitrates)
+        sizes[i, :levels] = ladder.sizes[:, :segment_count]
+        bitrates[i, :levels] = ladder.bitrates
+        durations[i] = ladder.durations[:segment_count]
+
+    state = PlayerState(batch, bitrates[ladder_index], max_buffer, history)
+    rows = np.arange(batch)
+    now = np.zeros(batch)
+    started = np.zeros(batch, dtype=bool)
+    startup_delay = np.zeros(batch)
+    stall_time = np.zeros(batch)
+    stall_count = np.zeros(batch, dtype=np.int64)
+    switches = np.zeros(batch, dtype=np.int64)
+    bits_played = np.zeros(batch)
+    seconds_played = np.zeros(batch)
+    levels_used = np.zeros((batch, level_count), dtype=np.int64)
+
+    for segment in range(segment_count):
+        duration = durations[ladder_index, segment]
+        state.duration = duration
+        state.next_sizes = sizes[ladder_index, :, segment]
+        level = np.asarray(algorithm.select(state), dtype=np.int64)
+        level = np.minimum(level, np.isfinite(state.next_sizes).sum(axis=1) - 1)
+        size = state.next_sizes[rows, level]
+
+        finished = clock.finish_time(now + rtt, size)
+        download = finished - now
+
+        # 再生中はダウンロード中にバッファが減り、足りなければ停止する
+        stall = np.where(started, np.maximum(download - state.buffer, 0), 0)
+        stall_time += stall
+        stall_count += stall > 0
+        state.buffer = np.where(started, np.maximum(state.buffer - download, 0), state.buffer) + duration
+        now = finished
+
+        threshold = duration if startup_buffer is None else startup_buffer
+        starting = ~started & (state.buffer >= threshold)
+        startup_delay = np.where(starting, now, startup_delay)
+        started |= starting
+
+        # バッファが上限を超える場合は次の取得を待つ
+        wait = np.where(started, np.maximum(state.buffer - max_buffer, 0), 0)
+        now = now + wait
+        state.buffer = state.buffer - wait
+
+        switches += (state.last_level >= 0) & (level != state.last_level)
+        state.last_level = level
+        state.throughput = np.roll(state.throughput, -1, axis=1)
+        state.throughput[:, -1] = size / 1000 / np.maximum(download, 1e-6)
+        state.samples += 1
+        bits_played += size
+        seconds_played += duration
+        levels_used[rows, level] += 1
+
+    # 最後まで開始できなかった場合は全体の取得時間を起動遅延とする
+    startup_delay = np.where(started, startup_delay, now)
+
+    def per_ladder(values):
+        return values.reshape((ladder_count, trace_count) + values.shape[1:])
+
+    return {
+        "startup_delay": per_ladder(startup_delay),
+        "stall_time": per_ladder(stall_time),
+        "stall_count": per_ladder(stall_count),
+        "switches": per_ladder(switches),
+        "average_bitrate": per_ladder(bits_played / np.maximum(seconds_played, 1e-9) / 1000),
+        "levels_used": per_ladder(levels_used),
+    }
+
+
+def summarize(ladders, results):
+    """
+    シミュレーション結果をラダーごとに集計する（トレース全体の平均・中央値・95パーセンタイル）。
+
+    Returns:
+        dict: {algorithm: {ladder: {metric: {"mean", "p50", "p95"}}}}
+    """
+    summary = {}
+    for algorithm, metrics in results.items():
+        summary[algorithm] = {}
+        for i, ladder in enumerate(ladders):
+            summary[algorithm][ladder.name] = {
+                metric: {
+                    "mean": float(np.mean(values[i])),
+                    "p50": float(np.percentile(values[i], 50)),
+                    "p95": float(np.percentile(values[i], 95)),
+                }
+                for metric, values in metrics.items() if metric != "levels_used"
+            }
+            summary[algorithm][ladder.name]["level_share"] = (
+                metrics["levels_used"][i].sum(axis=0) / max(1, metrics["levels_used"][i].sum())
+            ).tolist()
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay bandwidth traces against HLS ladders with ABR algorithms.")
+    parser.add_argument("--hls-dir", action="append", default=[], help="HLS output directory (repeatable).")
+    parser.add_argument("--trace", action="append", default=[], help="Trace file/glob or metrics store directory.")
+    parser.add_argument("--synthetic", type=int, default=0, help="Number of synthetic traces to generate.")
+    parser.add_argument("--mean-kbps", type=float, default=2000.0)
+    parser.add_argument("--variability", type=float, default=0.5)
+    parser.add_argument("--seconds", type=int, default=600, help="Length of synthetic traces.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--algorithms", default=",".join(ALGORITHMS))
+    parser.add_argument("--max-buffer", type=float, default=30.0)
+    parser.add_argument("--rtt", type=float, default=0.05, help="Request round-trip time in seconds.")
+    parser.add_argument("--output", default=None, help="Write the summary as JSON.")
+    args = parser.parse_args(argv)
+
+    ladders = [load_ladder(path) for path in (args.hls_dir or ["segments/hls_file"])]
+    traces = []
+    for pattern in args.trace:
+        traces.extend(load_trace(path) for path in sorted(glob.glob(pattern)) or [pattern])
+    if args.synthetic:
+        traces.extend(generate_traces(args.synthetic, args.seconds, args.mean_kbps, args.variability, args.seed))
+    if not traces:
+        parser.error("Provide --trace and/or --synthetic.")
+    traces = stack_traces(traces)
+
+    results = {}
+    for name in args.algorithms.split(","):
+        if name not in ALGORITHMS:
+            parser.error(f"Unknown algorithm: {name}")
+        results[name] = simulate(ladders, traces, ALGORITHMS[name](), max_buffer=args.max_buffer, rtt=args.rtt)
+
+    summary = summarize(ladders, results)
+    for algorithm, per_ladder in summary.items():
+        for ladder, metrics in per_ladder.items():
+            print(f"{algorithm:>10} {ladder:>20}: startup {metrics['startup_delay']['mean']:.2f}s, "
+                  f"stall {metrics['stall_time']['mean']:.2f}s ({metrics['stall_count']['mean']:.1f}x), "
+                  f"switches {metrics['switches']['mean']:.1f}, "
+                  f"bitrate {metrics['average_bitrate']['mean']:.0f} kbps")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"traces": len(traces), "ladders": [ladder.name for ladder in ladders],
+                       "summary": summary}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
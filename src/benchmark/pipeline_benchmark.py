@@ -0,0 +1,514 @@
+"""
+合成した入力動画でパイプラインの各ステージを計測するベンチマーク。
+
+ffmpegのlavfiソース(testsrcなど)で指定した解像度・長さの動画を生成し、次のステージを個別に計測する。
+  h264    : compress_video_to_h264
+  segment : mp4_create
+  hls     : create_hls_with_dynamic_bitrate（セグメントごと）
+  serve   : serve_hls へのリクエスト（keep-alive接続で並行に取得）
+  monitor : ネットワークモニタの計測ループ（ThroughputSampler + AsyncProbeEngine + MetricsStore）
+
+各ステージは新しいプロセスで実行し、ウォールタイム、フレーム/秒、ピークRSS、CPU使用率を計測して
+JSONに書き出す。--compare で以前の結果と比較し、遅くなったステージを表示する。
+
+使い方:
+    python -m src.benchmark.pipeline_benchmark --resolutions 640x360,1280x720 --durations 10,60
+    python -m src.benchmark.pipeline_benchmark --compare benchmarks/results/<前回>.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+STAGES = ("h264", "segment", "hls", "serve", "monitor")
+FPS = 30
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080)]
+
+
+def generate_clip(path, width, height, seconds, source="testsrc"):
+    """
+    ffmpegのlavfiソースから合成動画を生成する。
+
+    Args:
+        path (str): 出力先のパス。
+        width (int): 幅。
+        height (int): 高さ。
+        seconds (int): 長さ（秒）。
+        source (str): lavfiのソース名 ("testsrc", "testsrc2", "smptebars" など)。
+    """
+    command = [
+        "ffmpeg", "-y", "-f", "lavfi", "-i", f"{source}=size={width}x{height}:rate={FPS}:duration={seconds}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", path
+    ]
+    subprocess.run(command, capture_output=True, check=True)
+
+
+def resource_usage():
+    """
+    このプロセスと終了済みの子プロセス(ffmpeg)のCPU時間とピークRSSを返す。
+
+    Returns:
+        dict: cpu_seconds, peak_rss_bytes（自プロセス）, child_peak_rss_bytes（最大の子プロセス）。
+    """
+    if resource is not None:
+        # Linuxのru_maxrssはKB、macOSはバイト
+        scale = 1 if sys.platform == "darwin" else 1024
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            "cpu_seconds": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+            "peak_rss_bytes": own.ru_maxrss * scale,
+            "child_peak_rss_bytes": children.ru_maxrss * scale,
+        }
+
+    import psutil
+    process = psutil.Process()
+    times = process.cpu_times()
+    memory = process.memory_info()
+    return {
+        "cpu_seconds": times.user + times.system + times.children_user + times.children_system,
+        "peak_rss_bytes": getattr(memory, "peak_wset", memory.rss),
+        "child_peak_rss_bytes": None,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Server did not start on port {port}")
+
+
+def list_segments(segment_dir):
+    return sorted(
+        os.path.join(segment_dir, f) for f in os.listdir(segment_dir)
+        if f.startswith("segment_") and f.endswith(".mp4")
+    )
+
+
+def list_hls_files(hls_dir):
+    """配信ディレクトリ内のプレイリストとセグメントのURLパスを返す。"""
+    paths = []
+    for root, _, files in os.walk(hls_dir):
+        for name in files:
+            if name.endswith((".m3u8", ".ts", ".m4s", ".mp4")):
+                paths.append("/" + os.path.relpath(os.path.join(root, name), hls_dir).replace(os.sep, "/"))
+    return sorted(paths)
+
+
+def stage_h264(clip, width, height, frames, options):
+    from src.server.h264_compression import compress_video_to_h264
+    compress_video_to_h264(clip, width, height)
+    return {"frames": frames}
+
+
+def stage_segment(clip, width, height, frames, options):
+    from src.server.mp4_creater import mp4_create
+    mp4_create(clip, frames, "h264_outputs/res.mp4", width, height, segment_mode=options["segment_mode"])
+    return {"frames": frames, "segments": len(list_segments("segments/segmented_video"))}
+
+
+def stage_hls(clip, width, height, frames, options):
+    from src.server.hls_server import create_hls_with_dynamic_bitrate, finalize_m3u8
+    from src.server.media_probe import get_video_bitrate
+
+    hls_dir = "segments/hls_file"
+    shutil.rmtree(hls_dir, ignore_errors=True)
+    os.makedirs(hls_dir, exist_ok=True)
+    video_bitrate = get_video_bitrate("h264_outputs/res.mp4")
+    segments = list_segments("segments/segmented_video")
+    for segment in segments:
+        create_hls_with_dynamic_bitrate(segment, hls_dir, RESOLUTIONS, video_bitrate, playlist_type="EVENT")
+    finalize_m3u8(hls_dir)
+    return {"frames": frames, "segments": len(segments), "renditions": len(RESOLUTIONS)}
+
+
+def stage_serve(clip, width, height, frames, options):
+    """
+    serve_hlsを起動し、clients本のkeep-alive接続でプレイリストとセグメントを繰り返し取得する。
+    """
+    from src.client.hls_client import serve_hls
+    from src.client.segment_cache import SegmentCache
+
+    hls_dir = os.path.abspath("segments/hls_file")
+    paths = list_hls_files(hls_dir)
+    if not paths:
+        raise RuntimeError("No HLS files to serve; run the hls stage first.")
+
+    port = free_port()
+    cache = SegmentCache() if options["serve_cache"] else None
+    template = os.path.join(REPO_ROOT, "src", "client", "playback", "hls_template.html")
+    server = threading.Thread(
+        target=serve_hls,
+        args=(hls_dir, template, os.path.join(hls_dir, "index.html"), "master.m3u8"),
+        kwargs={"port": port, "cache": cache, "open_browser": False},
+        daemon=True
+    )
+    server.start()
+    wait_for_port(port)
+
+    duration = options["serve_seconds"]
+    latencies = []
+    counters = {"requests": 0, "bytes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(offset):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        local_latencies = []
+        requests = body_bytes = errors = 0
+        index = offset
+        while time.perf_counter() < deadline:
+            path = paths[index % len(paths)]
+            index += 1
+            started = time.perf_counter()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                body_bytes += len(response.read())
+                if response.status != 200:
+                    errors += 1
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+                continue
+            local_latencies.append(time.perf_counter() - started)
+            requests += 1
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            counters["requests"] += requests
+            counters["bytes"] += body_bytes
+            counters["errors"] += errors
+
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(options["serve_clients"])]
+    # ハンドラのアクセスログ(stderr)で端末が埋まらないようにする（書き込み自体は計測に含まれる）
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+
+    latencies.sort()
+
+    def latency_ms(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000 if latencies else None
+
+    return {
+        "requests": counters["requests"],
+        "requests_per_second": counters["requests"] / duration,
+        "megabytes_per_second": counters["bytes"] / duration / 1024 ** 2,
+        "errors": counters["errors"],
+        "clients": options["serve_clients"],
+        "latency_p50_ms": latency_ms(50),
+        "latency_p95_ms": latency_ms(95),
+        "latency_p99_ms": latency_ms(99),
+    }
+
+
+def stage_monitor(clip, width, height, frames, options):
+    """
+    ネットワークモニタの計測ループを、ローカルの静的サーバーに対してmonitor_seconds秒実行する。
+    計測自体のオーバーヘッド（CPU使用率）と、実際に得られたサンプル数・プローブ数を記録する。
+    """
+    import functools
+    import http.server
+    from src.client.http_engine import PooledHTTPServer
+    from src.metrics_store import MetricsStore
+    from src.monitor_videostreaming import NETWORK_SCHEMA
+    from src.network_probe import AsyncProbeEngine
+    from src.throughput_sampler import ThroughputSampler
+    from src.utils import CONFIG_PATH, load_config
+
+    class QuietHandler(http.server.SimpleHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+    hls_dir = os.path.abspath("segments/hls_file")
+    os.makedirs(hls_dir, exist_ok=True)
+    if not os.path.exists(os.path.join(hls_dir, "master.m3u8")):
+        with open(os.path.join(hls_dir, "master.m3u8"), "w") as f:
+            f.write("#EXTM3U\n")
+
+    # ワーカーは作業ディレクトリに移動しているため、設定はリポジトリのものを絶対パスで読む
+    monitor_config = load_config(os.path.join(REPO_ROOT, CONFIG_PATH)).get("network_monitor", {})
+    port = free_port()
+    server = PooledHTTPServer(("127.0.0.1", port), functools.partial(QuietHandler, directory=hls_dir), workers=8)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    sampler = ThroughputSampler(options["interface"], monitor_config.get("sample_rate", 20.0))
+    probe = AsyncProbeEngine(f"http://127.0.0.1:{port}/master.m3u8",
+                             rate=monitor_config.get("probe_rate", 20),
+                             connections=monitor_config.get("probe_connections", 2))
+    store = MetricsStore("monitor_metrics", NETWORK_SCHEMA)
+
+    sampler.start()
+    probe.start()
+    sampler_samples = reports = 0
+    deadline = time.time() + options["monitor_seconds"]
+    try:
+        while time.time() < deadline:
+            time.sleep(monitor_config.get("report_interval", 1.0))
+            throughput = sampler.collect()
+            sample = {"time": time.time()}
+            sample.update(throughput)
+            sample.update(probe.snapshot())
+            store.append(sample)
+            sampler_samples += throughput["samples"]
+            reports += 1
+    finally:
+        probe.stop()
+        sampler.stop()
+        store.close()
+        server.shutdown()
+        server.server_close()
+
+    return {
+        "reports": reports,
+        "sampler_samples": sampler_samples,
+        "probes_sent": probe.stats.sent,
+        "probes_failed": probe.stats.failed,
+    }
+
+
+STAGE_FUNCTIONS = {
+    "h264": stage_h264,
+    "segment": stage_segment,
+    "hls": stage_hls,
+    "serve": stage_serve,
+    "monitor": stage_monitor,
+}
+
+
+def _stage_worker(stage, workdir, clip, width, height, frames, options, results):
+    """子プロセスでステージを1つ実行し、計測結果をresultsに送る。"""
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    try:
+        before = resource_usage()
+        started = time.perf_counter()
+        extra = STAGE_FUNCTIONS[stage](clip, width, height, frames, options)
+        wall = time.perf_counter() - started
+        after = resource_usage()
+        cpu_seconds = after["cpu_seconds"] - before["cpu_seconds"]
+        results.put({
+            "ok": True,
+            "wall_seconds": wall,
+            "fps": extra.pop("frames") / wall if "frames" in extra and wall > 0 else None,
+            "cpu_seconds": cpu_seconds,
+            # 100%で1コアを使い切った状態
+            "cpu_percent": cpu_seconds / wall * 100 if wall > 0 else None,
+            "peak_rss_bytes": after["peak_rss_bytes"],
+            "child_peak_rss_bytes": after["child_peak_rss_bytes"],
+            "extra": extra,
+        })
+    except Exception as e:
+        results.put({"ok": False, "error": f"{type(e).__name__}: {e}"})
+
+
+def run_stage(stage, workdir, clip, width, height, frames, options):
+    """ステージを新しいプロセスで実行し、ピークRSSが他のステージの影響を受けないようにする。"""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_stage_worker,
+                              args=(stage, workdir, clip, width, height, frames, options, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1.0)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                result = {"ok": False, "error": f"stage process exited with code {process.exitcode}"}
+                break
+    process.join()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def ffmpeg_version():
+    try:
+        output = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True, check=True).stdout
+        return output.splitlines()[0]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        return None
+
+
+def run_benchmark(resolutions, durations, stages, options, workdir=None, keep=False):
+    """
+    全ての解像度・長さの組み合わせについて、指定したステージを順に計測する。
+
+    Returns:
+        dict: {"meta": {...}, "runs": [...]}
+    """
+    base_dir = workdir or tempfile.mkdtemp(prefix="hls-bench-")
+    runs = []
+    try:
+        for width, height in resolutions:
+            for seconds in durations:
+                clip_dir = os.path.join(base_dir, f"{width}x{height}-{seconds}s")
+                os.makedirs(clip_dir, exist_ok=True)
+                clip = os.path.join(clip_dir, "input.mp4")
+                print(f"[bench] generating {width}x{height} {seconds}s clip ({options['source']})")
+                generate_clip(clip, width, height, seconds, options["source"])
+                frames = seconds * FPS
+
+                for stage in stages:
+                    result = run_stage(stage, clip_dir, clip, width, height, frames, options)
+                    result.update({"stage": stage, "width": width, "height": height, "seconds": seconds})
+                    runs.append(result)
+                    if result["ok"]:
+                        fps = f", {result['fps']:.1f} fps" if result["fps"] else ""
+                        print(f"[bench] {width}x{height} {seconds}s {stage}: {result['wall_seconds']:.2f}s{fps}, "
+                              f"cpu {result['cpu_percent']:.0f}%, peak rss "
+                              f"{result['peak_rss_bytes'] / 1024 ** 2:.0f} MB")
+                    else:
+                        print(f"[bench] {width}x{height} {seconds}s {stage}: failed ({result['error']})")
+    finally:
+        if not keep and workdir is None:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "ffmpeg": ffmpeg_version(),
+            "options": options,
+        },
+        "runs": runs,
+    }
+
+
+def compare_results(current, previous, threshold=0.10):
+    """
+    同じ(解像度, 長さ, ステージ)のウォールタイムを比較し、threshold以上遅くなったものを返す。
+
+    Returns:
+        list: [(キー, 以前の秒数, 今回の秒数, 比率), ...]
+    """
+    def index(results):
+        return {(run["width"], run["height"], run["seconds"], run["stage"]): run
+                for run in results["runs"] if run.get("ok")}
+
+    previous_runs = index(previous)
+    regressions = []
+    for key, run in index(current).items():
+        before = previous_runs.get(key)
+        if before is None or not before["wall_seconds"]:
+            continue
+        ratio = run["wall_seconds"] / before["wall_seconds"]
+        if ratio >= 1 + threshold:
+            regressions.append((key, before["wall_seconds"], run["wall_seconds"], ratio))
+    return regressions
+
+
+def parse_resolutions(text):
+    return [tuple(int(value) for value in item.lower().split("x")) for item in text.split(",") if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the HLS pipeline on synthetic clips.")
+    parser.add_argument("--resolutions", default="640x360,1280x720", help="Comma-separated WxH list.")
+    parser.add_argument("--durations", default="10,60", help="Comma-separated clip lengths in seconds.")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Comma-separated subset of {', '.join(STAGES)}.")
+    parser.add_argument("--source", default="testsrc", help="lavfi source used to generate clips.")
+    parser.add_argument("--segment-mode", default="copy", choices=("copy", "encode"))
+    parser.add_argument("--serve-seconds", type=float, default=5.0)
+    parser.add_argument("--serve-clients", type=int, default=16)
+    parser.add_argument("--serve-cache", action="store_true", help="Enable the in-memory segment cache.")
+    parser.add_argument("--monitor-seconds", type=float, default=5.0)
+    parser.add_argument("--interface", default=None, help="Interface for the monitor stage (default: all).")
+    parser.add_argument("--workdir", default=None, help="Directory for generated files (default: temp dir).")
+    parser.add_argument("--keep", action="store_true", help="Keep generated files.")
+    parser.add_argument("--output", default=None, help="Result JSON path (default: benchmarks/results/...).")
+    parser.add_argument("--compare", default=None, help="Previous result JSON to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Slowdown ratio reported as regression.")
+    args = parser.parse_args(argv)
+
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    options = {
+        "source": args.source,
+        "segment_mode": args.segment_mode,
+        "serve_seconds": args.serve_seconds,
+        "serve_clients": args.serve_clients,
+        "serve_cache": args.serve_cache,
+        "monitor_seconds": args.monitor_seconds,
+        "interface": args.interface,
+    }
+    results = run_benchmark(parse_resolutions(args.resolutions),
+                            [int(value) for value in args.durations.split(",") if value],
+                            stages, options, workdir=args.workdir, keep=args.keep)
+
+    output = args.output
+    if output is None:
+        revision = (results["meta"]["revision"] or "unknown")[:8]
+        stamp = datetime.datetime.now().strftime("%y%m%d-%H%M%S")
+        output = os.path.join(REPO_ROOT, "benchmarks", "results", f"{stamp}-{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"[bench] results written to {output}")
+
+    failed = [run for run in results["runs"] if not run["ok"]]
+    regressions = []
+    if args.compare:
+        with open(args.compare, "r") as f:
+            previous = json.load(f)
+        regressions = compare_results(results, previous, args.threshold)
+        for (width, height, seconds, stage), before, after, ratio in regressions:
+            print(f"[bench] REGRESSION {width}x{height} {seconds}s {stage}: {before:.2f}s -> {after:.2f}s "
+                  f"({ratio:.2f}x)")
+        if not regressions:
+            print(f"[bench] no regressions against {args.compare}")
+
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,10 +2,6 @@ import webbrowser
 import subprocess
 import platform
 import os
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
 
 # グローバル変数
 driver = None
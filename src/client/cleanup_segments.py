@@ -1,13 +1,16 @@
 import os
 import shutil
 
-def clear_hls_segments(segment_dir):
+def clear_hls_segments(segment_dir, segment_db=None):
     """
     指定されたディレクトリ内のすべてのHLSセグメントを削除。
 
     Args:
         segment_dir (str): セグメントを格納しているディレクトリのパス。
+        segment_db (SegmentIndex): 指定した場合、このディレクトリのセグメントと番号の記録も削除する。
     """
+    if segment_db is not None:
+        segment_db.clear_renditions(segment_dir)
     if os.path.exists(segment_dir):
         try:
             shutil.rmtree(segment_dir)
@@ -1,29 +1,55 @@
 from src.client.hls_client import serve_hls
+from src.client.segment_cache import SegmentCache
+from src.server.segment_index import load_segment_index
+from src.utils import load_config, hls_server_port, hls_public_url
 
 
 class VidepPlayback:
-    def __init__(self, hls_dir):
+    def __init__(self, hls_dir, open_browser=True):
         # Directory containing the HLS files (e.g., playlist.m3u8 and .ts files)
         self.output_dir = "segments/hls_file"
         # Path to save the HTML file
         self.html_file = "segments/hls_file/live-stream.html"
         # URL to the HLS playlist
         self.m3u8_playlist_url = "http://localhost:8080/master.m3u8"
+        # プレイヤーのページをブラウザで開くか（ヘッドレス実行では開かない）
+        self.open_browser = open_browser
 
     def run(self):
         running = True
+        config = load_config()
+        server_config = config.get("http_server", {})
+        cache_config = config.get("segment_cache", {})
+        # サーバーを再起動してもキャッシュは引き継ぐ
+        cache = None
+        if cache_config.get("enabled", True):
+            cache = SegmentCache(
+                max_bytes=cache_config.get("max_bytes", 256 * 1024 ** 2),
+                max_object_bytes=cache_config.get("max_object_bytes", 16 * 1024 ** 2),
+                playlist_validation=cache_config.get("playlist_validation", "mtime")
+            )
+        # パッケージャが記録したセグメントのチェックサムをETagに使う
+        segment_db = load_segment_index(config)
 
         while running:
             serve_hls(
                 output_directory="segments/hls_file",
                 html_template_path="src/client/playback/hls_template.html",
                 html_file_path="segments/hls_file/live-stream.html",
-                m3u8_url="http://localhost:8080/master.m3u8"
+                m3u8_url=hls_public_url("master.m3u8", config),
+                port=hls_server_port(config),
+                workers=server_config.get("workers", 64),
+                max_connections=server_config.get("max_connections", 256),
+                keepalive_timeout=server_config.get("keepalive_timeout", 5.0),
+                write_timeout=server_config.get("write_timeout", 60.0),
+                cache=cache,
+                open_browser=self.open_browser,
+                segment_db=segment_db
             )
 
-def start_video_playback(hls_dir):
+def start_video_playback(hls_dir, open_browser=True):
     """
     VideoPlayback の実行
     """
-    client_operator = VidepPlayback(hls_dir)
+    client_operator = VidepPlayback(hls_dir, open_browser)
     client_operator.run()
\ No newline at end of file
@@ -1,11 +1,40 @@
+import functools
 import http.server
-import socketserver
 import webbrowser
 import os
 import json
+import re
+import time
+from urllib.parse import parse_qs, urljoin
 from src.client.playback.logger import VideoLogger
+from src.client.http_engine import PooledHTTPServer
+from src.client.segment_cache import SegmentCache
+from src.server.ll_hls import part_published, playlist_edge, playlist_satisfies
 
-def serve_hls(output_directory, html_template_path, html_file_path, m3u8_url):
+# LL-HLSのブロッキングリクエストを保留する最大時間（秒）とポーリング間隔
+BLOCKING_RELOAD_TIMEOUT = 6.0
+BLOCKING_POLL_INTERVAL = 0.02
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def parse_range(header):
+    """
+    Parse a single-range "Range: bytes=..." header.
+
+    Returns:
+        tuple: (start, end) where end is inclusive. start is None for a suffix range
+            (the last `end` bytes) and end is None for an open-ended range.
+            None if the header is not a single byte range.
+    """
+    match = _RANGE_PATTERN.match(header.strip()) if header else None
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    start, end = match.groups()
+    return (int(start) if start else None), (int(end) if end else None)
+
+def serve_hls(output_directory, html_template_path, html_file_path, m3u8_url,
+              port=8080, workers=64, max_connections=256, keepalive_timeout=5.0, cache=None, open_browser=True,
+              segment_db=None, write_timeout=60.0):
     """
     Serve HLS video and open it in Chrome, with real-time logging.
 
@@ -13,7 +42,17 @@ def serve_hls(output_directory, html_template_path, html_file_path, m3u8_url):
         output_directory (str): Directory containing the HLS files.
         html_template_path (str): Path to the HTML template file.
         html_file_path (str): Path to save the final HTML file.
-        m3u8_url (str): URL to the playlist file (playlist.m3u8).
+        m3u8_url (str): URL to the playlist file (playlist.m3u8). The player page is opened on the same
+            origin, so with the shaping proxy this is the proxy's URL rather than the port served here.
+        port (int): Port to listen on.
+        workers (int): Number of worker threads handling connections.
+        max_connections (int): Maximum number of concurrent connections; extra ones get 503.
+        keepalive_timeout (float): Seconds an idle keep-alive connection is kept open.
+        write_timeout (float): Seconds a response may stall (e.g. a slow or shaped client) before the
+            connection is dropped.
+        cache (SegmentCache): In-memory cache for segment and playlist bodies. None serves from disk.
+        open_browser (bool): Open the player page in the browser (disable for benchmarks/headless runs).
+        segment_db (SegmentIndex): Segment index used to send ETags and answer If-None-Match with 304.
     """
     # Initialize the logger
     logger = VideoLogger(log_dir="logs/video_streaming")
@@ -31,18 +70,206 @@ def serve_hls(output_directory, html_template_path, html_file_path, m3u8_url):
         html_file.write(html_content)
 
     # Start HTTP server with custom handler
-    os.chdir(output_directory)
-    port = 8080
+    # chdirせずに配信ディレクトリを渡し、サーバーを再起動しても相対パスが変わらないようにする
+    serve_directory = os.path.abspath(output_directory)
 
     class LoggingHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+        # keep-aliveで同じ接続を使い回す
+        protocol_version = "HTTP/1.1"
+        extensions_map = {
+            **http.server.SimpleHTTPRequestHandler.extensions_map,
+            ".m4s": "video/iso.segment",
+            ".cmfv": "video/mp4",
+        }
+        etag = None  # 次の応答に付けるETag
+
+        def end_headers(self):
+            if self.etag is not None:
+                self.send_header("ETag", self.etag)
+                self.etag = None
+            super().end_headers()
+
         def do_GET(self):
             try:
+                path, _, query = self.path.partition("?")
+                params = parse_qs(query)
+                if path.endswith(".m3u8") and "_HLS_msn" in params:
+                    # LL-HLSのブロッキングリロード
+                    if not self.wait_for_playlist(path, params):
+                        return
+                elif path.endswith(".ts") and os.path.basename(path).startswith("part-"):
+                    # プリロードヒントで要求されたパーシャルセグメントは完成まで待機
+                    if not self.wait_for_part(path):
+                        return
+
+                if path == "/_cache/stats":
+                    self.send_json(cache.stats() if cache else {})
+                    return
+                if "Range" in self.headers and not path.endswith(".m3u8") and self.send_range(path):
+                    return
+                if segment_db is not None and not path.endswith(".m3u8") and self.send_not_modified(path):
+                    return
+                if cache is not None and self.send_cached(path):
+                    return
                 super().do_GET()
             except ConnectionAbortedError:
                 print("Connection was aborted by the client.")
             except Exception as e:
                 print(f"Unexpected error in GET request: {e}")
 
+        def wait_for_playlist(self, path, params):
+            """
+            _HLS_msn/_HLS_part で指定された位置がプレイリストに公開されるまで応答を保留する。
+            """
+            try:
+                msn = int(params["_HLS_msn"][0])
+                part = int(params["_HLS_part"][0]) if "_HLS_part" in params else None
+            except ValueError:
+                self.send_error(400, "Invalid _HLS_msn/_HLS_part")
+                return False
+
+            file_path = self.translate_path(path)
+            deadline = time.time() + BLOCKING_RELOAD_TIMEOUT
+            while time.time() < deadline:
+                try:
+                    with open(file_path, "r") as f:
+                        text = f.read()
+                except FileNotFoundError:
+                    text = ""
+                if text:
+                    if playlist_satisfies(text, msn, part):
+                        return True
+                    # 2セグメント以上先の要求は不正とする
+                    if msn > playlist_edge(text)[0] + 2:
+                        self.send_error(400, "_HLS_msn is too far in the future")
+                        return False
+                time.sleep(BLOCKING_POLL_INTERVAL)
+            self.send_error(503, "Playlist update timed out")
+            return False
+
+        def wait_for_part(self, path):
+            """
+            パーシャルセグメントが解像度のプレイリストに公開されるまで応答を保留する。
+            FFmpegはパーシャルを最終的な名前のまま書き込むため、ファイルの存在だけでは完成を判定できない。
+            """
+            file_path = self.translate_path(path)
+            level_dir = os.path.dirname(file_path)
+            playlist_path = os.path.join(level_dir, f"{os.path.basename(level_dir)}.m3u8")
+            deadline = time.time() + BLOCKING_RELOAD_TIMEOUT
+            while time.time() < deadline:
+                try:
+                    with open(playlist_path, "r") as f:
+                        text = f.read()
+                except FileNotFoundError:
+                    text = ""
+                if text and part_published(text, os.path.basename(file_path)):
+                    return True
+                time.sleep(BLOCKING_POLL_INTERVAL)
+            self.send_error(503, "Partial segment not yet available")
+            return False
+
+        def send_not_modified(self, path):
+            """
+            インデックスに記録されたセグメントのチェックサムをETagとし、If-None-Matchが一致すれば304を返す。
+            一致しない場合はETagを設定してFalse（通常の応答に任せる）。
+            """
+            file_path = self.translate_path(path)
+            row = segment_db.lookup(file_path)
+            if row is None:
+                return False
+            _, checksum = row
+            etag = f'"{checksum[:32]}"'
+            if etag not in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+                self.etag = etag
+                return False
+            self.send_response(304)
+            self.etag = etag
+            self.end_headers()
+            return True
+
+        def send_cached(self, path):
+            """
+            セグメント/プレイリストをメモリ上のキャッシュから返す。キャッシュできない場合はFalse。
+            """
+            file_path = self.translate_path(path)
+            if not SegmentCache.is_cacheable(file_path):
+                return False
+            body = cache.get(file_path)
+            if body is None:
+                return False
+            self.send_response(200)
+            self.send_header("Content-Type", self.guess_type(file_path))
+            self.send_header("Content-Length", str(len(body)))
+            if file_path.endswith(".m3u8"):
+                self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(body)
+            return True
+
+        def send_range(self, path):
+            """
+            単一範囲のRangeリクエストに206で応答する（fMP4の単一ファイルのEXT-X-BYTERANGE用）。
+            キャッシュにあればディスクに触れず、なければsendfileでファイルから直接送る。
+            複数範囲などで扱えない場合はFalse（通常の200応答に任せる）。
+            """
+            byte_range = parse_range(self.headers["Range"])
+            if byte_range is None:
+                return False
+            start, end = byte_range
+            file_path = self.translate_path(path)
+
+            # プレイヤーは公開済みの範囲を先頭と末尾を指定して要求するため、そのままキャッシュを引ける
+            if cache is not None and start is not None and end is not None:
+                body = cache.get_range(file_path, start, end)
+                if body is not None:
+                    self.send_range_headers(file_path, start, end, None)
+                    self.wfile.write(body)
+                    return True
+
+            try:
+                f = open(file_path, "rb")
+            except OSError:
+                self.send_error(404, "File not found")
+                return True
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                if start is None:
+                    start, end = max(0, size - end), size - 1
+                elif end is None or end >= size:
+                    end = size - 1
+                if start >= size or start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return True
+                self.send_range_headers(file_path, start, end, size)
+                # ユーザー空間にコピーせずにソケットへ送る（非対応のOSでは通常の送信になる）
+                self.connection.sendfile(f, start, end - start + 1)
+            return True
+
+        def send_range_headers(self, file_path, start, end, size):
+            self.send_response(206)
+            self.send_header("Content-Type", self.guess_type(file_path))
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size if size is not None else '*'}")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+
+        def send_json(self, data):
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_empty_response(self, code):
+            # keep-alive接続ではContent-Lengthがないとクライアントが応答の終わりを判別できない
+            self.send_response(code)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
         def do_POST(self):
             try:
                 if self.path == "/log_event":
@@ -50,26 +277,53 @@ def serve_hls(output_directory, html_template_path, html_file_path, m3u8_url):
                         content_length = int(self.headers['Content-Length'])
                         post_data = self.rfile.read(content_length)
                         event_data = json.loads(post_data)
-                        logger.log_event(event_data)
-                        self.send_response(200)
-                        self.end_headers()
+                        # 単一のイベント、イベントの配列、{"events": [...]} のいずれも受け付ける
+                        if isinstance(event_data, dict) and isinstance(event_data.get("events"), list):
+                            event_data = event_data["events"]
+                        if isinstance(event_data, list):
+                            logger.log_events([event for event in event_data if isinstance(event, dict)])
+                        elif isinstance(event_data, dict):
+                            logger.log_event(event_data)
+                        else:
+                            self.send_empty_response(400)
+                            return
+                        self.send_empty_response(200)
                     except Exception as e:
                         print(f"Error handling POST request: {e}")
-                        self.send_response(500)
-                        self.end_headers()
+                        self.send_empty_response(500)
+                elif self.path == "/_cache/invalidate":
+                    # パッケージャからのプレイリスト書き込み通知
+                    content_length = int(self.headers['Content-Length'])
+                    paths = json.loads(self.rfile.read(content_length)).get("paths", [])
+                    if cache is not None:
+                        for path in paths:
+                            cache.invalidate(path)
+                    self.send_empty_response(204)
+                else:
+                    self.send_empty_response(404)
             except ConnectionResetError:
                 print("Connection reset by the client.")
             except Exception as e:
                 print(f"Error in POST request: {e}")
 
     try:
-        server_url = f"http://localhost:{port}/{os.path.basename(html_file_path)}"
+        # プレイヤーのページはプレイリストと同じオリジン（プロキシ経由の場合はプロキシ）から開く
+        server_url = urljoin(m3u8_url, os.path.basename(html_file_path))
         print(f"Serving at {server_url}")
-        webbrowser.open(server_url)
+        if open_browser:
+            webbrowser.open(server_url)
 
-        with socketserver.TCPServer(("", port), LoggingHTTPRequestHandler) as httpd:
-            print(f"Serving HLS files at port {port}")
+        # ワーカースレッドのプールで接続を並行に処理する
+        handler = functools.partial(LoggingHTTPRequestHandler, directory=serve_directory)
+        with PooledHTTPServer(("", port), handler, workers=workers,
+                              max_connections=max_connections, keepalive_timeout=keepalive_timeout,
+                              write_timeout=write_timeout) as httpd:
+            print(f"Serving HLS files at port {port} ({workers} workers, up to {max_connections} connections)")
             print("Press Ctrl+C to stop the server.")
             httpd.serve_forever()
     except KeyboardInterrupt:
         print("Server stopped.")
+    finally:
+        logger.close()
+        if cache is not None:
+            print(f"Segment cache stats: {cache.stats()}")
@@ -0,0 +1,192 @@
+"""
+HLS配信用の並行HTTPサーバー。
+
+接続ごとにスレッドを生成する代わりに、固定数のワーカースレッドで接続を処理する。
+同時接続数には上限を設け、上限を超えた接続には503を返してすぐに閉じる。
+ハンドラをHTTP/1.1(keep-alive)で動作させ、プレイヤーがプレイリストとセグメントを
+同じ接続で取得し続けられるようにする。
+
+ワーカーは1リクエストを処理するたびに接続を手放し、次のリクエストを待つkeep-alive接続は
+セレクタのスレッドで待機させる（アイドル状態の接続がワーカーを占有しない）。
+アイドルのタイムアウト(keepalive_timeout)は次のリクエストを待つ間だけに適用し、
+リクエストの処理中の送受信にはより長いwrite_timeoutを使う（帯域が制限された遅いクライアントでも
+セグメントの送信中に切断されない）。
+"""
+
+import functools
+import http.server
+import queue
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BUSY_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Length: 0\r\n"
+    b"Connection: close\r\n\r\n"
+)
+
+
+def single_request_handler(handler_class):
+    """
+    1回の呼び出しで1リクエストだけを処理するハンドラのクラスを作成する。
+
+    Args:
+        handler_class (type): BaseHTTPRequestHandlerのサブクラス（functools.partialも可）。
+
+    Returns:
+        callable: ハンドラを作成する関数。作成したハンドラのclose_connectionで接続を続けるかを判定する。
+    """
+    args, keywords = (), {}
+    if isinstance(handler_class, functools.partial):
+        handler_class, args, keywords = handler_class.func, handler_class.args, handler_class.keywords
+
+    class SingleRequestHandler(handler_class):
+        def handle(self):
+            self.close_connection = True
+            self.handle_one_request()
+            # パイプラインで受信済みのリクエストはこのハンドラの読み込みバッファにあるため、続けて処理する
+            while not self.close_connection and self._has_buffered_request():
+                self.handle_one_request()
+
+        def _has_buffered_request(self):
+            timeout = self.connection.gettimeout()
+            self.connection.settimeout(0)
+            try:
+                return bool(self.rfile.peek(1))
+            except OSError:
+                return False
+            finally:
+                self.connection.settimeout(timeout)
+
+    SingleRequestHandler.__name__ = handler_class.__name__
+    return functools.partial(SingleRequestHandler, *args, **keywords)
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, workers=64, max_connections=256, keepalive_timeout=5.0,
+                 write_timeout=60.0):
+        """
+        Args:
+            server_address (tuple): (host, port)。
+            handler_class (type): リクエストハンドラのクラス。
+            workers (int): リクエストを処理するワーカースレッド数。
+            max_connections (int): 同時に受け付ける接続数の上限（待機中のkeep-alive接続を含む）。
+            keepalive_timeout (float): 次のリクエストを待つkeep-alive接続を維持する最大時間（秒）。
+            write_timeout (float): リクエストの処理中に送受信が止まった場合に切断するまでの時間（秒）。
+        """
+        self.request_queue_size = max_connections
+        super().__init__(server_address, single_request_handler(handler_class))
+        self.workers = workers
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.write_timeout = write_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hls-http")
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.rejected_connections = 0
+
+        # 次のリクエストを待つ接続 (ソケット -> (クライアントのアドレス, 期限))
+        self.idle_connections = {}
+        self.parking = queue.SimpleQueue()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        self.closed = False
+        self.idle_thread = threading.Thread(target=self._idle_loop, name="hls-http-idle", daemon=True)
+        self.idle_thread.start()
+
+    def process_request(self, request, client_address):
+        if not self.connection_slots.acquire(blocking=False):
+            # 接続数の上限を超えた場合は待たせずに拒否する
+            self.rejected_connections += 1
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+
+        # 最初のリクエストが届くまでもワーカーを使わずに待機する
+        self._park(request, client_address)
+
+    def _park(self, request, client_address):
+        self.parking.put((request, client_address))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self.wakeup_writer.send(b"\0")
+        except OSError:
+            pass
+
+    def _idle_loop(self):
+        """
+        待機中の接続を監視し、リクエストが届いたらワーカーに渡す。期限を過ぎた接続は閉じる。
+        """
+        while not self.closed:
+            now = time.monotonic()
+            while True:
+                try:
+                    request, client_address = self.parking.get_nowait()
+                except queue.Empty:
+                    break
+                self.selector.register(request, selectors.EVENT_READ)
+                self.idle_connections[request] = (client_address, now + self.keepalive_timeout)
+
+            for request, (_, deadline) in list(self.idle_connections.items()):
+                if deadline <= now:
+                    self.selector.unregister(request)
+                    del self.idle_connections[request]
+                    self._close_connection(request)
+
+            timeout = min((deadline for _, deadline in self.idle_connections.values()), default=now + 1.0) - now
+            for key, _ in self.selector.select(max(0.0, timeout)):
+                if key.fileobj is self.wakeup_reader:
+                    try:
+                        while self.wakeup_reader.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                request = key.fileobj
+                self.selector.unregister(request)
+                client_address, _ = self.idle_connections.pop(request)
+                self.executor.submit(self._process_request_worker, request, client_address)
+
+        for request in list(self.idle_connections):
+            self._close_connection(request)
+        self.idle_connections.clear()
+        self.selector.close()
+
+    def _process_request_worker(self, request, client_address):
+        keep_alive = False
+        try:
+            request.settimeout(self.write_timeout)
+            handler = self.RequestHandlerClass(request, client_address, self)
+            keep_alive = not handler.close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+
+        if keep_alive and not self.closed:
+            self._park(request, client_address)
+        else:
+            self._close_connection(request)
+
+    def _close_connection(self, request):
+        self.shutdown_request(request)
+        self.connection_slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.closed = True
+        self._wakeup()
+        self.idle_thread.join(timeout=1.0)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
@@ -1,14 +1,40 @@
 import os
 import json
+import time
+import atexit
+import queue
+import threading
 from datetime import datetime
 
+# メトリクスストアのスキーマ
+EVENT_SCHEMA = [
+    ("time", "f8"),
+    ("type", "category"),
+    ("segment", "category"),
+    ("resolution", "i4")
+]
+GAZE_SCHEMA = [
+    ("time", "f8"),
+    ("gaze_x", "f4"),
+    ("gaze_y", "f4")
+]
+
+
 class VideoLogger:
-    def __init__(self, log_dir):
+    def __init__(self, log_dir, metrics=True, max_pending=65536, flush_bytes=64 * 1024, flush_interval=1.0):
         """
         Initialize the VideoLogger.
 
+        Events are queued in memory and written by a background thread, so callers
+        (e.g. HTTP request threads) never touch the file themselves.
+
         Args:
             log_dir (str): Base directory to save log files.
+            metrics (bool): Also record events in columnar metrics stores
+                (<start_time>_events / <start_time>_gaze, readable with load_metrics).
+            max_pending (int): Maximum number of queued records. Records beyond this are dropped.
+            flush_bytes (int): Write to the file once this many bytes are buffered.
+            flush_interval (float): Write to the file at least this often (seconds).
         """
         self.log_dir = os.path.abspath(log_dir)  # 絶対パスを取得
         self.today = datetime.now().strftime("%Y-%m-%d")  # 現在の日付を取得
@@ -25,6 +51,11 @@ class VideoLogger:
         # ログファイルパス
         self.log_file_path = os.path.join(self.daily_log_dir, f"{self.start_time}.txt")
 
+        # メトリクスストアは最初の記録時に作成する
+        self.metrics = metrics
+        self.event_store = None
+        self.gaze_store = None
+
         # ログファイルの初期化
         try:
             with open(self.log_file_path, "w") as log_file:
@@ -33,6 +64,16 @@ class VideoLogger:
             print(f"Error initializing log file: {e}")
             raise
 
+        # 書き込みはバックグラウンドスレッドでまとめて行う
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_loop, name="video-logger", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
     def log_event(self, event):
         """
         Log an event to the log file.
@@ -40,16 +81,18 @@ class VideoLogger:
         Args:
             event (dict): Event data to log.
         """
-        event_data = {
-            "time": datetime.now().isoformat(),
-            **event
-        }
-        try:
-            with open(self.log_file_path, "a") as log_file:
-                log_file.write(json.dumps(event_data) + "\n")
-        except Exception as e:
-            print(f"Error writing to log file: {e}")
-            raise
+        self._enqueue(("event", time.time(), event))
+
+    def log_events(self, events):
+        """
+        Log a batch of events to the log file.
+
+        Args:
+            events (list): List of event dicts.
+        """
+        now = time.time()
+        for event in events:
+            self._enqueue(("event", now, event))
 
     def log_gaze_position(self, gaze_x, gaze_y):
         """
@@ -59,10 +102,128 @@ class VideoLogger:
             gaze_x (int): X-coordinate of the gaze.
             gaze_y (int): Y-coordinate of the gaze.
         """
-        log_entry = f"{datetime.now().strftime('%H:%M:%S')} - Gaze Position: ({gaze_x}, {gaze_y})\n"
+        self._enqueue(("gaze", time.time(), (gaze_x, gaze_y)))
+
+    def _enqueue(self, record):
+        if self.closed:
+            return
+        try:
+            self.pending.put_nowait(record)
+        except queue.Full:
+            # 書き込みが追いつかない場合は呼び出し側を待たせずに捨てる
+            self.dropped += 1
+
+    def _write_loop(self):
+        lines = []
+        buffered = 0
+        events = []
+        gazes = []
+        last_flush = time.monotonic()
+
+        with open(self.log_file_path, "a") as log_file:
+            while True:
+                timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+                try:
+                    record = self.pending.get(timeout=timeout)
+                except queue.Empty:
+                    record = None
+
+                if record is not None:
+                    kind, timestamp, data = record
+                    if kind == "stop":
+                        self._write_batch(log_file, lines, events, gazes, durable=True)
+                        data.set()
+                        if self.closed:
+                            break
+                        lines, buffered, events, gazes = [], 0, [], []
+                        last_flush = time.monotonic()
+                        continue
+                    try:
+                        line = self._format(kind, timestamp, data, events, gazes)
+                    except Exception as e:
+                        # 不正な記録は捨てて書き込みを続ける（スレッドが止まると以降の記録がすべて失われる）
+                        print(f"Error formatting log record: {e}")
+                        continue
+                    lines.append(line)
+                    buffered += len(line)
+
+                if buffered >= self.flush_bytes or time.monotonic() - last_flush >= self.flush_interval:
+                    self._write_batch(log_file, lines, events, gazes)
+                    lines, buffered, events, gazes = [], 0, [], []
+                    last_flush = time.monotonic()
+
+    def _format(self, kind, timestamp, data, events, gazes):
+        if kind == "gaze":
+            gaze_x, gaze_y = data
+            gazes.append({"time": timestamp, "gaze_x": gaze_x, "gaze_y": gaze_y})
+            return f"{datetime.fromtimestamp(timestamp).strftime('%H:%M:%S')} - Gaze Position: ({gaze_x}, {gaze_y})\n"
+
+        line = json.dumps({"time": datetime.fromtimestamp(timestamp).isoformat(), **data}) + "\n"
+        resolution = data.get("resolution")
+        events.append({
+            "time": timestamp,
+            "type": data.get("type"),
+            "segment": data.get("segment"),
+            "resolution": resolution if isinstance(resolution, int) else -1
+        })
+        return line
+
+    def _write_batch(self, log_file, lines, events, gazes, durable=False):
         try:
-            with open(self.log_file_path, "a") as log_file:
-                log_file.write(log_entry)
+            if lines:
+                log_file.write("".join(lines))
+            log_file.flush()
+            if durable:
+                os.fsync(log_file.fileno())
         except Exception as e:
-            print(f"Error logging gaze position: {e}")
-            raise
\ No newline at end of file
+            print(f"Error writing to log file: {e}")
+
+        if not self.metrics:
+            return
+        try:
+            # numpyを使うため、最初に記録するときにimportする
+            from src.metrics_store import MetricsStore
+            if events:
+                if self.event_store is None:
+                    self.event_store = MetricsStore(os.path.join(self.daily_log_dir, f"{self.start_time}_events"),
+                                                    EVENT_SCHEMA)
+                self.event_store.extend(events)
+            if gazes:
+                if self.gaze_store is None:
+                    self.gaze_store = MetricsStore(os.path.join(self.daily_log_dir, f"{self.start_time}_gaze"),
+                                                   GAZE_SCHEMA, batch_size=1024)
+                self.gaze_store.extend(gazes)
+            if durable:
+                for store in (self.event_store, self.gaze_store):
+                    if store is not None:
+                        store.flush(durable=True)
+        except Exception as e:
+            print(f"Error writing to metrics store: {e}")
+
+    def flush(self, timeout=None):
+        """
+        Write all queued records and fsync the log file.
+
+        Returns:
+            bool: True if the flush completed within the timeout.
+        """
+        if not self.writer.is_alive():
+            return False
+        done = threading.Event()
+        self.pending.put(("stop", None, done))
+        return done.wait(timeout)
+
+    def close(self):
+        """
+        Flush all queued records durably and stop the background writer.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.writer.join()
+        for store in (self.event_store, self.gaze_store):
+            if store is not None:
+                store.close()
+        if self.dropped:
+            print(f"VideoLogger dropped {self.dropped} records because the write queue was full.")
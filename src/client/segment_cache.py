@@ -0,0 +1,196 @@
+"""
+HLSサーバーのメモリ上のLRUキャッシュ。
+
+.tsなどのセグメントも、HLSの削除後の再生成やLL-HLSのセッションの開始で同じ名前のまま書き直されるため、
+取得のたびにstatで更新時刻とサイズを確認し、変わっていればディスクから読み直す（本文は読まない）。
+プレイリスト(.m3u8)は次のいずれかの方法で無効化する。
+・"mtime": 取得のたびにstatで更新時刻とサイズを確認する。
+・"notify": パッケージャからの書き込み通知(POST /_cache/invalidate)を受けるまでキャッシュを使い続ける。
+fMP4の単一ファイル(.cmfv)は追記され続けるためファイル全体はキャッシュせず、公開済みのバイト範囲単位でキャッシュする。
+範囲は同じファイル（inode）が縮まずに追記されている間だけ有効とし、作り直された場合は読み直す。
+"""
+
+import json
+import os
+import queue
+import threading
+import urllib.request
+from collections import OrderedDict
+
+PLAYLIST_EXTENSIONS = (".m3u8",)
+SEGMENT_EXTENSIONS = (".ts", ".m4s", ".mp4", ".aac")
+
+
+class SegmentCache:
+    def __init__(self, max_bytes=256 * 1024 ** 2, max_object_bytes=16 * 1024 ** 2, playlist_validation="mtime"):
+        """
+        Args:
+            max_bytes (int): キャッシュに保持する本文の合計サイズの上限（バイト）。
+            max_object_bytes (int): 1ファイルあたりのサイズの上限。これより大きいファイルはキャッシュしない。
+            playlist_validation (str): プレイリストの無効化方法 ("mtime" または "notify")。
+        """
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.playlist_validation = playlist_validation
+        self.entries = OrderedDict()  # path -> (body, mtime_ns, size) / (path, start, end) -> (body, inode, size)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_cacheable(path):
+        return path.endswith(PLAYLIST_EXTENSIONS + SEGMENT_EXTENSIONS)
+
+    def get(self, path):
+        """
+        ファイルの内容をキャッシュから返す。キャッシュにない場合はディスクから読み込んで登録する。
+
+        Args:
+            path (str): ファイルの絶対パス。
+
+        Returns:
+            bytes: ファイルの内容。ファイルが存在しない、または大きすぎる場合はNone。
+        """
+        is_playlist = path.endswith(PLAYLIST_EXTENSIONS)
+        stat = None
+        if not is_playlist or self.playlist_validation == "mtime":
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.invalidate(path)
+                return None
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and (stat is None or (entry[1], entry[2]) == (stat.st_mtime_ns, stat.st_size)):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size > self.max_object_bytes:
+                    return None
+                body = f.read()
+        except OSError:
+            return None
+
+        self._put(path, body, stat.st_mtime_ns, stat.st_size)
+        return body
+
+    def get_range(self, path, start, end):
+        """
+        追記のみのファイルのバイト範囲をキャッシュから返す。
+        公開された範囲は追記では変わらないが、HLSを削除して作り直すと同じ名前のファイルが先頭から書き直される。
+        そのため、キャッシュしたときと同じinodeで、サイズが縮んでいない場合のみキャッシュを使う。
+
+        Args:
+            path (str): ファイルの絶対パス。
+            start (int): 範囲の先頭（バイト）。
+            end (int): 範囲の末尾（バイト、この位置を含む）。
+
+        Returns:
+            bytes: 範囲の内容。ファイルがない、範囲がファイルの外にある、または大きすぎる場合はNone。
+        """
+        key = (path, start, end)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._drop(key)
+            return None
+        inode = (stat.st_dev, stat.st_ino)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == inode and stat.st_size >= entry[2]:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        length = end - start + 1
+        if length <= 0 or length > self.max_object_bytes:
+            return None
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size <= end:
+                    return None
+                f.seek(start)
+                body = f.read(length)
+        except OSError:
+            return None
+
+        self._put(key, body, (stat.st_dev, stat.st_ino), stat.st_size)
+        return body
+
+    def _put(self, key, body, version, size):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old[0])
+            self.entries[key] = (body, version, size)
+            self.total_bytes += len(body)
+            # 古いものから削除して上限内に収める
+            while self.total_bytes > self.max_bytes and self.entries:
+                _, (evicted, _, _) = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+    def invalidate(self, path):
+        self._drop(os.path.abspath(path))
+
+    def _drop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= len(entry[0])
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class CacheInvalidationNotifier:
+    """
+    パッケージャ側でプレイリストの書き込みをHLSサーバーに通知する。
+    パッケージャを待たせないよう、通知はバックグラウンドスレッドで送信する。
+    """
+
+    def __init__(self, url="http://localhost:8080/_cache/invalidate"):
+        self.url = url
+        self.pending = queue.Queue(maxsize=1024)
+        self.thread = threading.Thread(target=self._send_loop, daemon=True)
+        self.thread.start()
+
+    def __call__(self, path):
+        try:
+            self.pending.put_nowait(os.path.abspath(path))
+        except queue.Full:
+            pass
+
+    def _send_loop(self):
+        while True:
+            paths = [self.pending.get()]
+            # 溜まっている通知はまとめて送る
+            while not self.pending.empty() and len(paths) < 64:
+                paths.append(self.pending.get_nowait())
+            request = urllib.request.Request(
+                self.url, data=json.dumps({"paths": paths}).encode(),
+                headers={"Content-Type": "application/json"}, method="POST"
+            )
+            try:
+                urllib.request.urlopen(request, timeout=1).close()
+            except OSError:
+                # サーバーが起動していない場合は通知を捨てる
+                pass
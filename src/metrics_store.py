@@ -0,0 +1,280 @@
+"""
+固定スキーマの列指向・追記専用のメトリクスストア。
+
+1つのストアは1つのディレクトリで、スキーマ(schema.json)と列ごとのバイナリファイル(<列名>.bin)からなる。
+レコードはメモリ上にまとめてから列ごとに追記し、読み込み時はnp.memmapで各列をそのまま配列として開く。
+テキストログのように1行ずつ解析する必要がないため、長時間の実験でも読み込みはファイルサイズにほぼ依存しない。
+
+列の型はNumPyのdtype文字列（"f8", "f4", "i4" など）か "category"。
+"category" は文字列を整数コード(int32)として保存し、コードと文字列の対応を <列名>.labels.json に保存する。
+"""
+
+import csv
+import json
+import os
+import threading
+import time
+import numpy as np
+
+SCHEMA_FILE = "schema.json"
+CATEGORY = "category"
+CATEGORY_DTYPE = "<i4"
+MISSING_CODE = -1
+
+
+def column_dtype(dtype):
+    """スキーマの型をディスク上のdtype（リトルエンディアン固定）に変換する。"""
+    if dtype == CATEGORY:
+        return np.dtype(CATEGORY_DTYPE)
+    return np.dtype(dtype).newbyteorder("<")
+
+
+class MetricsStore:
+    def __init__(self, directory, schema, batch_size=256, flush_interval=5.0):
+        """
+        Args:
+            directory (str): ストアのディレクトリ。既存のストアがあれば追記する。
+            schema (list): 列の定義 [(列名, 型), ...]。
+            batch_size (int): この件数が溜まったらディスクに書き出す。
+            flush_interval (float): 最後の書き出しからこの秒数が経過したら、件数に関係なく書き出す。
+
+        Raises:
+            ValueError: 既存のストアとスキーマが一致しない場合。
+        """
+        self.directory = directory
+        self.schema = [(name, dtype) for name, dtype in schema]
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+
+        schema_path = os.path.join(directory, SCHEMA_FILE)
+        document = {"version": 1, "columns": [{"name": name, "dtype": dtype} for name, dtype in self.schema]}
+        if os.path.exists(schema_path):
+            with open(schema_path, "r") as f:
+                existing = json.load(f)
+            if existing["columns"] != document["columns"]:
+                raise ValueError(f"Schema mismatch for metrics store: {directory}")
+        else:
+            with open(schema_path, "w") as f:
+                json.dump(document, f, indent=4)
+
+        self.labels = {}
+        for name, dtype in self.schema:
+            if dtype == CATEGORY:
+                self.labels[name] = _read_labels(directory, name)
+        self.codes = {name: {label: code for code, label in enumerate(labels)} for name, labels in self.labels.items()}
+
+        # 途中で書き込みが中断された列があれば、最も短い列に揃えてから追記する
+        self.rows = _row_count(directory, self.schema)
+        self.files = {}
+        for name, dtype in self.schema:
+            path = os.path.join(directory, f"{name}.bin")
+            with open(path, "ab") as f:
+                f.truncate(self.rows * column_dtype(dtype).itemsize)
+            self.files[name] = open(path, "ab")
+
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def append(self, record):
+        """
+        レコードを1件追加する。
+
+        Args:
+            record (dict): 列名をキーとする値。欠けている列は欠損値（数値はNaN/0、categoryは-1）になる。
+        """
+        with self.lock:
+            self.pending.append(record)
+            if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush_locked()
+
+    def extend(self, records):
+        with self.lock:
+            self.pending.extend(records)
+            if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush_locked()
+
+    def flush(self, durable=False):
+        """
+        溜まっているレコードを書き出す。
+
+        Args:
+            durable (bool): Trueの場合はfsyncしてディスクへの書き込みを保証する。
+        """
+        with self.lock:
+            self._flush_locked(durable)
+
+    def _flush_locked(self, durable=False):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        records, self.pending = self.pending, []
+
+        columns = {}
+        labels_changed = False
+        for name, dtype in self.schema:
+            if dtype == CATEGORY:
+                codes = self.codes[name]
+                values = []
+                for record in records:
+                    label = record.get(name)
+                    if label is None:
+                        values.append(MISSING_CODE)
+                        continue
+                    label = str(label)
+                    if label not in codes:
+                        codes[label] = len(self.labels[name])
+                        self.labels[name].append(label)
+                        labels_changed = True
+                    values.append(codes[label])
+                column = np.asarray(values, dtype=column_dtype(dtype))
+            else:
+                missing = np.nan if np.dtype(dtype).kind == "f" else 0
+                column = np.asarray([missing if record.get(name) is None else record[name] for record in records],
+                                    dtype=column_dtype(dtype))
+            columns[name] = column
+
+        # ラベルは列データより先に確定させる（読み込み側で未知のコードが出ないように）
+        if labels_changed:
+            for name, labels in self.labels.items():
+                _write_labels(self.directory, name, labels)
+
+        for name, column in columns.items():
+            self.files[name].write(column.tobytes())
+        for f in self.files.values():
+            f.flush()
+            if durable:
+                os.fsync(f.fileno())
+        self.rows += len(records)
+
+    def close(self):
+        with self.lock:
+            if not self.files:
+                return
+            self._flush_locked(durable=True)
+            for f in self.files.values():
+                f.close()
+            self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _labels_path(directory, name):
+    return os.path.join(directory, f"{name}.labels.json")
+
+
+def _read_labels(directory, name):
+    try:
+        with open(_labels_path(directory, name), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def _write_labels(directory, name, labels):
+    path = _labels_path(directory, name)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(labels, f)
+    os.replace(temp_path, path)
+
+
+def _row_count(directory, schema):
+    counts = []
+    for name, dtype in schema:
+        path = os.path.join(directory, f"{name}.bin")
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        counts.append(size // column_dtype(dtype).itemsize)
+    return min(counts) if counts else 0
+
+
+def read_schema(directory):
+    with open(os.path.join(directory, SCHEMA_FILE), "r") as f:
+        return [(column["name"], column["dtype"]) for column in json.load(f)["columns"]]
+
+
+class MetricsTable:
+    """
+    load_metricsの戻り値。列名で各列のnp.memmap（読み取り専用）を取得できる。
+    category列はコードの配列で、対応する文字列はlabels[列名]、またはdecode(列名)で取得する。
+    """
+
+    def __init__(self, directory, schema, columns, labels):
+        self.directory = directory
+        self.schema = schema
+        self.columns = columns
+        self.labels = labels
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def names(self):
+        return [name for name, _ in self.schema]
+
+    def decode(self, name):
+        """category列を文字列の配列に変換する（欠損はNone）。"""
+        labels = np.asarray(self.labels[name] + [None], dtype=object)
+        codes = np.asarray(self.columns[name])
+        return labels[np.where(codes < 0, len(labels) - 1, codes)]
+
+    def to_records(self):
+        """構造化配列 (np.recarray) としてコピーを返す。category列はコードのまま。"""
+        dtype = [(name, column_dtype(kind)) for name, kind in self.schema]
+        records = np.empty(len(self), dtype=dtype)
+        for name, _ in self.schema:
+            records[name] = self.columns[name]
+        return records.view(np.recarray)
+
+
+def load_metrics(directory):
+    """
+    ストアを読み込む。各列はnp.memmapで開くため、データはアクセスしたときに必要な分だけ読み込まれる。
+
+    Args:
+        directory (str): ストアのディレクトリ。
+
+    Returns:
+        MetricsTable: 読み込んだテーブル。
+    """
+    schema = read_schema(directory)
+    rows = _row_count(directory, schema)
+    columns = {}
+    labels = {}
+    for name, dtype in schema:
+        if rows == 0:
+            columns[name] = np.empty(0, dtype=column_dtype(dtype))
+        else:
+            columns[name] = np.memmap(os.path.join(directory, f"{name}.bin"), dtype=column_dtype(dtype),
+                                      mode="r", shape=(rows,))
+        if dtype == CATEGORY:
+            labels[name] = _read_labels(directory, name)
+    return MetricsTable(directory, schema, columns, labels)
+
+
+def export_csv(directory, csv_path):
+    """
+    ストアをCSVに書き出す（category列は文字列に戻す）。
+
+    Args:
+        directory (str): ストアのディレクトリ。
+        csv_path (str): 出力するCSVファイルのパス。
+
+    Returns:
+        int: 書き出したレコード数。
+    """
+    table = load_metrics(directory)
+    columns = [table.decode(name) if dtype == CATEGORY else table[name] for name, dtype in table.schema]
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(table.names())
+        for row in zip(*columns):
+            writer.writerow(["" if value is None else value for value in row])
+    return len(table)
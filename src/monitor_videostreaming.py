@@ -1,10 +1,50 @@
 import os
+import sys
 import time
+import signal
 import datetime
-import psutil
-import matplotlib.pyplot as plt
-from queue import Queue
-import requests
+from queue import Queue, Empty
+from src.metrics_store import MetricsStore
+from src.network_probe import AsyncProbeEngine
+from src.throughput_sampler import ThroughputSampler
+from src.utils import load_config
+
+# プロットする図と、各図に描く系列（キューに送る辞書のキー）
+PLOTS = {
+    "Bandwidth (kB/s)": ["send_avg", "send_peak", "recv_avg", "recv_peak"],
+    "Jitter (ms)": ["jitter_ms"],
+    "Latency (ms)": ["rtt_p50", "rtt_p95", "rtt_p99"],
+    "Packet Loss (%)": ["probe_loss"]
+}
+
+# メトリクスストアのスキーマ（1秒ごとの集計1件が1レコード）
+NETWORK_SCHEMA = [
+    ("time", "f8"),
+    ("elapsed", "f8"),
+    ("send_avg", "f4"),
+    ("send_peak", "f4"),
+    ("recv_avg", "f4"),
+    ("recv_peak", "f4"),
+    ("rtt_p50", "f4"),
+    ("rtt_p95", "f4"),
+    ("rtt_p99", "f4"),
+    ("rtt_min", "f4"),
+    ("rtt_max", "f4"),
+    ("jitter_ms", "f4"),
+    ("probe_loss", "f4"),
+    ("probes", "i4")
+]
+
+
+def _pyplot():
+    """
+    matplotlibはプロットを描くときに初めてimportする（起動時間を短くするため）。
+    子プロセスでもGUIを使わないよう、バックエンドはAggに固定する。
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
 
 
 class NetworkMonitor:
@@ -15,49 +55,31 @@ class NetworkMonitor:
         self.timestamp = None  # ログとプロットの統一タイムスタンプ
         self.current_log_dir = None
         self.start_time = time.time()
-        self.prev_sent = psutil.net_io_counters().bytes_sent
-        self.prev_recv = psutil.net_io_counters().bytes_recv
-        self.prev_time = time.time()
+        self.running = True
+
+        # プロットの設定
+        monitor_config = load_config().get("network_monitor", {})
+        self.plot_mode = monitor_config.get("plot_mode", "interval")  # "interval" または "shutdown"
+        self.plot_interval = monitor_config.get("plot_interval", 10.0)
+        self.plot_capacity = monitor_config.get("plot_capacity", 2048)
+
+        # 帯域幅の計測 (指定インターフェースのみ、sample_rate Hzでサンプリングしてreport_interval秒ごとに集計)
+        self.report_interval = monitor_config.get("report_interval", 1.0)
+        self.store_flush_interval = monitor_config.get("store_flush_interval", 10.0)
+        self.sampler = ThroughputSampler(interface, monitor_config.get("sample_rate", 20.0))
+
+        # 遅延の計測 (keep-alive接続を使い回すプローブ)
+        self.probe = AsyncProbeEngine(
+            url,
+            rate=monitor_config.get("probe_rate", 20),
+            connections=monitor_config.get("probe_connections", 2),
+            window=monitor_config.get("probe_window", 5.0),
+            timeout=monitor_config.get("probe_timeout", 1.0)
+        )
 
     def get_total_bandwidth(self):
-        """総帯域幅を計測"""
-        current_counters = psutil.net_io_counters()
-        current_sent = current_counters.bytes_sent
-        current_recv = current_counters.bytes_recv
-        current_time = time.time()
-
-        # 送信および受信データ量の変化
-        sent_diff = current_sent - self.prev_sent
-        recv_diff = current_recv - self.prev_recv
-        time_diff = current_time - self.prev_time
-
-        # 帯域幅 (バイト/秒) の計算
-        if time_diff > 0:
-            bandwidth = (sent_diff + recv_diff) / time_diff
-        else:
-            bandwidth = 0
-
-        # 前回の状態を更新
-        self.prev_sent = current_sent
-        self.prev_recv = current_recv
-        self.prev_time = current_time
-
-        return bandwidth
-
-    def get_latency(self):
-        """レイテンシを計測"""
-        try:
-            start_time = time.time()
-            response = requests.get(self.url, timeout=2)
-            end_time = time.time()
-            latency = (end_time - start_time) * 1000  # ミリ秒に変換
-            return latency
-        except requests.exceptions.RequestException:
-            return float('inf')  # タイムアウトなどのエラーの場合
-
-    def get_packet_loss(self):
-        """仮想的にパケットロスをシミュレート (実際のロジックは環境に依存)"""
-        return 0.0  # 必要に応じてリアルな測定ロジックに置き換え
+        """前回の呼び出しからの送信・受信の平均とピーク (kB/s) を取得"""
+        return self.sampler.collect()
 
     def log_network(self):
         """ネットワークの使用状況をログに記録"""
@@ -66,69 +88,107 @@ class NetworkMonitor:
             self.current_log_dir = os.path.join("logs/network_plot", self.timestamp)
             os.makedirs(self.current_log_dir, exist_ok=True)
 
-        log_file = os.path.join(self.current_log_dir, "network_monitoring.txt")
-        while True:
+        # load_metrics(<log_dir>/metrics) で読み込む
+        store = MetricsStore(os.path.join(self.current_log_dir, "metrics"), NETWORK_SCHEMA,
+                             batch_size=60, flush_interval=self.store_flush_interval)
+        while self.running:
             try:
-                used_bandwidth = self.get_total_bandwidth()
-                jitter = abs(time.time() - self.prev_time)
-                latency = self.get_latency()
-                packet_loss = self.get_packet_loss()
-
-                log_entry = (
-                    f"{datetime.datetime.now()}: "
-                    f"Bandwidth: {used_bandwidth / 1024:.2f} KB/s, "
-                    f"Jitter: {jitter:.2f}s, "
-                    f"Latency: {latency:.2f}ms, "
-                    f"Packet Loss: {packet_loss:.2f}%\n"
-                )
-                with open(log_file, "a") as f:
-                    f.write(log_entry)
+                time.sleep(self.report_interval)
+                throughput = self.get_total_bandwidth()
+                probe = self.probe.snapshot()
 
                 # データをqueueに送信
-                self.queue.put((time.time() - self.start_time, used_bandwidth / 1024, jitter, latency, packet_loss))
-                time.sleep(1)
+                sample = {
+                    "time": time.time(),
+                    "elapsed": time.time() - self.start_time,
+                    "bandwidth": throughput["send_avg"] + throughput["recv_avg"]
+                }
+                sample.update(throughput)
+                sample.update(probe)
+                store.append(sample)
+                self.queue.put(sample)
             except Exception as e:
                 print(f"Error in log_network: {e}")
                 time.sleep(1)
+        store.close()
 
     def plot_network(self):
-        """ネットワーク使用状況をプロット"""
-        elapsed_times = []
-        metrics = {
-            "Bandwidth (kB/s)": [],
-            "Jitter (s)": [],
-            "Latency (ms)": [],
-            "Packet Loss (%)": []
-        }
+        """ネットワーク使用状況をプロット
+
+        図は最初に一度だけ作成し、以降は線のデータを差し替えて保存する。
+        履歴はDownsamplingBufferで一定サイズに保つため、1回の描画コストは経過時間に依存しない。
+        plot_mode が "interval" の場合は plot_interval 秒ごと、"shutdown" の場合は終了時に1回だけ描画する。
+        """
+        elapsed_times = DownsamplingBuffer(self.plot_capacity)
+        series = {key: DownsamplingBuffer(self.plot_capacity) for keys in PLOTS.values() for key in keys}
+        figures = {}
+        last_render = time.time()
+        dirty = False
 
         while True:
             try:
-                data = self.queue.get()
+                # 未描画のデータがない間は次のデータまで待機する（timeout=0で空回りしない）
+                timeout = None
+                if self.plot_mode == "interval" and dirty:
+                    timeout = max(0.0, self.plot_interval - (time.time() - last_render))
+                try:
+                    data = self.queue.get(timeout=timeout)
+                except Empty:
+                    data = False  # 描画のタイミング
+
                 if data is None:
                     break
 
-                elapsed_time, used_bandwidth, jitter, latency, packet_loss = data
-
-                elapsed_times.append(elapsed_time)
-                metrics["Bandwidth (kB/s)"].append(used_bandwidth)
-                metrics["Jitter (s)"].append(jitter)
-                metrics["Latency (ms)"].append(latency)
-                metrics["Packet Loss (%)"].append(packet_loss)
-
-                # 各メトリックのプロットを保存
-                for metric, values in metrics.items():
-                    plt.figure()
-                    plt.plot(elapsed_times, values, label=metric)
-                    plt.xlabel("Time (s)")
-                    plt.ylabel(metric)
-                    plt.title(f"{metric} Over Time")
-                    plt.legend()
-                    plt.savefig(os.path.join(self.current_log_dir, f"{metric.split(' ')[0].lower()}.png"))
-                    plt.close()
+                if data:
+                    elapsed_times.append(data["elapsed"])
+                    for key, values in series.items():
+                        value = data.get(key)
+                        values.append(float("nan") if value is None else value)
+                    dirty = True
+
+                if self.plot_mode == "interval" and dirty and time.time() - last_render >= self.plot_interval:
+                    self.render_plots(figures, elapsed_times, series)
+                    last_render = time.time()
+                    dirty = False
 
             except Exception as e:
                 print(f"Error in plot_network: {e}")
 
+        # 終了時に最新の状態を保存
+        if dirty:
+            self.render_plots(figures, elapsed_times, series)
+        for figure, _, _ in figures.values():
+            _pyplot().close(figure)
+
+    def render_plots(self, figures, elapsed_times, series):
+        """各メトリックのプロットを保存 (図は使い回し、線のデータのみ更新)"""
+        times = elapsed_times.values()
+        for metric, keys in PLOTS.items():
+            if metric not in figures:
+                figure, axis = _pyplot().subplots()
+                lines = {}
+                for key in keys:
+                    lines[key], = axis.plot([], [], label=metric if len(keys) == 1 else key)
+                axis.set_xlabel("Time (s)")
+                axis.set_ylabel(metric)
+                axis.set_title(f"{metric} Over Time")
+                axis.legend()
+                figures[metric] = (figure, axis, lines)
+
+            figure, axis, lines = figures[metric]
+            for key, line in lines.items():
+                line.set_data(times, series[key].values())
+            axis.relim()
+            axis.autoscale_view()
+            figure.savefig(os.path.join(self.current_log_dir, f"{metric.split(' ')[0].lower()}.png"))
+
+    def stop(self):
+        """ログを止め、プロットスレッドに終了を通知する"""
+        self.running = False
+        self.probe.stop()
+        self.sampler.stop()
+        self.queue.put(None)
+
     def start(self):
         """ログとプロットを並行実行"""
         from threading import Thread
@@ -136,13 +196,49 @@ class NetworkMonitor:
         log_thread = Thread(target=self.log_network)
         plot_thread = Thread(target=self.plot_network)
 
+        self.sampler.start()
+        self.probe.start()
         log_thread.start()
         plot_thread.start()
 
-        log_thread.join()
-        plot_thread.join()
+        try:
+            log_thread.join()
+        finally:
+            # 終了時に最後のプロットを保存する
+            self.stop()
+            log_thread.join()
+            plot_thread.join()
+
+
+class DownsamplingBuffer:
+    """
+    上限サイズのバッファ。満杯になると古い半分を隣接2点の平均で間引き、
+    直近のデータは元の解像度のまま、古いデータほど粗く保持する。
+    """
+
+    def __init__(self, capacity=2048):
+        self.capacity = max(4, capacity)
+        self.data = []
+
+    def append(self, value):
+        if len(self.data) >= self.capacity:
+            half = len(self.data) // 2
+            older = self.data[:half]
+            merged = [(older[i] + older[i + 1]) / 2 for i in range(0, len(older) - 1, 2)]
+            if len(older) % 2:
+                merged.append(older[-1])
+            self.data = merged + self.data[half:]
+        self.data.append(value)
+
+    def values(self):
+        return self.data
+
+    def __len__(self):
+        return len(self.data)
 
 
 def start_monitor_network(url, interface, queue):
+    # terminate()で終了されたときも、メトリクスとプロットを保存してから終了する
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     monitor = NetworkMonitor(url, interface, queue)
     monitor.start()
@@ -58,29 +58,53 @@ clear_settings メソッド:
 参考文献:ImpactofPacketLossesontheQualityofVideoStreamTransmission
 """
 
+import platform
 import subprocess
+from src.shaping_proxy import create_shaping_proxy
+from src.utils import load_config
 
 class NetworkController:
     def __init__(self, interface):
         self.interface = interface
+        self.proxy = None
 
     def apply_settings(self, rate=None, delay=None, loss=None):
-        try:
-            # 現在の設定をクリア
-            self.clear_settings()
+        # 現在の設定をクリア
+        self.clear_settings()
+
+        if platform.system() == "Windows":
+            try:
+                # コマンドを構築
+                command = f"netsh interface ipv4 set subinterface \"{self.interface}\" mtu=1500 store=persistent"
+                subprocess.run(command, shell=True, check=True)
+                print(f"Command executed successfully: {command}")
 
-            # コマンドを構築
-            command = f"netsh interface ipv4 set subinterface \"{self.interface}\" mtu=1500 store=persistent"
-            subprocess.run(command, shell=True, check=True)
-            print(f"Command executed successfully: {command}")
+            except subprocess.CalledProcessError as e:
+                if "elevation" in str(e.stderr).lower():
+                    print("Error: The operation requires elevated permissions. Please run the script as an administrator.")
+                else:
+                    print(f"Error applying settings: {e.stderr if e.stderr else e}")
 
-        except subprocess.CalledProcessError as e:
-            if "elevation" in str(e.stderr).lower():
-                print("Error: The operation requires elevated permissions. Please run the script as an administrator.")
-            else:
-                print(f"Error applying settings: {e.stderr if e.stderr else e}")
+        # 帯域幅・遅延・損失はプレイヤーとHLSサーバーの間のプロキシで再現する（OSや権限に依存しない）
+        config = load_config()
+        if config.get("network_shaping", {}).get("enabled", False):
+            try:
+                self.proxy = create_shaping_proxy(config, rate=rate, delay=delay, loss=loss)
+                self.proxy.start()
+            except (OSError, ValueError) as e:
+                self.proxy = None
+                print(f"Error starting shaping proxy: {e}")
+        else:
+            print("Network shaping is disabled (network_shaping.enabled in config.json).")
 
     def clear_settings(self):
+        if self.proxy is not None:
+            self.proxy.stop()
+            self.proxy = None
+            print("Stopped shaping proxy.")
+
+        if platform.system() != "Windows":
+            return
         try:
             command = f"netsh interface ipv4 set subinterface \"{self.interface}\" mtu=0 store=persistent"
             subprocess.run(command, shell=True, stderr=subprocess.DEVNULL)
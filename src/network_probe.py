@@ -0,0 +1,207 @@
+"""
+HLSサーバーへの遅延を計測する非同期プローブエンジン。
+
+keep-aliveの接続をプールして使い回し、小さなHEADリクエストを1秒間に何度も送る。
+接続の確立やプレイリストの転送時間を含まないため、応答時間はほぼ往復遅延(RTT)になる。
+ジッタはRFC 3550と同じ方法（連続するプローブのRTTの差の指数平滑）で求め、
+RTTのパーセンタイルとプローブの損失率は直近window秒のスライディングウィンドウで集計する。
+"""
+
+import asyncio
+import ssl
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, p):
+    """
+    ソート済みのリストからパーセンタイルを求める（最近傍法）。
+
+    Args:
+        sorted_values (list): 昇順にソートされた値。
+        p (float): パーセンタイル (0〜100)。
+
+    Returns:
+        float: パーセンタイル値。値がない場合はNone。
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+class ProbeStats:
+    """
+    プローブ結果の集計。プローブ側(asyncioスレッド)と読み出し側(モニタスレッド)から使うためロックで保護する。
+    """
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self.samples = deque()  # (送信時刻, RTT(ms) または失敗時None)
+        self.jitter = 0.0
+        self.last_rtt = None
+        self.sent = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def record(self, sent_at, rtt):
+        with self.lock:
+            self.sent += 1
+            if rtt is None:
+                self.failed += 1
+            else:
+                # RFC 3550: J += (|D| - J) / 16
+                if self.last_rtt is not None:
+                    self.jitter += (abs(rtt - self.last_rtt) - self.jitter) / 16
+                self.last_rtt = rtt
+            self.samples.append((sent_at, rtt))
+            self._prune(time.monotonic())
+
+    def _prune(self, now):
+        while self.samples and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+    def snapshot(self):
+        """
+        直近window秒の集計を返す。
+
+        Returns:
+            dict: rtt_ms（中央値）, rtt_p50, rtt_p95, rtt_p99, rtt_min, rtt_max, jitter_ms,
+                  probe_loss（%）, probes（ウィンドウ内のプローブ数）。
+        """
+        with self.lock:
+            self._prune(time.monotonic())
+            rtts = sorted(rtt for _, rtt in self.samples if rtt is not None)
+            probes = len(self.samples)
+            jitter = self.jitter
+
+        lost = probes - len(rtts)
+        p50 = percentile(rtts, 50)
+        return {
+            "rtt_ms": p50,
+            "rtt_p50": p50,
+            "rtt_p95": percentile(rtts, 95),
+            "rtt_p99": percentile(rtts, 99),
+            "rtt_min": rtts[0] if rtts else None,
+            "rtt_max": rtts[-1] if rtts else None,
+            "jitter_ms": jitter,
+            "probe_loss": lost / probes * 100 if probes else 0.0,
+            "probes": probes,
+        }
+
+
+class AsyncProbeEngine:
+    def __init__(self, url, rate=20, connections=2, window=5.0, timeout=1.0):
+        """
+        Args:
+            url (str): プローブ先のURL（例: http://localhost:8080/master.m3u8）。
+            rate (float): 1秒あたりのプローブ数。
+            connections (int): プールするkeep-alive接続の数（同時に送るプローブ数の上限）。
+            window (float): パーセンタイルと損失率を集計するウィンドウの長さ（秒）。
+            timeout (float): プローブのタイムアウト（秒）。超えたものは損失として数える。
+        """
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.use_ssl = parts.scheme == "https"
+        self.port = parts.port or (443 if self.use_ssl else 80)
+        self.path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        self.request = (
+            f"HEAD {self.path} HTTP/1.1\r\n"
+            f"Host: {parts.netloc or self.host}\r\n"
+            f"Connection: keep-alive\r\n\r\n"
+        ).encode()
+
+        self.rate = rate
+        self.connections = max(1, connections)
+        self.timeout = timeout
+        self.stats = ProbeStats(window)
+        self.loop = None
+        self.stop_event = None
+        self.thread = None
+
+    def start(self):
+        """バックグラウンドスレッドでイベントループを起動する。"""
+        ready = threading.Event()
+        self.thread = threading.Thread(target=asyncio.run, args=(self._run(ready),), name="network-probe", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def stop(self):
+        if self.loop is not None and self.stop_event is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+        if self.thread is not None:
+            self.thread.join(timeout=self.timeout + 1)
+
+    def snapshot(self):
+        return self.stats.snapshot()
+
+    async def _run(self, ready):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        idle = asyncio.Queue()  # 空いているkeep-alive接続
+        slots = asyncio.Semaphore(self.connections)
+        tasks = set()
+        ready.set()
+
+        interval = 1.0 / self.rate
+        next_at = time.monotonic()
+        while not self.stop_event.is_set():
+            # 全ての接続が使用中の場合、その回のプローブは送らない（遅い応答で計測自体が詰まらないように）
+            if not slots.locked():
+                await slots.acquire()
+                task = asyncio.create_task(self._probe(idle, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            next_at += interval
+            delay = next_at - time.monotonic()
+            if delay < 0:
+                # 遅れた分は取り戻さずに次の周期から再開する
+                next_at = time.monotonic()
+                delay = 0
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        while not idle.empty():
+            _, writer = idle.get_nowait()
+            writer.close()
+
+    async def _probe(self, idle, slots):
+        connection = None
+        sent_at = time.monotonic()
+        try:
+            if not idle.empty():
+                connection = idle.get_nowait()
+            else:
+                # 新しい接続の確立時間はRTTに含めない
+                connection = await asyncio.wait_for(self._connect(), timeout=self.timeout)
+                sent_at = time.monotonic()
+
+            reader, writer = connection
+            writer.write(self.request)
+            await writer.drain()
+            header = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=self.timeout)
+            rtt = (time.monotonic() - sent_at) * 1000
+
+            if b"connection: close" in header.lower() or not header.startswith(b"HTTP/1.1"):
+                writer.close()
+            else:
+                idle.put_nowait(connection)
+            self.stats.record(sent_at, rtt)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            if connection is not None:
+                connection[1].close()
+            self.stats.record(sent_at, None)
+        finally:
+            slots.release()
+
+    async def _connect(self):
+        context = ssl.create_default_context() if self.use_ssl else None
+        return await asyncio.open_connection(self.host, self.port, ssl=context)
@@ -0,0 +1,208 @@
+"""
+入力ファイルの内容とエンコードパラメータをキーにした、エンコード結果のキャッシュ。
+
+キャッシュエントリは cache_dir/<key>/ 以下に成果物とmanifest.jsonとして保存され、
+ヒットした場合はハードリンク（不可能な場合はコピー）で出力先に配置する。
+ハードリンクは同じinodeを共有するため、出力先へ書き込む処理は既存ファイルを削除してから
+新しいファイルを作成すること（FFmpegの-yによる上書きはキャッシュ側の内容も書き換えてしまう）。
+manifest.jsonの更新時刻を最終使用時刻とし、合計サイズがmax_bytesを超えた場合は古いものから削除する。
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+# 同じファイルを何度もハッシュしないよう、(パス, サイズ, 更新時刻, inode) ごとに結果を保持する
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def file_fingerprint(path):
+    """
+    ファイル全体の内容からフィンガープリントを計算する。
+    一部だけを読む方法では、読まなかった範囲が書き換えられた場合に古いエンコード結果を返してしまう。
+    結果はプロセス内で (パス, サイズ, 更新時刻, inode) をキーに保持し、変更されていなければ再計算しない。
+
+    Args:
+        path (str): 対象ファイルのパス。
+
+    Returns:
+        str: SHA-256の16進文字列。
+    """
+    stat = os.stat(path)
+    stat_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    with _fingerprints_lock:
+        if stat_key in _fingerprints:
+            return _fingerprints[stat_key]
+
+    digest = hashlib.sha256(str(stat.st_size).encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    fingerprint = digest.hexdigest()
+    with _fingerprints_lock:
+        _fingerprints[stat_key] = fingerprint
+    return fingerprint
+
+
+def link_or_copy(src, dst):
+    """
+    srcをdstにハードリンクする。別ファイルシステムなどでリンクできない場合はコピーする。
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def remove_if_exists(path):
+    """
+    出力先のファイルを削除する。キャッシュと共有しているinodeを上書きしないために使用する。
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class EncodeCache:
+    def __init__(self, cache_dir="cache/encode", max_bytes=20 * 1024 ** 3):
+        """
+        Args:
+            cache_dir (str): キャッシュを保存するディレクトリ。
+            max_bytes (int): キャッシュの合計サイズの上限（バイト）。
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def make_key(self, input_paths, params):
+        """
+        入力ファイルのフィンガープリントとエンコードパラメータからキャッシュキーを作成する。
+
+        Args:
+            input_paths (list): 入力ファイルのパスのリスト。
+            params (dict): 解像度・ビットレート・プリセットなどのエンコードパラメータ。
+
+        Returns:
+            str: キャッシュキー。
+        """
+        digest = hashlib.sha256()
+        for path in input_paths:
+            digest.update(file_fingerprint(path).encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def fetch(self, key, dest_dir, rename=None):
+        """
+        キャッシュされた成果物をdest_dirに配置する。
+
+        Args:
+            key (str): キャッシュキー。
+            dest_dir (str): 成果物を配置するディレクトリ。
+            rename (callable): 登録時のファイル名とmetaを受け取り、配置先のファイル名を返す関数（番号の付け替えなど）。
+
+        Returns:
+            dict: ヒットした場合はmanifestのmeta、ミスの場合はNone。
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        manifest_path = os.path.join(entry_dir, "manifest.json")
+        try:
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        try:
+            os.makedirs(dest_dir, exist_ok=True)
+            for name in manifest["files"]:
+                link_or_copy(os.path.join(entry_dir, name), os.path.join(dest_dir, rename(name, manifest.get("meta", {})) if rename else name))
+        except OSError as e:
+            print(f"Encode cache entry {key[:12]} is broken: {e}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        # 最終使用時刻を更新 (LRU)
+        os.utime(manifest_path)
+        return manifest.get("meta", {})
+
+    def store(self, key, file_paths, meta=None):
+        """
+        成果物をキャッシュに登録する。
+
+        Args:
+            key (str): キャッシュキー。
+            file_paths (list): 登録するファイルのパス（ファイル名はエントリ内で一意であること）。
+            meta (dict): 成果物と一緒に保存する付加情報。
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.exists(os.path.join(entry_dir, "manifest.json")):
+            return
+
+        # 一時ディレクトリに作成してからリネームし、並列プロセスから不完全なエントリが見えないようにする
+        temp_dir = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(temp_dir)
+        try:
+            names = []
+            for path in file_paths:
+                name = os.path.basename(path)
+                link_or_copy(path, os.path.join(temp_dir, name))
+                names.append(name)
+            with open(os.path.join(temp_dir, "manifest.json"), "w") as f:
+                json.dump({"files": names, "meta": meta or {}, "created": time.time()}, f)
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # 他のプロセスが同じキーを先に登録した場合など
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """
+        合計サイズがmax_bytesを超えている間、最終使用時刻の古いエントリから削除する。
+        """
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            manifest_path = os.path.join(entry_dir, "manifest.json")
+            if key.startswith(".tmp-") or not os.path.exists(manifest_path):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir)
+            )
+            entries.append((os.path.getmtime(manifest_path), size, entry_dir))
+            total_size += size
+
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+            print(f"Evicted encode cache entry: {os.path.basename(entry_dir)[:12]}")
+
+
+def load_encode_cache(config):
+    """
+    config.jsonの"encode_cache"設定からEncodeCacheを作成する。
+
+    Args:
+        config (dict): 設定値。
+
+    Returns:
+        EncodeCache: キャッシュが無効化されている場合はNone。
+    """
+    cache_config = config.get("encode_cache", {})
+    if not cache_config.get("enabled", True):
+        return None
+    return EncodeCache(
+        cache_dir=cache_config.get("dir", "cache/encode"),
+        max_bytes=cache_config.get("max_bytes", 20 * 1024 ** 3)
+    )
@@ -0,0 +1,237 @@
+"""
+リアルタイム配信のエンコード速度を一定に保つガバナー。
+
+セグメントごとにFFmpegが報告するエンコード速度（speed=、1.0で実時間）を受け取り、
+目標の実時間比を下回った場合は処理を軽く、十分な余裕が続いた場合は元の設定に戻す。
+
+  遅れた場合: スレッド数を増やす → x264プリセットを速くする → 最上位のレンディションを一段下げる
+  余裕がある場合: 上記を逆の順に戻す（設定値より重くはしない）
+
+エンコードが実時間に追いつかないと、ライブエッジが実時間から少しずつ離れていくため、
+画質を一時的に下げてでも実時間での配信を維持する。調整はすべて標準出力とJSON Linesのログに記録する。
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+
+_SPEED_PATTERN = re.compile(r"speed=\s*([0-9.]+)x")
+
+
+def parse_ffmpeg_speed(output):
+    """
+    FFmpegの出力（統計行、または-progressの出力）から最後に報告された速度を取り出す。
+
+    Args:
+        output (str): FFmpegの出力。
+
+    Returns:
+        float: 速度（1.0で実時間）。報告がない場合はNone。
+    """
+    matches = _SPEED_PATTERN.findall(output or "")
+    if not matches:
+        return None
+    try:
+        return float(matches[-1])
+    except ValueError:
+        return None
+
+
+def combine_speeds(speeds):
+    """
+    同じ入力を順番に処理した複数のFFmpegの速度から、全体の速度を求める。
+
+    Args:
+        speeds (list): 各FFmpegの速度。
+
+    Returns:
+        float: 全体の速度。報告がない場合はNone。
+    """
+    speeds = [speed for speed in speeds if speed]
+    if not speeds:
+        return None
+    return 1.0 / sum(1.0 / speed for speed in speeds)
+
+
+class EncodeGovernor:
+    def __init__(self, target_speed=1.0, upgrade_speed=1.5, upgrade_after=3, threads=None, max_threads=None,
+                 max_preset_steps=4, max_shed=None, log_dir="logs/encode_governor"):
+        """
+        Args:
+            target_speed (float): 維持する実時間比。これを下回ったセグメントの直後に処理を軽くする。
+            upgrade_speed (float): この実時間比を上回るセグメントが続いた場合に設定を戻す。
+            upgrade_after (int): 設定を戻すまでに続く必要があるセグメント数。
+            threads (int): エンコーダのスレッド数の初期値。NoneはFFmpegに任せる（スレッドの調整は行わない）。
+            max_threads (int): スレッド数の上限。Noneの場合はCPUコア数。
+            max_preset_steps (int): プリセットを速くする最大段数。
+            max_shed (int): 下げる最大レンディション数。Noneの場合は最も低いレンディション以外すべて。
+            log_dir (str): 調整のログを保存するディレクトリ。Noneの場合は標準出力のみ。
+        """
+        self.target_speed = target_speed
+        self.upgrade_speed = upgrade_speed
+        self.upgrade_after = upgrade_after
+        self.base_threads = threads
+        self.max_threads = max_threads or os.cpu_count() or 1
+        self.max_preset_steps = max_preset_steps
+        self.max_shed = max_shed
+        self.log_dir = log_dir
+        self.log_path = None
+
+        # 現在の調整状態
+        self.threads = threads
+        self.preset_steps = 0
+        self.shed = 0
+        self.fast_streak = 0
+        self.segments = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, governor_config):
+        """
+        config.jsonの"encode_governor"からガバナーを作成する。
+
+        Returns:
+            EncodeGovernor: 無効な場合はNone。
+        """
+        if not governor_config.get("enabled", False):
+            return None
+        return cls(
+            target_speed=governor_config.get("target_speed", 1.0),
+            upgrade_speed=governor_config.get("upgrade_speed", 1.5),
+            upgrade_after=governor_config.get("upgrade_after", 3),
+            threads=governor_config.get("threads"),
+            max_threads=governor_config.get("max_threads"),
+            max_preset_steps=governor_config.get("max_preset_steps", 4),
+            max_shed=governor_config.get("max_shed"),
+            log_dir=governor_config.get("log_dir", "logs/encode_governor")
+        )
+
+    def preset(self, base_preset):
+        """
+        現在の調整を反映したx264プリセットを返す。
+
+        Args:
+            base_preset (str): 設定上のプリセット。
+        """
+        with self.lock:
+            index = PRESETS.index(base_preset) if base_preset in PRESETS else PRESETS.index("medium")
+            return PRESETS[max(0, index - self.preset_steps)]
+
+    def encoder_threads(self):
+        """
+        現在のエンコーダのスレッド数を返す（NoneはFFmpegに任せる）。
+        """
+        with self.lock:
+            return self.threads
+
+    def renditions(self, renditions):
+        """
+        現在の調整を反映したレンディションの一覧を返す。
+
+        下げたレンディションは名前（プレイリスト）を残したまま、下げていない最上位のレンディションと
+        同じ解像度・ビットレートでエンコードする。プレイリストとセグメント番号が途切れないため、
+        プレイヤーはそのまま再生を続けられる。
+
+        Args:
+            renditions (list): (level, width, height, kbps) のリスト（低い順）。
+
+        Returns:
+            list: (level, width, height, kbps) のリスト。
+        """
+        with self.lock:
+            shed = min(self.shed, len(renditions) - 1)
+        if shed <= 0:
+            return list(renditions)
+        kept = renditions[:len(renditions) - shed]
+        _, width, height, bitrate = kept[-1]
+        return kept + [(level, width, height, bitrate) for level, _, _, _ in renditions[len(kept):]]
+
+    def observe(self, segment, speeds, rendition_count):
+        """
+        セグメントのエンコード速度を受け取り、必要であれば設定を一段調整する。
+
+        Args:
+            segment (str): セグメント名（ログ用）。
+            speeds (dict): ステージ名ごとのFFmpegの速度（Noneは報告なし）。
+            rendition_count (int): レンディション数。
+
+        Returns:
+            str: 調整した内容。調整しなかった場合はNone。
+        """
+        reported = [speed for speed in speeds.values() if speed]
+        if not reported:
+            return None
+        speed = min(reported)
+
+        with self.lock:
+            self.segments += 1
+            before = self._state()
+            change = None
+            if speed < self.target_speed:
+                self.fast_streak = 0
+                change = self._downgrade(rendition_count)
+            elif speed >= self.upgrade_speed:
+                self.fast_streak += 1
+                if self.fast_streak >= self.upgrade_after:
+                    self.fast_streak = 0
+                    change = self._upgrade()
+            else:
+                self.fast_streak = 0
+            after = self._state()
+
+        if change is not None:
+            self._log(segment, speed, speeds, change, before, after)
+        return change
+
+    def _state(self):
+        return {"threads": self.threads, "preset_steps": self.preset_steps, "shed": self.shed}
+
+    def _downgrade(self, rendition_count):
+        if self.threads is not None and self.threads < self.max_threads:
+            self.threads = min(self.max_threads, self.threads * 2)
+            return "threads up"
+        if self.preset_steps < self.max_preset_steps:
+            self.preset_steps += 1
+            return "faster preset"
+        max_shed = rendition_count - 1 if self.max_shed is None else min(self.max_shed, rendition_count - 1)
+        if self.shed < max_shed:
+            self.shed += 1
+            return "shed rendition"
+        return None
+
+    def _upgrade(self):
+        if self.shed > 0:
+            self.shed -= 1
+            return "restore rendition"
+        if self.preset_steps > 0:
+            self.preset_steps -= 1
+            return "slower preset"
+        if self.threads is not None and self.base_threads is not None and self.threads > self.base_threads:
+            self.threads = max(self.base_threads, self.threads // 2)
+            return "threads down"
+        return None
+
+    def _log(self, segment, speed, speeds, change, before, after):
+        print(f"[governor] {segment}: speed {speed:.2f}x (target {self.target_speed:.2f}x) -> {change} "
+              f"(threads {after['threads'] or 'auto'}, preset -{after['preset_steps']}, shed {after['shed']})")
+        if not self.log_dir:
+            return
+        try:
+            if self.log_path is None:
+                now = datetime.now()
+                daily_dir = os.path.join(self.log_dir, now.strftime("%Y-%m-%d"))
+                os.makedirs(daily_dir, exist_ok=True)
+                self.log_path = os.path.join(daily_dir, f"{now.strftime('%H-%M-%S')}.jsonl")
+            record = {
+                "time": time.time(), "segment": segment, "speed": speed, "speeds": speeds,
+                "change": change, "before": before, "after": after
+            }
+            with open(self.log_path, "a") as log_file:
+                log_file.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"Error writing governor log: {e}")
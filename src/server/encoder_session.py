@@ -0,0 +1,121 @@
+import subprocess
+import threading
+import time
+from src.server.encode_cache import remove_if_exists
+from src.server.encode_governor import parse_ffmpeg_speed
+
+
+class EncoderSession:
+    """
+    1セグメント分のフレームを標準入力経由でFFmpegに直接渡し、H.264でエンコードするセッション。
+
+    cv2.VideoWriterで一時ファイル(mp4v)を書き出してから再エンコードする代わりに、
+    rawvideoをパイプで流し込むため、エンコードはフレームの生成と並行して進む。
+    """
+
+    def __init__(self, output_path, width, height, fps, video_bitrate, preset="fast", bufsize="3M", threads=None):
+        """
+        Args:
+            output_path (str): 出力するMP4ファイルのパス。
+            width (int): フレームの幅。
+            height (int): フレームの高さ。
+            fps (int): 動画のフレームレート。
+            video_bitrate (int | str): ビットレート（kbpsの整数、または"3000k"のような文字列）。
+            preset (str): x264のプリセット。
+            bufsize (str): レート制御のバッファサイズ。
+            threads (int): エンコーダのスレッド数。Noneの場合はFFmpegに任せる。
+        """
+        self.output_path = output_path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frame_count = 0
+        self.started_at = time.time()  # 最初のフレームを受け取った時刻
+        self.speed = None  # FFmpegが報告した直近のエンコード速度（1.0で実時間）
+
+        video_bitrate_str = f"{video_bitrate}k" if isinstance(video_bitrate, int) else video_bitrate
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error", "-progress", "pipe:1",
+            "-f", "rawvideo", "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}", "-r", str(fps),
+            "-i", "-",
+            "-c:v", "libx264", "-preset", preset,
+            "-pix_fmt", "yuv420p",
+        ]
+        if threads:
+            command += ["-threads", str(threads)]
+        if video_bitrate_str:
+            command += ["-b:v", video_bitrate_str, "-maxrate", video_bitrate_str, "-bufsize", bufsize]
+        command.append(output_path)
+
+        # キャッシュとハードリンクを共有している可能性があるため、上書きせずに削除してから作成する
+        remove_if_exists(output_path)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.progress_reader = threading.Thread(target=self._read_progress, daemon=True)
+        self.progress_reader.start()
+
+    def _read_progress(self):
+        """
+        -progressの出力を読み続け、直近のエンコード速度を保持する。
+        """
+        for line in self.process.stdout:
+            if line.startswith(b"speed="):
+                speed = parse_ffmpeg_speed(line.decode(errors="replace"))
+                if speed is not None:
+                    self.speed = speed
+
+    def write(self, frame):
+        """
+        フレームをエンコーダに渡す。
+
+        Args:
+            frame (np.ndarray): BGR形式のフレーム (height, width, 3)。
+        """
+        height, width = frame.shape[:2]
+        if (width, height) != (self.width, self.height):
+            raise ValueError(
+                f"Frame size {width}x{height} does not match encoder size {self.width}x{self.height}"
+            )
+        try:
+            self.process.stdin.write(memoryview(frame).cast("B") if frame.flags.c_contiguous else frame.tobytes())
+        except BrokenPipeError:
+            # FFmpegが異常終了した場合はclose()でエラー内容を報告する
+            self.close()
+            raise
+        self.frame_count += 1
+
+    def close(self):
+        """
+        標準入力を閉じ、エンコードの完了を待機する。
+
+        Returns:
+            str: 出力したMP4ファイルのパス。
+
+        Raises:
+            subprocess.CalledProcessError: FFmpegが異常終了した場合。
+        """
+        if self.process.stdin and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        stderr = self.process.stderr.read() if self.process.stderr else b""
+        returncode = self.process.wait()
+        self.progress_reader.join()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, self.process.args, stderr=stderr.decode(errors="replace")
+            )
+        return self.output_path
+
+    def abort(self):
+        """
+        エンコードを中断し、プロセスを終了させる。
+        """
+        try:
+            if self.process.stdin and not self.process.stdin.closed:
+                self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.kill()
+        self.process.wait()
@@ -0,0 +1,117 @@
+"""
+デコードしたフレームを固定サイズのリングバッファ経由でエンコーダに渡すモジュール。
+
+フレームごとに新しい配列を確保する代わりに、事前に確保したNumPy配列を
+cap.read(image=...)で再利用する。バッファ数はmax_bytesから決まるため、
+セグメントの長さや解像度に関係なく、フレームが占めるメモリの上限を設定できる。
+"""
+
+import queue
+import threading
+import numpy as np
+
+
+class FrameRing:
+    def __init__(self, frame_shape, max_bytes=256 * 1024 ** 2, dtype=np.uint8):
+        """
+        Args:
+            frame_shape (tuple): フレームの形状 (height, width, channels)。
+            max_bytes (int): リングバッファ全体のメモリ上限（バイト）。最低2フレームは確保する。
+            dtype: フレームのデータ型。
+        """
+        frame_bytes = int(np.prod(frame_shape)) * np.dtype(dtype).itemsize
+        self.slot_count = max(2, max_bytes // frame_bytes)
+        self.buffers = [np.empty(frame_shape, dtype=dtype) for _ in range(self.slot_count)]
+        self.free = queue.Queue()
+        for index in range(self.slot_count):
+            self.free.put(index)
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers)
+
+    def acquire(self, timeout=None):
+        """
+        空きバッファを取得する。全て使用中の場合は解放されるまで待機する（バックプレッシャ）。
+
+        Returns:
+            tuple: (バッファ番号, np.ndarray)
+        """
+        index = self.free.get(timeout=timeout)
+        return index, self.buffers[index]
+
+    def release(self, index):
+        self.free.put(index)
+
+
+def pump_frames(cap, consume, max_frames, max_buffer_bytes=256 * 1024 ** 2, on_frame=None, on_ring=None):
+    """
+    capからデコードしたフレームをリングバッファに書き込み、別スレッドのconsumeに順番に渡す。
+    デコードとエンコーダへの受け渡しが並行に進み、メモリ使用量はmax_buffer_bytesで頭打ちになる。
+
+    Args:
+        cap (cv2.VideoCapture): 入力動画。
+        consume (callable): フレーム(np.ndarray)を受け取る関数。戻った時点でバッファは再利用される。
+        max_frames (int): 処理する最大フレーム数。
+        max_buffer_bytes (int): リングバッファのメモリ上限（バイト）。
+        on_frame (callable): フレームを1枚消費するたびに消費済みフレーム数を受け取る関数。
+        on_ring (callable): 作成したFrameRingを受け取る関数（キューの深さの監視用）。
+
+    Returns:
+        int: 処理したフレーム数。
+    """
+    ret, first_frame = cap.read()
+    if not ret or max_frames <= 0:
+        return 0
+
+    ring = FrameRing(first_frame.shape, max_buffer_bytes, first_frame.dtype)
+    if on_ring is not None:
+        on_ring(ring)
+    filled = queue.Queue()
+    errors = []
+    consumed = [0]
+
+    def consumer():
+        while True:
+            index = filled.get()
+            if index is None:
+                break
+            try:
+                if not errors:
+                    consume(ring.buffers[index])
+                    consumed[0] += 1
+                    if on_frame is not None:
+                        on_frame(consumed[0])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                ring.release(index)
+
+    thread = threading.Thread(target=consumer, daemon=True)
+    thread.start()
+
+    try:
+        index, buffer = ring.acquire()
+        buffer[...] = first_frame
+        filled.put(index)
+        del first_frame
+
+        decoded = 1
+        while decoded < max_frames and not errors:
+            index, buffer = ring.acquire()
+            ret, frame = cap.read(image=buffer)
+            if not ret:
+                ring.release(index)
+                break
+            if frame is not buffer:
+                # サイズが変わった場合などOpenCVが新しい配列を返したときはコピーする
+                buffer[...] = frame
+            filled.put(index)
+            decoded += 1
+    finally:
+        filled.put(None)
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return consumed[0]
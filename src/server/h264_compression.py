@@ -1,7 +1,8 @@
 import os
 import subprocess
+from src.server.encode_cache import remove_if_exists
 
-def compress_video_to_h264(input_video, window_width, window_height):
+def compress_video_to_h264(input_video, window_width, window_height, cache=None):
     """
     入力動画をH.264形式に圧縮し、指定された解像度で出力する関数。
 
@@ -9,6 +10,7 @@ def compress_video_to_h264(input_video, window_width, window_height):
         input_video (str): 入力動画のパス。
         window_width (int): 出力動画の幅。
         window_height (int): 出力動画の高さ。
+        cache (EncodeCache): エンコード結果のキャッシュ。入力とパラメータが同じ場合は再エンコードしない。
 
     Returns:
         str: 圧縮された動画のファイルパス。
@@ -25,9 +27,22 @@ def compress_video_to_h264(input_video, window_width, window_height):
         "-vf", f"scale={window_width}:{window_height}",
         "-b:v", "3000k", "-maxrate", "3000k",
         "-bufsize", "2M", "-c:v", "libx264", "-preset", "medium",
+        # 30秒ごとにキーフレームを置き、MP4セグメントをストリームコピーで分割できるようにする
+        "-force_key_frames", "expr:gte(t,n_forced*30)",
         "-tune", "film", res_output
     ]
 
+    # キャッシュを確認
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key([input_video], {"stage": "h264", "command": command[3:]})
+        if cache.fetch(cache_key, os.path.dirname(res_output)) is not None:
+            print(f"Encode cache hit: {res_output}")
+            return res_output
+
+    # キャッシュと共有している可能性があるため、上書きせずに削除してから作成する
+    remove_if_exists(res_output)
+
     # FFmpegを実行
     try:
         print(f"Running FFmpeg for {res_output}...")
@@ -37,4 +52,7 @@ def compress_video_to_h264(input_video, window_width, window_height):
         print(f"Error during FFmpeg execution: {e.stderr}")
         raise
 
+    if cache is not None:
+        cache.store(cache_key, [res_output])
+
     return res_output
@@ -0,0 +1,246 @@
+"""
+セグメント化済みのMP4からHLSファイルを並列に生成するモジュール。
+
+各MP4セグメントが使用する.tsファイル番号は、セグメントの長さから事前に決定的に割り当てるため、
+ワーカーの完了順序に関係なく同じ番号・同じ順序のプレイリストが生成される。
+スレッド数は「ワーカー数 × FFmpegの-threads」が全体のスレッド予算を超えないように配分する。
+fMP4モードでは、ワーカーが出力したチャンクを全ワーカーの完了後に再生順で単一ファイルへ追記する。
+セグメントインデックスがある場合は、MP4セグメントの一覧と長さをインデックスから読み出し、
+番号はインデックス上で予約する（同じ出力ディレクトリに書き込む他のプロセスと番号が重複しない）。
+"""
+
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.server.encode_cache import file_fingerprint, remove_if_exists
+from src.server.hls_server import (
+    append_to_m3u8, commit_fmp4_chunk, create_hls_with_dynamic_bitrate, create_master_m3u8, get_playlist,
+    indexed_source_segments, reserve_segment_numbers, resolve_renditions, segment_number, write_rendition_info
+)
+from src.server.media_probe import get_video_duration
+
+
+def segment_durations(segment_paths):
+    """
+    各MP4セグメントの長さ（秒）を求める。長さが取得できない場合は30秒のチャンクとみなす。
+    """
+    durations = []
+    for path in segment_paths:
+        duration = get_video_duration(path)
+        durations.append(duration if duration is not None else 30)
+    return durations
+
+
+def plan_segment_numbers(segment_paths, segment_time, start_number=0, durations=None):
+    """
+    各MP4セグメントに割り当てる最初の.tsファイル番号を決定する。
+
+    Args:
+        segment_paths (list): 再生順に並んだMP4セグメントのパス。
+        segment_time (int): HLSセグメントの長さ（秒）。
+        start_number (int): 最初のMP4セグメントに割り当てる番号。
+        durations (list): 各セグメントの長さ（秒）。Noneの場合はsegment_durationsで求める。
+
+    Returns:
+        tuple: (各セグメントの開始番号のリスト, 次に使用する番号)
+    """
+    if durations is None:
+        durations = segment_durations(segment_paths)
+    start_numbers = []
+    next_number = start_number
+    for duration in durations:
+        start_numbers.append(next_number)
+        # 多めに見積もっても番号が飛ぶだけで、重複は起こらない
+        next_number += max(1, math.ceil(duration / segment_time - 1e-6))
+    return start_numbers, next_number
+
+
+def plan_thread_budget(job_count, total_threads=None, threads_per_job=None):
+    """
+    全体のスレッド予算をワーカー数とFFmpegの-threadsに配分する。
+
+    Args:
+        job_count (int): 処理するセグメント数。
+        total_threads (int): 使用するスレッドの総数。Noneの場合はCPUコア数。
+        threads_per_job (int): 1つのFFmpegに割り当てるスレッド数。Noneの場合は4。
+
+    Returns:
+        tuple: (ワーカー数, FFmpegの-threads)
+    """
+    total_threads = total_threads or os.cpu_count() or 1
+    threads_per_job = max(1, min(threads_per_job or 4, total_threads))
+    workers = max(1, min(job_count, total_threads // threads_per_job))
+    return workers, threads_per_job
+
+
+def _renumber(name, level, old_start, new_start):
+    """
+    キャッシュに登録したときの番号で付けられたファイル名を、今回割り当てた番号の名前に付け替える。
+    """
+    if not name or old_start == new_start:
+        return name
+    if name.startswith(f"segment-{level}-"):
+        return f"segment-{level}-{segment_number(name) - old_start + new_start:03d}.ts"
+    prefix = f"chunk-{old_start}"
+    if name.startswith(prefix) and name[len(prefix)] in ".-":
+        return f"chunk-{new_start}{name[len(prefix):]}"
+    return name
+
+
+def _package_segment(segment_path, output_dir, renditions, segment_time,
+                     start_number, end_number, threads, cache, segment_format="ts", ts_offset=None):
+    """
+    ワーカープロセスで1つのMP4セグメントをHLS化する。プレイリストは親プロセスでまとめて書く。
+    キャッシュがある場合は解像度ごとに成果物を登録し、全解像度がヒットした場合はエンコードを省略する。
+    キャッシュキーは内容とエンコードパラメータだけで決め、番号はヒットしたときに付け替える
+    （既存のセグメントや他のプロセスの予約で番号がずれても再利用できる）。
+
+    Returns:
+        dict: 解像度名ごとの (uri, duration) のリスト（fMP4の場合は追記前のチャンクを指すエントリ）。
+    """
+    if segment_format == "fmp4":
+        segment_names = {
+            level: [f"chunk-{start_number}.m4s", f"chunk-{start_number}-init.mp4",
+                    f"chunk-{start_number}-init-{level}.mp4"]
+            for level, _, _, _ in renditions
+        }
+    else:
+        segment_names = {
+            level: [f"segment-{level}-{number:03d}.ts" for number in range(start_number, end_number)]
+            for level, _, _, _ in renditions
+        }
+
+    cache_keys = {}
+    if cache is not None:
+        fingerprint = file_fingerprint(segment_path)
+        for level, width, height, bitrate in renditions:
+            cache_keys[level] = cache.make_key([], {
+                "stage": "hls", "input": fingerprint, "level": level, "resolution": [width, height],
+                "bitrate": bitrate, "segment_time": segment_time,
+                "format": segment_format, "ts_offset": ts_offset
+            })
+        hits = {}
+        for level, cache_key in cache_keys.items():
+            def rename(name, meta, level=level):
+                return _renumber(name, level, meta.get("start_number", start_number), start_number)
+
+            hit = cache.fetch(cache_key, os.path.join(output_dir, level), rename=rename)
+            if hit is not None and "entries" in hit:
+                hits[level] = [
+                    (rename(entry[0], hit), *entry[1:3], rename(entry[3], hit)) if len(entry) > 3
+                    else (rename(entry[0], hit), *entry[1:])
+                    for entry in hit["entries"]
+                ]
+        if len(hits) == len(cache_keys):
+            print(f"Encode cache hit: {os.path.basename(segment_path)}")
+            return hits
+
+    # キャッシュと共有している可能性があるため、上書きせずに削除してから作成する
+    for level, names in segment_names.items():
+        for name in names:
+            remove_if_exists(os.path.join(output_dir, level, name))
+
+    segment_lists = create_hls_with_dynamic_bitrate(
+        segment_path, output_dir, None, None, segment_time,
+        start_number=start_number, threads=threads, write_playlists=False, renditions=renditions,
+        segment_format=segment_format, ts_offset=ts_offset
+    )
+
+    for level, cache_key in cache_keys.items():
+        entries = segment_lists.get(level)
+        if entries:
+            # fMP4の場合はチャンクと初期化セグメント
+            names = dict.fromkeys(name for entry in entries for name in (entry[0], *entry[3:]) if name)
+            produced = [os.path.join(output_dir, level, name) for name in names]
+            cache.store(cache_key, produced, meta={"entries": entries, "start_number": start_number})
+    return segment_lists
+
+
+def create_hls_parallel(segment_dir, output_dir, resolutions, video_bitrate, segment_time=10,
+                        total_threads=None, threads_per_job=None, cache=None, renditions=None, segment_format="ts"):
+    """
+    セグメントディレクトリ内の全MP4をプロセスプールでHLS化し、最後にプレイリストを生成する。
+
+    Args:
+        segment_dir (str): MP4セグメントが格納されたディレクトリ。
+        output_dir (str): HLSの出力ディレクトリ。
+        resolutions (list): 解像度のリスト (width, height)。
+        video_bitrate (int): 元動画のビットレート（kbps）。
+        segment_time (int): HLSセグメントの長さ（秒）。
+        total_threads (int): 使用するスレッドの総数。Noneの場合はCPUコア数。
+        threads_per_job (int): 1つのFFmpegに割り当てるスレッド数。
+        cache (EncodeCache): エンコード結果のキャッシュ。
+        renditions (list): (level, width, height, kbps) のリスト（タイトルごとのラダー）。
+            Noneの場合はresolutionsとvideo_bitrateから求める。
+        segment_format (str): "ts" または "fmp4"。
+
+    Returns:
+        int: HLS化に成功したセグメント数。
+    """
+    indexed = indexed_source_segments(segment_dir)
+    if indexed is not None:
+        segment_paths = [path for path, _ in indexed]
+        durations = [duration if duration is not None else 30 for _, duration in indexed]
+    else:
+        segment_paths = [os.path.join(segment_dir, f) for f in sorted(os.listdir(segment_dir)) if f.endswith(".mp4")]
+        durations = None
+    if not segment_paths:
+        print("No segment files found in the segment directory.")
+        return 0
+
+    renditions = resolve_renditions(resolutions, video_bitrate, renditions)
+    levels = [level for level, _, _, _ in renditions]
+    os.makedirs(output_dir, exist_ok=True)
+    for level in levels:
+        os.makedirs(os.path.join(output_dir, level), exist_ok=True)
+
+    if durations is None:
+        durations = segment_durations(segment_paths)
+    _, count = plan_segment_numbers(segment_paths, segment_time, 0, durations)
+    first_number = reserve_segment_numbers(output_dir, levels, count)
+    start_numbers, next_number = plan_segment_numbers(segment_paths, segment_time, first_number, durations)
+    # fMP4の各チャンクのタイムスタンプは、既存のプレイリストの続きから再生順に並べる
+    start_time = get_playlist(output_dir, levels[0]).total_duration
+    ts_offsets = [start_time + sum(durations[:i]) for i in range(len(durations))]
+    workers, threads = plan_thread_budget(len(segment_paths), total_threads, threads_per_job)
+
+    print(f"Found {len(segment_paths)} segment files. Starting HLS generation "
+          f"with {workers} workers x {threads} threads...")
+
+    completed = 0
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_package_segment, path, output_dir, renditions,
+                            segment_time, start_number, end_number, threads, cache,
+                            segment_format, ts_offset if segment_format == "fmp4" else None): path
+            for path, start_number, end_number, ts_offset
+            in zip(segment_paths, start_numbers, start_numbers[1:] + [next_number], ts_offsets)
+        }
+        for future in as_completed(futures):
+            segment_file = os.path.basename(futures[future])
+            try:
+                results[futures[future]] = future.result()
+                completed += 1
+                print(f"HLSファイルを生成しました: {output_dir} for segment {segment_file} "
+                      f"({completed}/{len(segment_paths)})")
+            except Exception as e:
+                print(f'Video Encoding for HLS failed for {segment_file}: {e}')
+
+    # 全ワーカーの完了後に番号順でプレイリストを生成
+    for level in levels:
+        if segment_format == "fmp4":
+            entries = [
+                entry for path in segment_paths if path in results
+                for entry in commit_fmp4_chunk(output_dir, level, results[path].get(level, []))
+            ]
+        else:
+            entries = [
+                entry for path in segment_paths if path in results
+                for entry in results[path].get(level, [])
+            ]
+        append_to_m3u8(output_dir, level, entries)
+    write_rendition_info(output_dir, renditions)
+    create_master_m3u8(output_dir, renditions)
+
+    return completed
@@ -1,101 +1,304 @@
+import json
+import math
 import os
+import shutil
 import subprocess
+from src.server.playlist import MediaPlaylist, read_media_segments, read_segment_list, write_atomic
+from src.server.encode_governor import parse_ffmpeg_speed, combine_speeds
+from src.server.media_probe import get_video_duration
 
-# グローバル変数でセグメント番号を追跡
+# グローバル変数でセグメント番号とプレイリストを追跡
 segment_indices = {}
+playlists = {}
+fmp4_inits = {}  # 解像度のディレクトリ -> (現在の初期化セグメント名, 内容)
+segment_db = None  # SegmentIndex。Noneの場合はディレクトリとm3u8から状態を復元する
 
-def get_video_bitrate(input_file):
+# レンディションの情報が保存されていない場合のmaster.m3u8の値 (level, width, height, kbps)
+DEFAULT_RENDITIONS = [
+    ("low", 640, 360, 300),
+    ("medium", 1280, 720, 800),
+    ("high", 1920, 1080, 1500)
+]
+RENDITIONS_FILE = "renditions.json"
+
+# fMP4(CMAF)モードで解像度ごとに追記していくメディアファイルの拡張子
+# (.m4sのような不変のセグメントとして扱われないよう、CMAFのトラックファイルの拡張子を使う)
+FMP4_MEDIA_EXTENSION = ".cmfv"
+SEGMENT_FORMATS = ("ts", "fmp4")
+
+def segment_number(filename):
     """
-    FFmpegを使用して元動画のビットレートを取得する関数。
+    "segment-<level>-<番号>.ts" から番号を取り出す。
     """
-    command = [
-        "ffprobe", "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=bit_rate",
-        "-of", "default=noprint_wrappers=1:nokey=1",
-        input_file
-    ]
-    try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        bitrate_bps = int(result.stdout.strip())
-        return bitrate_bps // 1000  # kbps単位に変換
-    except Exception as e:
-        print(f"Error fetching bitrate: {e}")
+    return int(filename.split('-')[-1].split('.')[0])
+
+def use_segment_index(index):
+    """
+    セグメント番号・プレイリスト・帯域幅の参照に使うSegmentIndexを設定する。
+
+    Args:
+        index (SegmentIndex): インデックス。Noneの場合はディレクトリとm3u8を参照する。
+    """
+    global segment_db
+    segment_db = index
+
+def indexed_source_segments(segment_dir):
+    """
+    インデックスに記録されたMP4セグメントを再生順に返す。
+
+    Returns:
+        list: (path, duration) のリスト。インデックスがない場合や記録が古い場合はNone。
+    """
+    if segment_db is None:
         return None
+    return segment_db.source_segments(segment_dir)
+
+def set_segment_index(level, index, output_dir=None):
+    """
+    次に使用するセグメント番号を設定。
+    """
+    segment_indices[level] = index
+    if segment_db is not None and output_dir is not None:
+        segment_db.advance_numbers(output_dir, level, index)
 
 def get_next_segment_index(output_dir, level):
     """
     次のセグメント番号を取得。
+    インデックスがある場合は他のプロセスが使用した番号を含めて毎回インデックスから読み出す。
     """
+    if segment_db is not None:
+        next_number = segment_db.next_number(output_dir, level)
+        if next_number is not None:
+            segment_indices[level] = next_number
+            return next_number
+        # インデックスを使う前に作成されたセグメントがあれば、その続きから番号を記録する
+        segment_indices.pop(level, None)
     if level not in segment_indices:
         segment_files = [
             f for f in os.listdir(os.path.join(output_dir, level))
             if f.startswith(f"segment-{level}-") and f.endswith(".ts")
         ]
         if segment_files:
-            max_index = max(
-                int(f.split('-')[-1].split('.')[0]) for f in segment_files
-            )
+            max_index = max(segment_number(f) for f in segment_files)
         else:
             max_index = -1
         segment_indices[level] = max_index + 1
+        if segment_db is not None:
+            segment_db.advance_numbers(output_dir, level, segment_indices[level])
     return segment_indices[level]
 
+def reserve_segment_numbers(output_dir, levels, count):
+    """
+    全解像度で共通のセグメント番号をcount個確保し、最初の番号を返す。
+    インデックスがある場合はトランザクション内で予約するため、他のプロセスと番号が重複しない。
+    """
+    start = max(get_next_segment_index(output_dir, level) for level in levels)
+    if segment_db is not None:
+        start = segment_db.reserve_numbers(output_dir, levels, count)
+    for level in levels:
+        segment_indices[level] = start + count
+    return start
+
 def update_segment_index(level, count):
     """
     セグメント番号を更新。
     """
     segment_indices[level] += count
 
-def append_to_m3u8(output_dir, level, target_duration=10):
+def get_playlist(output_dir, level, playlist_type="VOD"):
     """
-    m3u8ファイルを全セグメント情報を記述。
+    解像度ごとのプレイリストをメモリ上に保持し、初回のみ既存のm3u8から復元する。
     """
     m3u8_path = os.path.join(output_dir, level, f"{level}.m3u8")
-    segment_files = sorted([
-        f for f in os.listdir(os.path.join(output_dir, level))
-        if f.startswith(f"segment-{level}-") and f.endswith(".ts")
-    ])
-    if not segment_files:
+    if m3u8_path not in playlists:
+        if segment_db is not None and not os.path.exists(m3u8_path):
+            # m3u8が失われていてもインデックスから復元する
+            playlist = MediaPlaylist(m3u8_path, playlist_type)
+            playlist.extend(segment_db.rendition_segments(output_dir, level))
+        else:
+            playlist = MediaPlaylist.load(m3u8_path, playlist_type)
+            if segment_db is not None and playlist.entries and not segment_db.rendition_segments(output_dir, level):
+                # インデックスを使う前に作成されたプレイリストを取り込む
+                segment_db.record_rendition_segments(output_dir, level, playlist.entries)
+        playlists[m3u8_path] = playlist
+    playlist = playlists[m3u8_path]
+    playlist.playlist_type = playlist_type
+    return playlist
+
+def append_to_m3u8(output_dir, level, entries, playlist_type="VOD"):
+    """
+    m3u8ファイルにセグメントを追記し、アトミックに書き出す。
+
+    Args:
+        output_dir (str): HLSの出力ディレクトリ。
+        level (str): 解像度名 (low/medium/high)。
+        entries (list): 追記する (uri, duration) のリスト。durationはFFmpegが出力した実測値。
+        playlist_type (str): "VOD"、"EVENT"、またはNone（ライブ）。
+    """
+    if not entries:
         print(f"No segments found for {level}. Skipping m3u8 generation.")
         return
 
-    with open(m3u8_path, 'w') as f:
-        f.write("#EXTM3U\n")
-        f.write("#EXT-X-VERSION:3\n")
-        f.write(f"#EXT-X-TARGETDURATION:{target_duration}\n")
-        f.write("#EXT-X-MEDIA-SEQUENCE:0\n")
-        f.write("#EXT-X-PLAYLIST-TYPE:VOD\n")
-        for segment in segment_files:
-            f.write(f"#EXTINF:{target_duration}.000000,\n")
-            f.write(f"{segment}\n")
-        f.write("#EXT-X-ENDLIST\n")
+    playlist = get_playlist(output_dir, level, playlist_type)
+    playlist.extend(entries)
+    playlist.write()
+    if segment_db is not None:
+        segment_db.record_rendition_segments(output_dir, level, entries)
+
+def regenerate_playlists(output_dir, playlist_type="VOD"):
+    """
+    インデックスに記録されたセグメントから各解像度のm3u8とmaster.m3u8を書き直す（エンコードは行わない）。
+
+    Returns:
+        int: 書き出したメディアプレイリストの数。
+    """
+    if segment_db is None:
+        raise RuntimeError("The segment index is disabled.")
+    renditions = read_rendition_info(output_dir)
+    levels = [level for level, _, _, _ in renditions] if renditions else segment_db.levels(output_dir)
+    written = 0
+    for level in levels:
+        entries = segment_db.rendition_segments(output_dir, level)
+        if not entries:
+            continue
+        playlist = MediaPlaylist(os.path.join(output_dir, level, f"{level}.m3u8"), playlist_type)
+        playlist.extend(entries)
+        playlist.write()
+        playlists[playlist.path] = playlist
+        written += 1
+    create_master_m3u8(output_dir, renditions)
+    return written
+
+def finalize_m3u8(output_dir, levels=("low", "medium", "high")):
+    """
+    EVENT/ライブのプレイリストにEXT-X-ENDLISTを付けて完結させる。
+    """
+    for level in levels:
+        playlist = playlists.get(os.path.join(output_dir, level, f"{level}.m3u8"))
+        if playlist is not None and playlist.entries:
+            playlist.end()
 
-def create_master_m3u8(output_dir):
+def write_rendition_info(output_dir, renditions):
+    """
+    各レンディションの解像度と目標ビットレートを保存する（master.m3u8の生成に使用）。
+    """
+    data = {"renditions": [
+        {"level": level, "width": width, "height": height, "bitrate": bitrate}
+        for level, width, height, bitrate in renditions
+    ]}
+    write_atomic(os.path.join(output_dir, RENDITIONS_FILE), json.dumps(data, indent=4))
+
+def read_rendition_info(output_dir):
+    """
+    保存されたレンディションの情報を読み込む。保存されていない場合はNone。
+    """
+    try:
+        with open(os.path.join(output_dir, RENDITIONS_FILE), "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return [(r["level"], r["width"], r["height"], r["bitrate"]) for r in data.get("renditions", [])]
+
+def measure_bandwidth(output_dir, level):
+    """
+    プレイリストに載っているセグメントの実際のサイズと長さから帯域幅を求める。
+
+    Returns:
+        tuple: (ピーク(bps), 平均(bps))。セグメントがない場合はNone。
+            ピークはセグメント単位のビットレートの最大値（HLSのBANDWIDTHの定義）。
+    """
+    if segment_db is not None:
+        measured = segment_db.bandwidth(output_dir, level)
+        if measured is not None:
+            peak, average = measured
+            return int(math.ceil(peak)), int(math.ceil(average))
+
+    playlist_path = os.path.join(output_dir, level, f"{level}.m3u8")
+    if not os.path.exists(playlist_path):
+        return None
+
+    peak = 0.0
+    total_bits = 0
+    total_duration = 0.0
+    for uri, duration, byterange, _ in read_media_segments(playlist_path):
+        if byterange is not None:
+            bits = byterange[0] * 8
+        else:
+            try:
+                bits = os.path.getsize(os.path.join(output_dir, level, uri)) * 8
+            except OSError:
+                continue
+        total_bits += bits
+        total_duration += duration
+        if duration > 0:
+            peak = max(peak, bits / duration)
+
+    if total_duration <= 0:
+        return None
+    return int(math.ceil(peak)), int(math.ceil(total_bits / total_duration))
+
+def create_master_m3u8(output_dir, renditions=None):
     """
     master.m3u8ファイルを生成。
+    BANDWIDTH/AVERAGE-BANDWIDTHは生成済みセグメントの実測値で、セグメントがまだない場合は目標ビットレートを使う。
+
+    Args:
+        output_dir (str): HLSの出力ディレクトリ。
+        renditions (list): (level, width, height, kbps) のリスト。Noneの場合は保存された情報を使う。
     """
     master_path = os.path.join(output_dir, "master.m3u8")
     print(f"Creating master playlist: {master_path}")
 
-    bitrates = {
-        "low": 300000,
-        "medium": 800000,
-        "high": 1500000
-    }
-    resolutions = {
-        "low": "640x360",
-        "medium": "1280x720",
-        "high": "1920x1080"
+    if renditions is None:
+        renditions = read_rendition_info(output_dir) or DEFAULT_RENDITIONS
+
+    lines = ["#EXTM3U\n"]
+    for level, width, height, bitrate in renditions:
+        playlist_path = f"{level}/{level}.m3u8"
+        measured = measure_bandwidth(output_dir, level)
+        if measured is not None:
+            peak, average = measured
+            attributes = f"BANDWIDTH={peak},AVERAGE-BANDWIDTH={average}"
+        else:
+            attributes = f"BANDWIDTH={bitrate * 1000}"
+        lines.append(f"#EXT-X-STREAM-INF:{attributes},RESOLUTION={width}x{height}\n")
+        lines.append(f"{playlist_path}\n")
+    write_atomic(master_path, "".join(lines))
+
+def ladder_bitrates(base_bitrate):
+    """
+    元動画のビットレートから各解像度のビットレート（kbps）を求める。
+    """
+    return {
+        "low": max(100, base_bitrate // 3),
+        "medium": max(300, base_bitrate),
+        "high": max(600, base_bitrate * 3)
     }
-    with open(master_path, 'w') as f:
-        f.write("#EXTM3U\n")
-        for level, bitrate in bitrates.items():
-            playlist_path = os.path.join(level, f"{level}.m3u8")
-            f.write(f"#EXT-X-STREAM-INF:BANDWIDTH={bitrate},RESOLUTION={resolutions[level]}\n")
-            f.write(f"{playlist_path}\n")
 
-def create_hls_with_dynamic_bitrate(input_file, output_dir, resolutions, base_bitrate, segment_time=10):
+def resolve_renditions(resolutions, base_bitrate, renditions=None):
+    """
+    生成するレンディションの一覧を求める。
+
+    Args:
+        resolutions (list): 解像度のリスト (width, height)。
+        base_bitrate (int): 元動画の総ビットレート（kbps）。
+        renditions (list): (level, width, height, kbps) のリスト（タイトルごとのラダーなど）。
+            指定した場合はresolutionsとbase_bitrateより優先する。
+
+    Returns:
+        list: (level, width, height, kbps) のリスト。
+    """
+    if renditions:
+        return [tuple(rendition) for rendition in renditions]
+    bitrates = ladder_bitrates(base_bitrate)
+    return [
+        (level, width, height, bitrate)
+        for (width, height), (level, bitrate) in zip(resolutions, bitrates.items())
+    ]
+
+def create_hls_with_dynamic_bitrate(input_file, output_dir, resolutions, base_bitrate, segment_time=10, single_decode=True,
+                                    start_number=None, threads=None, write_playlists=True, playlist_type="VOD",
+                                    renditions=None, preset=None, stats=None, segment_format="ts", ts_offset=None):
     """
     動的に元動画のビットレートを反映したHLSストリーミングファイルを作成。
 
@@ -105,25 +308,199 @@ def create_hls_with_dynamic_bitrate(input_file, output_dir, resolutions, base_bi
         resolutions (list): 解像度のリスト (width, height)。
         base_bitrate (int): 元動画の総ビットレート（kbps）。
         segment_time (int): 各セグメントの時間（秒）。
+        single_decode (bool): Trueの場合、入力を一度だけデコードして全解像度を1回のFFmpegで生成する。
+        start_number (int): 最初の.tsファイル番号。Noneの場合は出力ディレクトリから次の番号を求める。
+        threads (int): FFmpegに割り当てるスレッド数 (-threads)。Noneの場合はFFmpegに任せる。
+        write_playlists (bool): Falseの場合、各解像度のm3u8とmaster.m3u8を更新しない（並列生成用）。
+        playlist_type (str): 各解像度のm3u8のEXT-X-PLAYLIST-TYPE。リアルタイム配信では"EVENT"を指定する。
+        renditions (list): (level, width, height, kbps) のリスト。指定した場合はresolutionsとbase_bitrateより優先する。
+        preset (str): x264のプリセット。Noneの場合はFFmpegの既定値。
+        stats (dict): 指定した場合、FFmpegが報告したエンコード速度を"speed"に格納する（1.0で実時間）。
+        segment_format (str): "ts"（セグメントごとの.ts）または"fmp4"（初期化セグメントと解像度ごとの単一ファイル）。
+        ts_offset (float): fMP4の出力のタイムスタンプに加える秒数。Noneの場合はプレイリストの長さの合計。
+
+    Returns:
+        dict: 解像度名ごとの、今回生成した (uri, duration) のリスト。
+            fMP4の場合は (uri, duration, byterange, map_uri) のリストで、write_playlists=Falseのときは
+            追記前のチャンクを指す（commit_fmp4_chunkで追記する）。
     """
+    if segment_format not in SEGMENT_FORMATS:
+        raise ValueError(f"Unknown segment format: {segment_format}")
     os.makedirs(output_dir, exist_ok=True)
 
-    bitrates = {
-        "low": max(100, base_bitrate // 3),
-        "medium": max(300, base_bitrate),
-        "high": max(600, base_bitrate * 3)
-    }
+    renditions = resolve_renditions(resolutions, base_bitrate, renditions)
+
+    for level, _, _, _ in renditions:
+        os.makedirs(os.path.join(output_dir, level), exist_ok=True)
+
+    if start_number is None and segment_db is not None:
+        # 入力の長さから使用する番号を見積もって予約する（超えた分は生成後に番号を進める）
+        duration = get_video_duration(input_file)
+        count = max(1, math.ceil(duration / segment_time - 1e-6)) if duration else 1
+        start = reserve_segment_numbers(output_dir, [level for level, _, _, _ in renditions], count)
+        start_numbers = {level: start for level, _, _, _ in renditions}
+    elif start_number is None:
+        start_numbers = {level: get_next_segment_index(output_dir, level) for level, _, _, _ in renditions}
+    else:
+        start_numbers = {level: start_number for level, _, _, _ in renditions}
+
+    # fMP4はチャンクごとにタイムスタンプが0から始まるため、プレイリストの続きの時刻にずらす
+    if segment_format == "fmp4" and ts_offset is None:
+        ts_offset = get_playlist(output_dir, renditions[0][0], playlist_type).total_duration
+
+    speeds = [] if stats is not None else None
+    # 全解像度のセグメント番号が揃っている場合のみ一括生成できる
+    if single_decode and len(set(start_numbers.values())) == 1:
+        segment_lists = _create_hls_single_decode(input_file, output_dir, renditions, segment_time,
+                                                  start_numbers, threads, preset, speeds, segment_format, ts_offset)
+    else:
+        segment_lists = _create_hls_per_level(input_file, output_dir, renditions, segment_time,
+                                              start_numbers, threads, preset, speeds, segment_format, ts_offset)
+    if stats is not None:
+        stats["speed"] = combine_speeds(speeds)
+
+    if write_playlists:
+        for level, entries in segment_lists.items():
+            if segment_format == "fmp4":
+                entries = commit_fmp4_chunk(output_dir, level, entries)
+            # セグメント番号を更新
+            if segment_db is not None:
+                set_segment_index(level, start_numbers[level] + len(entries), output_dir)
+            else:
+                update_segment_index(level, len(entries))
+
+            # m3u8ファイルに実測の長さで追記
+            append_to_m3u8(output_dir, level, entries, playlist_type)
 
-    for (width, height), (level, bitrate) in zip(resolutions, bitrates.items()):
+        # master.m3u8を生成
+        write_rendition_info(output_dir, renditions)
+        create_master_m3u8(output_dir, renditions)
+
+    return segment_lists
+
+def _run_ffmpeg(command, speeds=None):
+    """
+    FFmpegを実行する。speedsを指定した場合は-progressの出力から速度を読み取り、追加する。
+    """
+    if speeds is None:
+        subprocess.run(command, check=True)
+        return
+    result = subprocess.run(command[:1] + ["-progress", "pipe:1"] + command[1:], check=True,
+                            stdout=subprocess.PIPE, text=True)
+    speeds.append(parse_ffmpeg_speed(result.stdout))
+
+def _read_chunk_playlist(chunk_playlist_path):
+    """
+    FFmpegが出力した今回分のプレイリストを読み込み、削除する。
+    """
+    try:
+        return [
+            (uri, duration, byterange, map_uri) if byterange or map_uri else (uri, duration)
+            for uri, duration, byterange, map_uri in read_media_segments(chunk_playlist_path)
+        ]
+    finally:
+        if os.path.exists(chunk_playlist_path):
+            os.remove(chunk_playlist_path)
+
+def _segment_options(segment_pattern, segment_format, start_number, ts_offset, init_name):
+    """
+    セグメントの形式に応じたHLSマルチプレクサのオプションを返す。
+    fMP4の場合は初期化セグメントとチャンク全体を1ファイルに書き出させ、EXT-X-BYTERANGEで参照させる。
+    """
+    if segment_format != "fmp4":
+        return ["-hls_segment_filename", segment_pattern, "-start_number", str(start_number)]
+    return [
+        "-output_ts_offset", f"{ts_offset or 0:.6f}",
+        "-hls_segment_type", "fmp4",
+        "-hls_flags", "single_file",
+        "-hls_fmp4_init_filename", init_name,
+        "-hls_segment_filename", segment_pattern,
+    ]
+
+def _create_hls_single_decode(input_file, output_dir, renditions, segment_time, start_numbers, threads,
+                              preset=None, speeds=None, segment_format="ts", ts_offset=None):
+    """
+    入力を一度だけデコードし、split/scaleで全解像度に分岐させてHLSを1パスで生成。
+    全解像度でキーフレーム位置を揃えるため、シーンチェンジによるIフレーム挿入は無効化する。
+    FFmpegには今回分だけのプレイリストを出力させ、実測のセグメント長を読み出す。
+    """
+    count = len(renditions)
+    filters = [f"[0:v]split={count}" + "".join(f"[v{i}]" for i in range(count))]
+    for i, (_, width, height, _) in enumerate(renditions):
+        filters.append(f"[v{i}]scale={width}:{height}[v{i}out]")
+
+    command = [
+        "ffmpeg", "-y",
+        "-i", input_file,
+        "-filter_complex", ";".join(filters),
+    ]
+    for i in range(count):
+        command += ["-map", f"[v{i}out]"]
+    command += ["-an", "-c:v", "libx264"]
+    if preset:
+        command += ["-preset", preset]
+    if threads:
+        command += ["-threads", str(threads)]
+    for i, (_, _, _, bitrate) in enumerate(renditions):
+        command += [
+            f"-b:v:{i}", f"{bitrate}k",
+            f"-maxrate:v:{i}", f"{bitrate}k",
+            f"-bufsize:v:{i}", "2M",
+        ]
+
+    start_number = next(iter(start_numbers.values()))
+    if segment_format == "fmp4":
+        segment_pattern = os.path.join(output_dir, "%v", f"chunk-{start_number}.m4s").replace("\\", "/")
+    else:
+        segment_pattern = os.path.join(output_dir, "%v", "segment-%v-%03d.ts").replace("\\", "/")
+    playlist_path = os.path.join(output_dir, "%v", f"chunk-{start_number}.m3u8").replace("\\", "/")
+    stream_map = " ".join(f"v:{i},name:{level}" for i, (level, _, _, _) in enumerate(renditions))
+    command += [
+        "-g", str(30 * segment_time),
+        "-keyint_min", str(30 * segment_time),
+        "-sc_threshold", "0",
+        "-force_key_frames", f"expr:gte(t,n_forced*{segment_time})",
+        "-f", "hls",
+        "-hls_time", str(segment_time),
+        "-hls_playlist_type", "vod",
+        *_segment_options(segment_pattern, segment_format, start_number, ts_offset, f"chunk-{start_number}-init-%v.mp4"),
+        "-var_stream_map", stream_map,
+        playlist_path  # プレイリストの出力先 (%vは解像度名に置換される)
+    ]
+
+    segment_lists = {}
+    try:
+        _run_ffmpeg(command, speeds)
+        print(f"HLS segments created for {', '.join(f'{level} {width}x{height} {bitrate}k' for level, width, height, bitrate in renditions)}.")
+
+        for level, _, _, _ in renditions:
+            segment_lists[level] = _read_chunk_playlist(
+                os.path.join(output_dir, level, f"chunk-{start_number}.m3u8")
+            )
+
+    except subprocess.CalledProcessError as e:
+        print(f"Error during HLS creation: {e}")
+
+    return segment_lists
+
+def _create_hls_per_level(input_file, output_dir, renditions, segment_time, start_numbers, threads,
+                          preset=None, speeds=None, segment_format="ts", ts_offset=None):
+    """
+    解像度ごとに個別のFFmpegプロセスでHLSを生成。
+    """
+    segment_lists = {}
+    for level, width, height, bitrate in renditions:
         subdir = os.path.join(output_dir, level).replace("\\", "/")
-        os.makedirs(subdir, exist_ok=True)
 
-        next_index = get_next_segment_index(output_dir, level)
-        segment_pattern = os.path.join(subdir, f"segment-{level}-%03d.ts").replace("\\", "/")
-        playlist_path = os.path.join(subdir, f"{level}.m3u8").replace("\\", "/")
+        next_index = start_numbers[level]
+        if segment_format == "fmp4":
+            segment_pattern = os.path.join(subdir, f"chunk-{next_index}.m4s").replace("\\", "/")
+        else:
+            segment_pattern = os.path.join(subdir, f"segment-{level}-%03d.ts").replace("\\", "/")
+        playlist_path = os.path.join(subdir, f"chunk-{next_index}.m3u8").replace("\\", "/")
 
         command = [
-            "ffmpeg",
+            "ffmpeg", "-y",
             "-i", input_file,
             "-map", "0",
             "-an",
@@ -134,26 +511,96 @@ def create_hls_with_dynamic_bitrate(input_file, output_dir, resolutions, base_bi
             "-f", "hls",
             "-hls_time", str(segment_time),
             "-hls_playlist_type", "vod",
-            "-hls_segment_filename", segment_pattern,
-            "-start_number", str(next_index),
+            *_segment_options(segment_pattern, segment_format, next_index, ts_offset, f"chunk-{next_index}-init.mp4"),
             "-g", str(30 * segment_time),
             "-force_key_frames", f"expr:gte(t,n_forced*{segment_time})",
-            playlist_path  # プレイリストの出力先
         ]
+        if preset:
+            command += ["-preset", preset]
+        if threads:
+            command += ["-threads", str(threads)]
+        command.append(playlist_path)  # プレイリストの出力先
 
         try:
-            subprocess.run(command, check=True)
+            _run_ffmpeg(command, speeds)
             print(f"HLS segments created for resolution {width}x{height}, bitrate {bitrate}k.")
 
-            # セグメント番号を更新
-            update_segment_index(level, 3)
-
-            # m3u8ファイルを全セグメントで書き直し
-            append_to_m3u8(output_dir, level, target_duration=segment_time)
+            segment_lists[level] = _read_chunk_playlist(playlist_path)
 
         except subprocess.CalledProcessError as e:
             print(f"Error during HLS creation for {level}: {e}")
 
-    # master.m3u8を生成
-    create_master_m3u8(output_dir)
+    return segment_lists
+
+def _current_init(level_dir):
+    """
+    解像度のディレクトリで現在使用している初期化セグメントの名前と内容を返す。ない場合は (None, None)。
+    """
+    if level_dir not in fmp4_inits:
+        names = sorted(
+            (f for f in os.listdir(level_dir) if f == "init.mp4" or (f.startswith("init-") and f.endswith(".mp4"))),
+            key=lambda name: int(name[len("init-"):-len(".mp4")]) if name != "init.mp4" else 0
+        )
+        if names:
+            with open(os.path.join(level_dir, names[-1]), "rb") as f:
+                fmp4_inits[level_dir] = (names[-1], f.read())
+        else:
+            fmp4_inits[level_dir] = (None, None)
+    return fmp4_inits[level_dir]
+
+def _commit_init(level_dir, chunk_init_path):
+    """
+    チャンクの初期化セグメントが現在のものと同じであれば再利用し、異なれば新しい名前で保存する。
+    （エンコード設定が変わってSPS/PPSが変わった場合のみ、プレイリストに新しいEXT-X-MAPが入る）
+
+    Returns:
+        str: 使用する初期化セグメントの名前。
+    """
+    current_name, current_body = _current_init(level_dir)
+    with open(chunk_init_path, "rb") as f:
+        body = f.read()
+    if body == current_body:
+        os.remove(chunk_init_path)
+        return current_name
+
+    if current_name is None:
+        name = "init.mp4"
+    else:
+        number = 0 if current_name == "init.mp4" else int(current_name[len("init-"):-len(".mp4")])
+        name = f"init-{number + 1}.mp4"
+    os.replace(chunk_init_path, os.path.join(level_dir, name))
+    fmp4_inits[level_dir] = (name, body)
+    return name
+
+def commit_fmp4_chunk(output_dir, level, entries):
+    """
+    FFmpegが出力したfMP4のチャンクを解像度ごとの単一ファイルに追記し、プレイリスト用のエントリに変換する。
+    チャンクは再生順に1つずつ追記すること。公開済みの範囲は書き換えないため、配信中でも安全に追記できる。
+
+    Args:
+        output_dir (str): HLSの出力ディレクトリ。
+        level (str): 解像度名。
+        entries (list): チャンクを指す (uri, duration, byterange, map_uri) のリスト。
+
+    Returns:
+        list: <level>.cmfv内の範囲を指す (uri, duration, byterange, map_uri) のリスト。
+    """
+    level_dir = os.path.join(output_dir, level)
+    media_name = f"{level}{FMP4_MEDIA_EXTENSION}"
+    media_path = os.path.join(level_dir, media_name)
 
+    committed = []
+    chunks = {}  # チャンクのURI -> (追記した位置, 初期化セグメント名)
+    for uri, duration, byterange, map_uri in entries:
+        if uri not in chunks:
+            chunk_path = os.path.join(level_dir, uri)
+            base_offset = os.path.getsize(media_path) if os.path.exists(media_path) else 0
+            with open(chunk_path, "rb") as src, open(media_path, "ab") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.remove(chunk_path)
+            init_name = _commit_init(level_dir, os.path.join(level_dir, map_uri)) if map_uri else None
+            chunks[uri] = (base_offset, init_name)
+        base_offset, init_name = chunks[uri]
+        length, offset = byterange
+        committed.append((media_name, duration, (length, base_offset + offset), init_name))
+    return committed
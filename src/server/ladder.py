@@ -0,0 +1,144 @@
+"""
+タイトルごとのビットレートラダー（per-title encoding）を求めるモジュール。
+
+入力動画を低解像度のプロキシとして固定品質(CRF)で高速にエンコードし、そのビットレートを
+映像の複雑さの指標とする。同じ品質に必要なビットレートは画素数のおよそ0.75乗に比例するとみなし、
+各解像度で必要なビットレートを推定して、レンディションごとの解像度とビットレートを選ぶ。
+
+・動きや細部の少ない映像: 高い解像度でも必要なビットレートが低いため、ビットレートを上限まで使わない。
+・複雑な映像: 目標ビットレートに見合う解像度まで下げ、ブロックノイズや再生停止を避ける。
+"""
+
+import math
+import os
+import subprocess
+import tempfile
+from src.server.media_probe import probe_media
+
+LEVELS = ("low", "medium", "high")
+CANDIDATE_RESOLUTIONS = [(426, 240), (640, 360), (854, 480), (1280, 720), (1920, 1080)]
+
+
+def analyze_complexity(input_file, proxy_height=180, crf=23, preset="veryfast", analysis_seconds=None):
+    """
+    入力動画を低解像度・固定品質でエンコードし、複雑さの指標を求める。
+
+    Args:
+        input_file (str): 入力動画のパス。
+        proxy_height (int): プロキシの高さ（幅はアスペクト比を維持）。
+        crf (int): プロキシのCRF（品質）。
+        preset (str): プロキシのx264プリセット。
+        analysis_seconds (float): 解析する長さ（秒）。Noneの場合は全体。
+
+    Returns:
+        dict: proxy_kbps（プロキシのビットレート）, proxy_pixels（プロキシの画素数）。失敗した場合はNone。
+    """
+    with tempfile.TemporaryDirectory(prefix="ladder-") as temp_dir:
+        proxy_path = os.path.join(temp_dir, "proxy.mp4")
+        command = ["ffmpeg", "-y", "-loglevel", "error", "-i", input_file]
+        if analysis_seconds:
+            command += ["-t", str(analysis_seconds)]
+        command += [
+            "-an", "-vf", f"scale=-2:{proxy_height}",
+            "-c:v", "libx264", "-preset", preset, "-crf", str(crf),
+            proxy_path
+        ]
+        try:
+            subprocess.run(command, capture_output=True, check=True)
+        except subprocess.CalledProcessError as e:
+            print(f"Error analyzing complexity: {e}")
+            return None
+
+        # 一時ファイルなので永続キャッシュには保存しない
+        info = probe_media(proxy_path, persistent=False)
+        if not info or not info["duration"] or not info["width"] or not info["height"]:
+            return None
+        return {
+            "proxy_kbps": os.path.getsize(proxy_path) * 8 / info["duration"] / 1000,
+            "proxy_pixels": info["width"] * info["height"],
+        }
+
+
+def per_title_ladder(complexity, min_kbps=150, max_kbps=6000, candidates=None, exponent=0.75,
+                     quality_factor=1.0, levels=LEVELS):
+    """
+    複雑さの指標からレンディションの解像度とビットレートを選ぶ。
+
+    最も高いレベルは、max_kbps以下で必要なビットレートを満たす最大の解像度とし、
+    その解像度に必要なビットレートがmax_kbpsより低ければそこで止める（余分なビットを使わない）。
+    残りのレベルは、最も高いレベルのビットレートまでの等比数列を目標とし、同じ方法で解像度を選ぶ。
+
+    Args:
+        complexity (dict): analyze_complexityの結果。
+        min_kbps (int): 最も低いレベルの目標ビットレート（kbps）。
+        max_kbps (int): 最も高いレベルのビットレートの上限（kbps）。
+        candidates (list): 選択できる解像度 (width, height) のリスト。
+        exponent (float): 必要なビットレートと画素数の関係の指数。
+        quality_factor (float): 必要なビットレートに掛ける係数（プロキシとの画質の差の補正）。
+        levels (tuple): レベル名（低い順）。
+
+    Returns:
+        list: (level, width, height, kbps) のリスト。
+    """
+    candidates = sorted(candidates or CANDIDATE_RESOLUTIONS, key=lambda size: size[0] * size[1])
+    scale = complexity["proxy_kbps"] * quality_factor / complexity["proxy_pixels"] ** exponent
+
+    def required_kbps(size):
+        return scale * (size[0] * size[1]) ** exponent
+
+    def pick(target):
+        fitting = [size for size in candidates if required_kbps(size) <= target]
+        size = fitting[-1] if fitting else candidates[0]
+        return size, min(target, required_kbps(size)) if fitting else target
+
+    top_size, top_kbps = pick(max_kbps)
+    low_kbps = min(min_kbps, top_kbps / 4)
+    count = len(levels)
+    renditions = []
+    for i, level in enumerate(levels):
+        if i == count - 1:
+            size, kbps = top_size, top_kbps
+        else:
+            target = low_kbps * (top_kbps / low_kbps) ** (i / (count - 1))
+            size, kbps = pick(target)
+        renditions.append((level, size[0], size[1], max(1, int(math.ceil(kbps)))))
+    return renditions
+
+
+def build_ladder(input_file, ladder_config):
+    """
+    設定に従ってレンディションの一覧を求める。
+
+    Args:
+        input_file (str): 解析する動画（H.264に圧縮した動画全体）。
+        ladder_config (dict): config.jsonの"ladder"。
+
+    Returns:
+        list: (level, width, height, kbps) のリスト。固定のラダーを使う場合や解析に失敗した場合はNone。
+    """
+    if ladder_config.get("mode", "fixed") != "per-title":
+        return None
+    if not os.path.exists(input_file):
+        print(f"Per-title ladder skipped: {input_file} does not exist.")
+        return None
+
+    complexity = analyze_complexity(
+        input_file,
+        proxy_height=ladder_config.get("proxy_height", 180),
+        crf=ladder_config.get("crf", 23),
+        analysis_seconds=ladder_config.get("analysis_seconds")
+    )
+    if complexity is None:
+        return None
+
+    renditions = per_title_ladder(
+        complexity,
+        min_kbps=ladder_config.get("min_kbps", 150),
+        max_kbps=ladder_config.get("max_kbps", 6000),
+        candidates=[tuple(size) for size in ladder_config.get("candidates", CANDIDATE_RESOLUTIONS)],
+        exponent=ladder_config.get("exponent", 0.75),
+        quality_factor=ladder_config.get("quality_factor", 1.0)
+    )
+    print(f"Per-title ladder (proxy {complexity['proxy_kbps']:.0f} kbps): "
+          + ", ".join(f"{level} {width}x{height} {kbps}k" for level, width, height, kbps in renditions))
+    return renditions
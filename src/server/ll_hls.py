@@ -0,0 +1,395 @@
+"""
+Low-Latency HLS (LL-HLS) 出力モジュール。
+
+フレームを標準入力経由で1つのFFmpegに渡し、全解像度の短いパーシャルセグメント(.ts)を
+エンコードされた順に出力する。パーシャルセグメントが完成するたびにEXT-X-PARTとして
+プレイリストに公開し、parts_per_segment個そろった時点で連結して通常のセグメントにする。
+プレイヤーはEXT-X-PRELOAD-HINTとブロッキングリロード(_HLS_msn/_HLS_part)で
+次のパーシャルセグメントを待ち受けるため、30秒のチャンクがそろうのを待つ必要がない。
+
+セグメントとパーシャルセグメントの番号は出力ディレクトリの既存のファイルの続きから始めるため、
+前のセッションのファイル（プレイヤーやキャッシュが参照している可能性がある）を上書きしない。
+"""
+
+import csv
+import math
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+from src.server.hls_server import (
+    create_master_m3u8, get_next_segment_index, resolve_renditions, segment_number, set_segment_index,
+    write_rendition_info
+)
+from src.server.playlist import write_atomic
+
+
+class LowLatencyPlaylist:
+    def __init__(self, path, part_target, playlist_type="EVENT", part_segments=3):
+        """
+        Args:
+            path (str): 書き出すm3u8ファイルのパス。
+            part_target (float): パーシャルセグメントの目標長（秒）。EXT-X-PART-INFに記載する。
+            playlist_type (str): "EVENT"、またはNone（ライブ）。
+            part_segments (int): EXT-X-PARTを残す直近のセグメント数。
+        """
+        self.path = path
+        self.part_target = part_target
+        self.playlist_type = playlist_type
+        self.part_segments = part_segments
+        self.media_sequence = 0
+        self.target_duration = 1
+        self.segments = []  # (uri, duration, parts)
+        self.current_parts = []  # 作成中のセグメントのパーシャル (uri, duration)
+        self.preload_hint = None
+        self.ended = False
+
+    def add_part(self, uri, duration, next_uri=None):
+        """
+        完成したパーシャルセグメントを追加する。
+
+        Args:
+            uri (str): パーシャルセグメントのURI。
+            duration (float): 長さ（秒）。
+            next_uri (str): 次に出力されるパーシャルセグメントのURI（プリロードヒント）。
+        """
+        self.current_parts.append((uri, duration))
+        self.preload_hint = next_uri
+
+    def complete_segment(self, uri):
+        """
+        作成中のパーシャルセグメントをまとめて1つのセグメントとして確定する。
+
+        Returns:
+            float: セグメントの長さ（秒）。
+        """
+        duration = sum(part_duration for _, part_duration in self.current_parts)
+        self.segments.append((uri, duration, self.current_parts))
+        self.current_parts = []
+        self.target_duration = max(self.target_duration, math.ceil(duration))
+        return duration
+
+    def end(self):
+        self.ended = True
+        self.preload_hint = None
+        self.write()
+
+    def render(self):
+        lines = [
+            "#EXTM3U\n",
+            "#EXT-X-VERSION:6\n",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}\n",
+            f"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={self.part_target * 3:.3f}\n",
+            f"#EXT-X-PART-INF:PART-TARGET={self.part_target:.3f}\n",
+            f"#EXT-X-MEDIA-SEQUENCE:{self.media_sequence}\n",
+        ]
+        if self.playlist_type:
+            lines.append(f"#EXT-X-PLAYLIST-TYPE:{self.playlist_type}\n")
+
+        # 直近のセグメントのみパーシャルセグメントを列挙する
+        first_with_parts = len(self.segments) - self.part_segments
+        for index, (uri, duration, parts) in enumerate(self.segments):
+            if index >= first_with_parts:
+                for part_uri, part_duration in parts:
+                    lines.append(f'#EXT-X-PART:DURATION={part_duration:.5f},URI="{part_uri}",INDEPENDENT=YES\n')
+            lines.append(f"#EXTINF:{duration:.6f},\n{uri}\n")
+        for part_uri, part_duration in self.current_parts:
+            lines.append(f'#EXT-X-PART:DURATION={part_duration:.5f},URI="{part_uri}",INDEPENDENT=YES\n')
+
+        if self.ended:
+            lines.append("#EXT-X-ENDLIST\n")
+        elif self.preload_hint:
+            lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="{self.preload_hint}"\n')
+        return "".join(lines)
+
+    def write(self):
+        write_atomic(self.path, self.render())
+
+
+def playlist_edge(text):
+    """
+    LL-HLSプレイリストの最新位置を求める（ブロッキングリロードの判定用）。
+
+    Args:
+        text (str): m3u8の内容。
+
+    Returns:
+        tuple: (作成中セグメントのメディアシーケンス番号, 公開済みのパーシャル数, ENDLISTの有無)
+    """
+    media_sequence = 0
+    completed = 0
+    trailing_parts = 0
+    ended = False
+    for line in text.splitlines():
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            media_sequence = int(line.split(":")[1])
+        elif line.startswith("#EXTINF:"):
+            completed += 1
+            trailing_parts = 0
+        elif line.startswith("#EXT-X-PART:"):
+            trailing_parts += 1
+        elif line.startswith("#EXT-X-ENDLIST"):
+            ended = True
+    # 確定済みセグメントのパーシャルはEXTINFの前に並ぶため、EXTINFで数え直している
+    return media_sequence + completed, trailing_parts, ended
+
+
+def playlist_satisfies(text, msn, part=None):
+    """
+    プレイリストが _HLS_msn/_HLS_part で要求された位置を含んでいるかを判定する。
+    """
+    current_msn, published_parts, ended = playlist_edge(text)
+    if ended or msn < current_msn:
+        return True
+    if msn > current_msn:
+        return False
+    return (part or 0) < published_parts
+
+
+def part_published(text, part_uri):
+    """
+    パーシャルセグメントが書き込みを終えて公開済みかを判定する（プリロードヒントで要求された場合の待機用）。
+
+    Args:
+        text (str): 解像度のm3u8の内容。
+        part_uri (str): パーシャルセグメントのURI (part-<level>-<番号>.ts)。
+    """
+    hint = None
+    for line in text.splitlines():
+        if line.startswith("#EXT-X-ENDLIST"):
+            return True
+        if line.startswith("#EXT-X-PART:") and f'URI="{part_uri}"' in line:
+            return True
+        if line.startswith("#EXT-X-PRELOAD-HINT:") and 'URI="' in line:
+            hint = line.split('URI="', 1)[1].split('"', 1)[0]
+    # プレイリストから外れた古いパーシャルは、プリロードヒントより前の番号であれば完成している
+    return hint is not None and segment_number(part_uri) < segment_number(hint)
+
+
+def next_part_number(level_dir, level):
+    """
+    前のセッションのパーシャルセグメントの続きの番号を返す。
+    """
+    numbers = [
+        segment_number(f) for f in os.listdir(level_dir)
+        if f.startswith(f"part-{level}-") and f.endswith(".ts")
+    ]
+    return max(numbers) + 1 if numbers else 0
+
+
+class LowLatencyHLSSession:
+    """
+    フレームを受け取りながらLL-HLSのパーシャルセグメントとプレイリストを公開するセッション。
+    """
+
+    def __init__(self, output_dir, resolutions, base_bitrate, width, height, fps,
+                 part_duration=1.0, parts_per_segment=4, preset="veryfast", playlist_type="EVENT", renditions=None):
+        """
+        Args:
+            output_dir (str): HLSの出力ディレクトリ。
+            resolutions (list): 解像度のリスト (width, height)。
+            base_bitrate (int): 元動画の総ビットレート（kbps）。
+            width (int): 入力フレームの幅。
+            height (int): 入力フレームの高さ。
+            fps (int): 動画のフレームレート。
+            part_duration (float): パーシャルセグメントの長さ（秒）。
+            parts_per_segment (int): 1セグメントを構成するパーシャルセグメントの数。
+            preset (str): x264のプリセット。
+            playlist_type (str): "EVENT"、またはNone（ライブ）。
+            renditions (list): (level, width, height, kbps) のリスト（タイトルごとのラダー）。
+        """
+        self.output_dir = output_dir
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.part_duration = part_duration
+        self.parts_per_segment = parts_per_segment
+        self.frame_count = 0
+        self.frame_times = deque()  # 未公開フレームの取り込み時刻
+        self.first_pending_frame = 0
+        self.publish_latencies = []
+        self.lock = threading.Lock()
+
+        self.renditions = resolve_renditions(resolutions, base_bitrate, renditions)
+        for level, _, _, _ in self.renditions:
+            os.makedirs(os.path.join(output_dir, level), exist_ok=True)
+        # 既存のセグメントの続きから番号を付ける（全解像度でそろえる）
+        start_sequence = max(get_next_segment_index(output_dir, level) for level, _, _, _ in self.renditions)
+        self.part_starts = {}
+        self.playlists = {}
+        self.part_lists = {}
+        for level, _, _, _ in self.renditions:
+            self.part_starts[level] = next_part_number(os.path.join(output_dir, level), level)
+            self.playlists[level] = LowLatencyPlaylist(
+                os.path.join(output_dir, level, f"{level}.m3u8"), part_duration, playlist_type
+            )
+            self.playlists[level].media_sequence = start_sequence
+            self.part_lists[level] = os.path.join(output_dir, level, "parts.csv")
+            if os.path.exists(self.part_lists[level]):
+                os.remove(self.part_lists[level])
+
+        self.process = subprocess.Popen(self._build_command(preset), stdin=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        write_rendition_info(output_dir, self.renditions)
+        create_master_m3u8(output_dir, self.renditions)
+
+        self.running = True
+        self.publisher = threading.Thread(target=self._publish_loop, daemon=True)
+        self.publisher.start()
+
+    def _build_command(self, preset):
+        count = len(self.renditions)
+        filters = [f"[0:v]split={count}" + "".join(f"[v{i}]" for i in range(count))]
+        for i, (_, width, height, _) in enumerate(self.renditions):
+            filters.append(f"[v{i}]scale={width}:{height}[v{i}out]")
+
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24",
+            "-s", f"{self.width}x{self.height}", "-r", str(self.fps),
+            "-i", "-",
+            "-filter_complex", ";".join(filters),
+        ]
+        part_frames = max(1, round(self.part_duration * self.fps))
+        for i, (level, _, _, bitrate) in enumerate(self.renditions):
+            subdir = os.path.join(self.output_dir, level).replace("\\", "/")
+            command += [
+                "-map", f"[v{i}out]",
+                "-c:v", "libx264", "-preset", preset, "-tune", "zerolatency",
+                "-pix_fmt", "yuv420p",
+                "-b:v", f"{bitrate}k", "-maxrate", f"{bitrate}k", "-bufsize", f"{bitrate}k",
+                # パーシャルセグメントを単独でデコードできるよう、先頭を必ずキーフレームにする
+                "-g", str(part_frames), "-keyint_min", str(part_frames), "-sc_threshold", "0",
+                "-force_key_frames", f"expr:gte(t,n_forced*{self.part_duration})",
+                "-f", "segment",
+                "-segment_time", str(self.part_duration),
+                "-segment_format", "mpegts",
+                "-segment_list", self.part_lists[level].replace("\\", "/"),
+                "-segment_list_type", "csv",
+                "-segment_start_number", str(self.part_starts[level]),
+                "-reset_timestamps", "0",
+                f"{subdir}/part-{level}-%05d.ts",
+            ]
+        return command
+
+    def write(self, frame):
+        """
+        フレームをエンコーダに渡す。
+
+        Args:
+            frame (np.ndarray): BGR形式のフレーム (height, width, 3)。
+        """
+        with self.lock:
+            self.frame_times.append(time.time())
+        self.process.stdin.write(memoryview(frame).cast("B") if frame.flags.c_contiguous else frame.tobytes())
+        self.frame_count += 1
+
+    def _publish_loop(self):
+        """
+        FFmpegのセグメントリスト(csv)を監視し、完成したパーシャルセグメントを公開する。
+        """
+        offsets = {level: 0 for level in self.part_lists}
+        part_counts = dict(self.part_starts)
+        while True:
+            finished = not self.running
+            for level, list_path in self.part_lists.items():
+                if not os.path.exists(list_path):
+                    continue
+                with open(list_path, "rb") as f:
+                    f.seek(offsets[level])
+                    chunk = f.read()
+                # 書き込み途中の行は次回に回す
+                complete = chunk[:chunk.rfind(b"\n") + 1]
+                offsets[level] += len(complete)
+                for row in csv.reader(complete.decode().splitlines()):
+                    if len(row) >= 3:
+                        self._publish_part(level, row[0], float(row[1]), float(row[2]), part_counts[level])
+                        part_counts[level] += 1
+            if finished:
+                break
+            time.sleep(0.02)
+
+    def _publish_part(self, level, part_uri, start, end, part_index):
+        playlist = self.playlists[level]
+        next_uri = f"part-{level}-{part_index + 1:05d}.ts"
+        playlist.add_part(part_uri, end - start, next_uri)
+
+        # parts_per_segment個そろったら連結してセグメントを確定
+        if len(playlist.current_parts) >= self.parts_per_segment:
+            sequence = playlist.media_sequence + len(playlist.segments)
+            segment_uri = f"segment-{level}-{sequence:05d}.ts"
+            self._concat_parts(level, playlist.current_parts, segment_uri)
+            playlist.complete_segment(segment_uri)
+            playlist.write()
+            # 全解像度のセグメントがそろったら実測の帯域幅でmaster.m3u8を更新する
+            if level == self.renditions[-1][0]:
+                create_master_m3u8(self.output_dir, self.renditions)
+        else:
+            playlist.write()
+
+        # 最も低い解像度の公開時刻でフレーム取り込みからの遅延を記録する
+        if level == self.renditions[0][0]:
+            self._record_latency(start, end)
+
+    def _concat_parts(self, level, parts, segment_uri):
+        subdir = os.path.join(self.output_dir, level)
+        temp_path = os.path.join(subdir, f".{segment_uri}.tmp")
+        with open(temp_path, "wb") as out:
+            for part_uri, _ in parts:
+                with open(os.path.join(subdir, part_uri), "rb") as part:
+                    out.write(part.read())
+        os.replace(temp_path, os.path.join(subdir, segment_uri))
+
+    def _record_latency(self, start, end):
+        now = time.time()
+        first_frame = round(start * self.fps)
+        last_frame = round(end * self.fps)
+        with self.lock:
+            ingest_time = None
+            while self.frame_times and self.first_pending_frame < last_frame:
+                if self.first_pending_frame == first_frame:
+                    ingest_time = self.frame_times[0]
+                self.frame_times.popleft()
+                self.first_pending_frame += 1
+        if ingest_time is not None:
+            self.publish_latencies.append(now - ingest_time)
+
+    def close(self):
+        """
+        エンコードを終了し、残りのパーシャルセグメントを公開してプレイリストを完結させる。
+        """
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.running = False
+        self.publisher.join()
+
+        for level, playlist in self.playlists.items():
+            # 端数のパーシャルセグメントを最後のセグメントにまとめる
+            if playlist.current_parts:
+                sequence = playlist.media_sequence + len(playlist.segments)
+                segment_uri = f"segment-{level}-{sequence:05d}.ts"
+                self._concat_parts(level, playlist.current_parts, segment_uri)
+                playlist.complete_segment(segment_uri)
+            playlist.end()
+            # 次のセッションやパッケージャがこのセッションの番号を再利用しないようにする
+            set_segment_index(level, playlist.media_sequence + len(playlist.segments), self.output_dir)
+        create_master_m3u8(self.output_dir, self.renditions)
+
+        report_publish_latency("LL-HLS", self.publish_latencies)
+
+
+def report_publish_latency(mode, latencies):
+    """
+    フレームを取り込んでからプレイリストに公開されるまでの遅延を表示する。
+    """
+    if not latencies:
+        return
+    ordered = sorted(latencies)
+    p50 = ordered[len(ordered) // 2]
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"[{mode}] publish latency: p50={p50:.2f}s p95={p95:.2f}s max={ordered[-1]:.2f}s "
+          f"({len(ordered)} samples)")
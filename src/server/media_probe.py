@@ -0,0 +1,203 @@
+"""
+動画ファイルの情報を1回のffprobeで取得し、永続的にキャッシュするモジュール。
+
+フレーム数・ビットレート・解像度・フレームレート・長さ・キーフレームの時刻をまとめて読み出す。
+結果は「絶対パス・サイズ・更新時刻(ns)」をキーとして cache_dir/<key>.json に保存するため、
+同じファイルは実行をまたいでも、ワーカープロセスからでも二度probeされない。
+ファイルが書き換えられるとサイズか更新時刻が変わり、キーが変わるので古い結果は使われない。
+リアルタイム配信ではセグメントごとにエントリが増えるため、メモリとディスクのキャッシュは
+それぞれPROBE_CACHE_MAX_ENTRIES件までとし、使われていないものから削除する。
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import uuid
+from collections import OrderedDict
+
+PROBE_CACHE_DIR = "cache/probe"
+PROBE_VERSION = 1  # 保存する項目を変えた場合に古いキャッシュを無効にする
+PROBE_CACHE_MAX_ENTRIES = 4096
+
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def _parse_rate(value):
+    """
+    "30000/1001" のような分数表記をfloatにする。
+    """
+    try:
+        numerator, _, denominator = str(value).partition("/")
+        rate = float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return rate if rate > 0 else None
+
+
+def _parse_number(value, cast=float):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _cache_key(path, stat):
+    text = f"{PROBE_VERSION}|{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _run_ffprobe(path):
+    """
+    ストリーム・フォーマット・パケット（デコードなし）の情報を1回のffprobeで読み出す。
+    """
+    command = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries",
+        "stream=codec_name,width,height,avg_frame_rate,r_frame_rate,nb_frames,bit_rate,duration"
+        ":format=duration,bit_rate:packet=pts_time,flags",
+        "-of", "json",
+        path
+    ]
+    result = subprocess.run(command, capture_output=True, text=True, check=True)
+    data = json.loads(result.stdout)
+    if not data.get("streams"):
+        raise ValueError(f"No video stream in {path}")
+    stream = data["streams"][0]
+    container = data.get("format", {})
+    packets = data.get("packets", [])
+
+    fps = _parse_rate(stream.get("avg_frame_rate")) or _parse_rate(stream.get("r_frame_rate"))
+    duration = _parse_number(container.get("duration")) or _parse_number(stream.get("duration"))
+
+    # nb_framesがないコンテナ(mkv/webmなど)ではパケット数を使う
+    frame_count = _parse_number(stream.get("nb_frames"), int)
+    if not frame_count:
+        frame_count = len(packets) or (round(duration * fps) if duration and fps else None)
+
+    bitrate = _parse_number(stream.get("bit_rate"), int) or _parse_number(container.get("bit_rate"), int)
+    if not bitrate and duration:
+        bitrate = int(os.path.getsize(path) * 8 / duration)
+
+    keyframes = sorted(
+        float(packet["pts_time"]) for packet in packets
+        if "K" in packet.get("flags", "") and packet.get("pts_time") not in (None, "", "N/A")
+    )
+    return {
+        "codec": stream.get("codec_name"),
+        "width": _parse_number(stream.get("width"), int),
+        "height": _parse_number(stream.get("height"), int),
+        "fps": fps,
+        "frame_count": frame_count,
+        "bitrate": bitrate // 1000 if bitrate else None,  # kbps
+        "duration": duration,
+        "keyframes": keyframes,
+    }
+
+
+def probe_media(path, persistent=True, cache_dir=PROBE_CACHE_DIR):
+    """
+    動画ファイルの情報を返す。キャッシュにあればffprobeを実行しない。
+
+    Args:
+        path (str): 動画ファイルのパス。
+        persistent (bool): Falseの場合はディスクのキャッシュを使わない（一時ファイル用）。
+        cache_dir (str): キャッシュを保存するディレクトリ。
+
+    Returns:
+        dict: codec, width, height, fps, frame_count, bitrate(kbps), duration(秒), keyframes(秒のリスト)。
+            ファイルが存在しない、またはprobeに失敗した場合はNone。
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        print(f"Error probing {path}: {e}")
+        return None
+    key = _cache_key(path, stat)
+
+    with _memory_lock:
+        if key in _memory_cache:
+            _memory_cache.move_to_end(key)
+            return _memory_cache[key]
+
+    cache_path = os.path.join(cache_dir, f"{key}.json")
+    info = None
+    if persistent:
+        try:
+            with open(cache_path, "r") as f:
+                info = json.load(f)
+            # 更新時刻を最終使用時刻とする (LRU)
+            os.utime(cache_path)
+        except (OSError, ValueError):
+            info = None
+
+    if info is None:
+        try:
+            info = _run_ffprobe(path)
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            print(f"Error probing {path}: {e}")
+            return None
+        if persistent:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                # 複数のプロセスが同時に書き込んでも壊れないよう、一時ファイルからリネームする
+                temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+                with open(temp_path, "w") as f:
+                    json.dump(info, f)
+                os.replace(temp_path, cache_path)
+                _prune_cache_dir(cache_dir)
+            except OSError as e:
+                print(f"Error writing probe cache: {e}")
+
+    with _memory_lock:
+        _memory_cache[key] = info
+        while len(_memory_cache) > PROBE_CACHE_MAX_ENTRIES:
+            _memory_cache.popitem(last=False)
+    return info
+
+
+def _prune_cache_dir(cache_dir, max_entries=PROBE_CACHE_MAX_ENTRIES):
+    """
+    キャッシュのファイル数がmax_entriesを超えている場合、最終使用時刻の古いものから削除する。
+    """
+    names = [name for name in os.listdir(cache_dir) if name.endswith(".json")]
+    if len(names) <= max_entries:
+        return
+    entries = []
+    for name in names:
+        try:
+            entries.append((os.path.getmtime(os.path.join(cache_dir, name)), name))
+        except OSError:
+            pass
+    entries.sort()
+    for _, name in entries[:len(entries) - max_entries]:
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+
+
+def get_video_bitrate(input_file):
+    """
+    動画のビットレート（kbps）を取得する。ストリームにない場合はコンテナの値、
+    それもない場合はファイルサイズと長さから求める。
+
+    Returns:
+        int: ビットレート（kbps）。取得できない場合はNone。
+    """
+    info = probe_media(input_file)
+    return info["bitrate"] if info else None
+
+
+def get_video_duration(input_file):
+    """
+    動画の長さ（秒）を取得する。
+
+    Returns:
+        float: 長さ（秒）。取得できない場合はNone。
+    """
+    info = probe_media(input_file)
+    return info["duration"] if info else None
@@ -1,45 +1,175 @@
-import cv2
+import bisect
+import math
 import os
 import subprocess
 import traceback
-from src.server.hls_server import get_video_bitrate
-from src.client.playback.logger import VideoLogger
-from src.bar_making import ProgressBar
+from src.server.media_probe import get_video_bitrate, probe_media
+from src.server.encoder_session import EncoderSession
+from src.server.encode_cache import remove_if_exists
     
-frame_buffer = []
+encoder_session = None
 segment_index = 0
 
-def mp4_create(input_video, input_frame, res_path, window_width, window_height):
-    cap = cv2.VideoCapture(res_path)
-    gaze_log = VideoLogger(log_dir="logs/gaze_prediction")
-    progress_bar = ProgressBar(input_frame=input_frame)
-
-    window_width = window_width
-    window_height = window_height
+def mp4_create(input_video, input_frame, res_path, window_width, window_height, cache=None, segment_mode="copy",
+               max_buffer_bytes=256 * 1024 ** 2, segment_db=None):
+    """
+    H.264に圧縮した動画を30秒ごとのMP4セグメントに分割します。
 
+    Args:
+        input_video (str): 入力動画のパス。
+        input_frame (int): 入力動画の総フレーム数。
+        res_path (str): H.264に圧縮した動画のパス。
+        window_width (int): 動画の幅。
+        window_height (int): 動画の高さ。
+        cache (EncodeCache): エンコード結果のキャッシュ。
+        segment_mode (str): "copy"の場合はキーフレーム位置でストリームコピーにより分割し、
+            キーフレームに合わない区間のみ再エンコードする。"encode"の場合は全フレームをデコードして再エンコードする。
+        max_buffer_bytes (int): "encode"の場合にデコード済みフレームを保持するメモリの上限（バイト）。
+        segment_db (SegmentIndex): 作成したセグメントを記録するインデックス（HLS化の際に走査とprobeを省く）。
+    """
     segment_dir = os.path.abspath("segments/segmented_video")
     os.makedirs(segment_dir, exist_ok=True)
 
     fps = 30
-    frame_counter = 0
-
     video_bitrate = get_video_bitrate(res_path)
-    while frame_counter < input_frame:
-        ret, frame = cap.read()
 
-        if not (ret):
-            break
+    # 前回のセグメントを削除（キャッシュと共有しているinodeを上書きしないため）
+    for f in os.listdir(segment_dir):
+        if f.startswith("segment_") and f.endswith(".mp4"):
+            remove_if_exists(os.path.join(segment_dir, f))
+    if segment_db is not None:
+        segment_db.clear_source_segments(segment_dir)
+
+    # キャッシュを確認
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key([res_path], {
+            "stage": "segment", "input_frame": input_frame, "fps": fps, "segment_seconds": 30,
+            "video_bitrate": video_bitrate, "preset": "fast", "segment_mode": segment_mode
+        })
+        cache_hit = cache.fetch(cache_key, segment_dir) is not None
+        if cache_hit:
+            print(f"Encode cache hit: {segment_dir}")
+    else:
+        cache_hit = False
+
+    if not cache_hit:
+        if segment_mode == "copy":
+            mp4_create_stream_copy(res_path, video_bitrate, fps, segment_dir)
+        else:
+            mp4_create_decoded(input_frame, res_path, video_bitrate, fps, segment_dir, max_buffer_bytes)
+
+    segment_paths = sorted(
+        os.path.join(segment_dir, f) for f in os.listdir(segment_dir)
+        if f.startswith("segment_") and f.endswith(".mp4")
+    )
+    if cache is not None and not cache_hit:
+        cache.store(cache_key, segment_paths)
+    if segment_db is not None:
+        segment_db.record_source_segments(segment_dir, segment_paths)
+
+def mp4_create_decoded(input_frame, res_path, video_bitrate, fps, segment_dir, max_buffer_bytes=256 * 1024 ** 2):
+    """
+    全フレームをデコードし、エンコーダセッションで再エンコードしながら分割します。
+    """
+    # デコードに必要なモジュールはこのモードでのみimportする（ストリームコピーでは不要）
+    import cv2
+    from src.server.frame_ring import pump_frames
+    from src.client.playback.logger import VideoLogger
+    from src.bar_making import ProgressBar
 
-        mp4_create_frame_segmented(frame, input_frame, video_bitrate, fps, segment_dir)
+    cap = cv2.VideoCapture(res_path)
+    gaze_log = VideoLogger(log_dir="logs/gaze_prediction")
+    progress_bar = ProgressBar(input_frame=input_frame)
 
-        frame_counter += 1
-        progress_bar.update(frame_counter)
+    # デコードとエンコーダへの受け渡しをリングバッファ経由で並行に行う
+    pump_frames(
+        cap,
+        lambda frame: mp4_create_frame_segmented(frame, input_frame, video_bitrate, fps, segment_dir),
+        input_frame, max_buffer_bytes, on_frame=progress_bar.update
+    )
 
+    # 規定数に満たない末尾のフレームを書き出す
+    mp4_finish_segment()
     cap.release()
 
+def mp4_create_stream_copy(res_path, video_bitrate, fps, segment_dir, segment_seconds=30):
+    """
+    デコードせずにストリームコピーで分割します。
+    分割位置がキーフレームに一致しない区間のみ、その区間だけを再エンコードします。
+
+    Args:
+        res_path (str): H.264に圧縮した動画のパス。
+        video_bitrate (int): 再エンコード時のビットレート（kbps）。
+        fps (int): 動画のフレームレート。
+        segment_dir (str): セグメントファイルを保存するディレクトリ。
+        segment_seconds (int): セグメントの長さ（秒）。
+    """
+    global segment_index
+
+    info = probe_media(res_path)
+    duration = info["duration"] if info else None
+    keyframes = info["keyframes"] if info else []
+    if duration is None or not keyframes:
+        raise RuntimeError(f"Unable to probe duration/keyframes of {res_path}")
+
+    # 各分割位置に対応するキーフレーム（許容誤差は半フレーム）
+    tolerance = 0.5 / fps
+    cut_times = [i * segment_seconds for i in range(math.ceil(duration / segment_seconds - 1e-6))]
+    aligned = []
+    for cut in cut_times:
+        index = bisect.bisect_left(keyframes, cut - tolerance)
+        aligned.append(keyframes[index] if index < len(keyframes) and keyframes[index] <= cut + tolerance else None)
+
+    if all(k is not None for k in aligned):
+        # 全ての分割位置がキーフレームなので、1回のFFmpegで分割できる
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error", "-i", res_path,
+            "-map", "0:v", "-c", "copy",
+            "-f", "segment", "-segment_format", "mp4",
+            "-reset_timestamps", "1",
+            "-segment_start_number", str(segment_index),
+        ]
+        if len(aligned) > 1:
+            # 分割はsegment_times以降の最初のキーフレームで行われるため、わずかに手前を指定する
+            command += ["-segment_times", ",".join(f"{k - 0.001:.6f}" for k in aligned[1:])]
+        command.append(os.path.join(segment_dir, "segment_%04d.mp4"))
+        subprocess.run(command, check=True)
+        segment_index += len(cut_times)
+        print(f"Stream-copied {len(cut_times)} segments into {segment_dir}")
+        return
+
+    video_bitrate_str = f"{video_bitrate}k"
+    copied = 0
+    for i, start in enumerate(cut_times):
+        end = cut_times[i + 1] if i + 1 < len(cut_times) else duration
+        segment_path = os.path.join(segment_dir, f"segment_{segment_index:04d}.mp4")
+
+        # 開始位置と終了位置の両方がキーフレームであればコピーできる
+        end_aligned = i + 1 >= len(cut_times) or aligned[i + 1] is not None
+        if aligned[i] is not None and end_aligned:
+            codec = ["-c", "copy", "-avoid_negative_ts", "make_zero"]
+            start = aligned[i]
+            end = aligned[i + 1] if i + 1 < len(cut_times) else duration
+            copied += 1
+        else:
+            codec = [
+                "-c:v", "libx264", "-preset", "fast",
+                "-b:v", video_bitrate_str, "-maxrate", video_bitrate_str, "-bufsize", "3M"
+            ]
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-ss", f"{start:.6f}", "-i", res_path, "-t", f"{end - start:.6f}",
+            "-map", "0:v", *codec, segment_path
+        ]
+        subprocess.run(command, check=True)
+        segment_index += 1
+
+    print(f"Stream-copied {copied} segments, re-encoded {len(cut_times) - copied} segments into {segment_dir}")
+
 def mp4_create_frame_segmented(combined_frame, input_frame, video_bitrate, fps, segment_dir="segments/segmented_video", segment_duration=6):
     """
-    合成フレームをセグメント化します。
+    合成フレームをエンコーダセッションに逐次渡し、セグメント化します。
 
     Args:
         combined_frame (np.ndarray): 合成されたフレーム。
@@ -49,7 +179,7 @@ def mp4_create_frame_segmented(combined_frame, input_frame, video_bitrate, fps,
         segment_dir (str): セグメントファイルを保存するディレクトリ。
         segment_duration (int): セグメントの長さ（秒単位）。
     """
-    global frame_buffer, segment_index
+    global encoder_session
 
     # セグメントディレクトリを作成
     segment_dir = os.path.abspath(segment_dir)
@@ -57,47 +187,54 @@ def mp4_create_frame_segmented(combined_frame, input_frame, video_bitrate, fps,
 
     thirty_sec = fps * 30
 
-    frame_buffer.append(combined_frame)
+    try:
+        # セグメントの最初のフレームでエンコーダを起動
+        if encoder_session is None:
+            segment_path = os.path.join(segment_dir, f"segment_{segment_index:04d}.mp4")
+            height, width, _ = combined_frame.shape
+            encoder_session = EncoderSession(segment_path, width, height, fps, video_bitrate)
 
-    # フレームが規定数に達したらセグメントを保存
-    if len(frame_buffer) >= thirty_sec:
-        segment_path = os.path.join(segment_dir, f"segment_{segment_index:04d}.mp4")
-        temp_raw_file = os.path.join(segment_dir, f"segment_{segment_index:04d}_raw.mp4")
-
-        try:
-            # OpenCVを使用して一時ファイルを作成
-            height, width, _ = frame_buffer[0].shape
-            out = cv2.VideoWriter(temp_raw_file, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
-            for frame in frame_buffer:
-                out.write(frame)
-            out.release()
-
-            print(f"未エンコードセグメントを保存しました: {temp_raw_file}")
-
-            # FFmpegを使用してエンコード
-            video_bitrate_str = f"{video_bitrate}k" if isinstance(video_bitrate, int) else video_bitrate
-            ffmpeg_command = [
-                "ffmpeg", "-y", "-i", temp_raw_file,
-                "-c:v", "libx264", "-preset", "fast",
-                "-b:v", video_bitrate_str, "-maxrate", video_bitrate_str,
-                "-bufsize", "3M", segment_path
-            ]
-            subprocess.run(ffmpeg_command, check=True)
+        encoder_session.write(combined_frame)
 
-            print(f"セグメントを保存しました: {segment_path}")
+    except Exception as e:
+        print(f"セグメント保存エラー: segment_{segment_index:04d}.mp4")
+        print(traceback.format_exc())
+        if encoder_session is not None:
+            encoder_session.abort()
+            encoder_session = None
+        return False
 
-            # 一時ファイルを削除
-            os.remove(temp_raw_file)
+    # フレームが規定数に達したらセグメントを確定させる
+    if encoder_session.frame_count >= thirty_sec:
+        return mp4_finish_segment()
 
-        except Exception as e:
-            print(f"セグメント保存エラー: {segment_path}")
-            print(traceback.format_exc())
-            frame_buffer.clear()
-            return False
+    return False
 
-        # フレームバッファをクリアし、次のセグメントの準備
-        frame_buffer.clear()
-        segment_index += 1
-        return True
+def mp4_finish_segment():
+    """
+    エンコード中のセグメントを確定させます。
+    動画の末尾で規定数に満たないフレームを書き出す場合にも使用します。
 
-    return False
+    Returns:
+        bool: セグメントを保存できた場合はTrue。
+    """
+    global encoder_session, segment_index
+
+    if encoder_session is None:
+        return False
+
+    session = encoder_session
+    encoder_session = None
+    segment_path = session.output_path
+
+    try:
+        session.close()
+        print(f"セグメントを保存しました: {segment_path}")
+    except Exception as e:
+        print(f"セグメント保存エラー: {segment_path}")
+        print(traceback.format_exc())
+        return False
+
+    # 次のセグメントの準備
+    segment_index += 1
+    return True
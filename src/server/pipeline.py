@@ -0,0 +1,211 @@
+"""
+リアルタイム配信のデコード・セグメントエンコード・HLSパッケージングを並行に実行するパイプライン。
+
+  デコード(メインスレッド) --FrameRing--> エンコード(スレッド) --キュー--> パッケージング(スレッド)
+
+各ステージは上限付きのキューでつながっており、後段が遅れると前段が待たされる（バックプレッシャ）。
+セグメントが規定フレーム数に達すると、エンコードステージはFFmpegの終了を待たずに
+次のセグメントのエンコーダを起動し、終了待ちとHLS生成はパッケージングステージが行う。
+そのため定常状態のスループットは各ステージの合計ではなく、最も遅いステージで決まる。
+
+EncodeGovernorを指定した場合は、セグメントごとのエンコード速度に応じて
+x264プリセット・スレッド数・レンディションを調整し、実時間での配信を維持する。
+"""
+
+import os
+import queue
+import threading
+import time
+import traceback
+from src.server.encoder_session import EncoderSession
+from src.server.frame_ring import pump_frames
+from src.server.hls_server import create_hls_with_dynamic_bitrate, finalize_m3u8, resolve_renditions
+from src.server.ll_hls import report_publish_latency
+
+
+class StreamingPipeline:
+    def __init__(self, video_bitrate, fps=30, segment_dir="segments/segmented_video",
+                 hls_output_dir="segments/hls_file", resolutions=None, segment_seconds=30,
+                 frame_buffer_bytes=256 * 1024 ** 2, package_queue_size=2, report_interval=5.0, renditions=None,
+                 governor=None, encode_preset="fast", package_preset="medium", segment_format="ts"):
+        """
+        Args:
+            video_bitrate (int): セグメントのビットレート（kbps）。
+            fps (int): 動画のフレームレート。
+            segment_dir (str): MP4セグメントを保存するディレクトリ。
+            hls_output_dir (str): HLSの出力ディレクトリ。
+            resolutions (list): 解像度のリスト (width, height)。
+            segment_seconds (int): MP4セグメントの長さ（秒）。
+            frame_buffer_bytes (int): デコード→エンコード間のリングバッファのメモリ上限（バイト）。
+            package_queue_size (int): エンコード→パッケージング間で待機できるセグメント数。
+            report_interval (float): キューの深さを表示する間隔（秒）。0の場合は表示しない。
+            renditions (list): (level, width, height, kbps) のリスト（タイトルごとのラダー）。
+            governor (EncodeGovernor): エンコード速度のガバナー。Noneの場合は設定を固定する。
+            encode_preset (str): セグメントのエンコードのx264プリセット（ガバナーが速くする前の値）。
+            package_preset (str): HLS生成のx264プリセット（ガバナーが速くする前の値）。
+            segment_format (str): HLSのセグメント形式 ("ts" または "fmp4")。
+        """
+        self.video_bitrate = video_bitrate
+        self.fps = fps
+        self.segment_dir = os.path.abspath(segment_dir)
+        self.hls_output_dir = hls_output_dir
+        self.resolutions = resolutions or [(640, 360), (1280, 720), (1920, 1080)]
+        self.renditions = resolve_renditions(self.resolutions, video_bitrate, renditions)
+        self.governor = governor
+        self.encode_preset = encode_preset
+        self.package_preset = package_preset
+        self.segment_format = segment_format
+        self.segment_frames = fps * segment_seconds
+        self.frame_buffer_bytes = frame_buffer_bytes
+        self.report_interval = report_interval
+        os.makedirs(self.segment_dir, exist_ok=True)
+
+        self.package_queue = queue.Queue(maxsize=package_queue_size)
+        self.ring = None
+        self.session = None
+        self.segment_index = 0
+
+        # ステージごとの処理量と処理時間
+        self.frames_encoded = 0
+        self.segments_packaged = 0
+        self.encode_busy = 0.0
+        self.package_busy = 0.0
+        self.stopped = threading.Event()
+
+    def run(self, cap, max_frames):
+        """
+        パイプラインを実行し、全セグメントのパッケージングが終わるまで待機する。
+
+        Args:
+            cap (cv2.VideoCapture): 入力動画。
+            max_frames (int): 処理する最大フレーム数。
+
+        Returns:
+            int: デコードしたフレーム数。
+        """
+        packager = threading.Thread(target=self._package_loop, name="hls-package", daemon=True)
+        packager.start()
+        reporter = None
+        if self.report_interval:
+            reporter = threading.Thread(target=self._report_loop, name="pipeline-report", daemon=True)
+            reporter.start()
+
+        started = time.time()
+        try:
+            frames = pump_frames(cap, self._encode_frame, max_frames, self.frame_buffer_bytes,
+                                 on_ring=self._set_ring)
+            # 規定数に満たない末尾のフレームを書き出す
+            self._submit_segment()
+        finally:
+            self.package_queue.put(None)
+            packager.join()
+            self.stopped.set()
+            if reporter is not None:
+                reporter.join()
+
+        finalize_m3u8(self.hls_output_dir)
+        elapsed = time.time() - started
+        print(f"[pipeline] {frames} frames in {elapsed:.1f}s ({frames / elapsed if elapsed else 0:.1f} fps), "
+              f"{self.segments_packaged} segments packaged")
+        return frames
+
+    def _set_ring(self, ring):
+        self.ring = ring
+
+    def _encode_frame(self, frame):
+        """
+        エンコードステージ: フレームをエンコーダセッションに渡す。
+        """
+        started = time.perf_counter()
+        if self.session is None:
+            segment_path = os.path.join(self.segment_dir, f"segment_{self.segment_index:04d}.mp4")
+            height, width, _ = frame.shape
+            if self.governor is not None:
+                self.session = EncoderSession(segment_path, width, height, self.fps, self.video_bitrate,
+                                              preset=self.governor.preset(self.encode_preset),
+                                              threads=self.governor.encoder_threads())
+            else:
+                self.session = EncoderSession(segment_path, width, height, self.fps, self.video_bitrate,
+                                              preset=self.encode_preset)
+            self.segment_index += 1
+
+        self.session.write(frame)
+        self.frames_encoded += 1
+        self.encode_busy += time.perf_counter() - started
+
+        if self.session.frame_count >= self.segment_frames:
+            self._submit_segment()
+
+    def _submit_segment(self):
+        """
+        完成したセグメントをパッケージングステージに渡す。キューが満杯なら空くまで待機する。
+        """
+        if self.session is None:
+            return
+        session = self.session
+        self.session = None
+        self.package_queue.put(session)
+
+    def _package_loop(self):
+        """
+        パッケージングステージ: エンコードの完了を待ち、HLSを生成する（セグメント順に1つずつ）。
+        """
+        while True:
+            session = self.package_queue.get()
+            if session is None:
+                break
+            started = time.perf_counter()
+            try:
+                session.close()
+                print(f"セグメントを保存しました: {session.output_path}")
+                self._package(session)
+                print(f"HLSファイルを生成しました: {self.hls_output_dir}")
+                report_publish_latency("standard", [time.time() - session.started_at])
+                self.segments_packaged += 1
+            except Exception:
+                print(f"セグメント保存エラー: {session.output_path}")
+                print(traceback.format_exc())
+            self.package_busy += time.perf_counter() - started
+
+    def _package(self, session):
+        """
+        セグメントをHLS化し、ガバナーにエンコード速度を報告する。
+        """
+        if self.governor is None:
+            create_hls_with_dynamic_bitrate(session.output_path, self.hls_output_dir, None, None,
+                                            playlist_type="EVENT", renditions=self.renditions,
+                                            preset=self.package_preset, segment_format=self.segment_format)
+            return
+
+        stats = {}
+        create_hls_with_dynamic_bitrate(session.output_path, self.hls_output_dir, None, None,
+                                        playlist_type="EVENT",
+                                        renditions=self.governor.renditions(self.renditions),
+                                        preset=self.governor.preset(self.package_preset),
+                                        threads=self.governor.encoder_threads(), stats=stats,
+                                        segment_format=self.segment_format)
+        self.governor.observe(os.path.basename(session.output_path),
+                              {"encode": session.speed, "package": stats.get("speed")},
+                              len(self.renditions))
+
+    def queue_depths(self):
+        """
+        各ステージ間のキューの深さを返す。
+
+        Returns:
+            dict: {"decode->encode": (使用中, 上限), "encode->package": (待機中, 上限)}
+        """
+        depths = {"encode->package": (self.package_queue.qsize(), self.package_queue.maxsize)}
+        if self.ring is not None:
+            depths["decode->encode"] = (self.ring.slot_count - self.ring.free.qsize(), self.ring.slot_count)
+        return depths
+
+    def _report_loop(self):
+        started = time.time()
+        while not self.stopped.wait(self.report_interval):
+            elapsed = time.time() - started
+            depths = ", ".join(f"{name} {used}/{limit}" for name, used, limit in
+                               ((name, *depth) for name, depth in self.queue_depths().items()))
+            print(f"[pipeline] queues: {depths} | encoded {self.frames_encoded} frames "
+                  f"(busy {self.encode_busy / elapsed:.0%}), packaged {self.segments_packaged} segments "
+                  f"(busy {self.package_busy / elapsed:.0%})")
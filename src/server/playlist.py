@@ -0,0 +1,201 @@
+"""
+HLSのメディアプレイリスト(m3u8)をメモリ上で管理し、追記のたびにアトミックに書き出すモジュール。
+
+ディレクトリを走査して全体を書き直す代わりに、FFmpegが出力したセグメントリストから
+実測のEXTINFを取り込み、一時ファイルへの書き込みとリネームで更新する。
+再生中のプレイヤーが書きかけのプレイリストを読むことはない。
+
+fMP4(CMAF)のセグメントは、EXT-X-MAP（初期化セグメント）とEXT-X-BYTERANGE（単一ファイル内の範囲）で表す。
+"""
+
+import math
+import os
+import uuid
+
+
+# プレイリストを書き出した後に呼び出される関数 (HLSサーバーのキャッシュ無効化通知など)
+write_listeners = []
+
+
+def add_write_listener(listener):
+    """
+    プレイリストの書き込み通知を受け取る関数を登録する。
+
+    Args:
+        listener (callable): 書き出したファイルのパスを受け取る関数。
+    """
+    write_listeners.append(listener)
+
+
+def write_atomic(path, text):
+    """
+    一時ファイルに書き込んでからリネームし、ファイルをアトミックに置き換える。
+    """
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w", newline="\n") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+    for listener in write_listeners:
+        listener(path)
+
+
+def read_segment_list(path):
+    """
+    m3u8ファイルからセグメントのURIと長さを読み出す。
+
+    Args:
+        path (str): m3u8ファイルのパス。
+
+    Returns:
+        list: (uri, duration) のリスト。
+    """
+    return [(uri, duration) for uri, duration, _, _ in read_media_segments(path)]
+
+
+def read_media_segments(path):
+    """
+    m3u8ファイルからセグメントのURI・長さ・バイト範囲・初期化セグメントを読み出す。
+
+    Args:
+        path (str): m3u8ファイルのパス。
+
+    Returns:
+        list: (uri, duration, byterange, map_uri) のリスト。byterangeは (length, offset)、
+            map_uriはそのセグメントに適用されるEXT-X-MAPのURI。ない場合はそれぞれNone。
+    """
+    entries = []
+    duration = None
+    byterange = None
+    map_uri = None
+    range_ends = {}  # オフセットが省略された場合は同じURIの前の範囲の直後から始まる
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",")[0])
+            elif line.startswith("#EXT-X-BYTERANGE:"):
+                length, _, offset = line[len("#EXT-X-BYTERANGE:"):].partition("@")
+                byterange = (int(length), int(offset) if offset else None)
+            elif line.startswith("#EXT-X-MAP:"):
+                map_uri = line.split('URI="', 1)[1].split('"', 1)[0] if 'URI="' in line else None
+            elif line and not line.startswith("#") and duration is not None:
+                if byterange is not None:
+                    length, offset = byterange
+                    if offset is None:
+                        offset = range_ends.get(line, 0)
+                    byterange = (length, offset)
+                    range_ends[line] = offset + length
+                entries.append((line, duration, byterange, map_uri))
+                duration = None
+                byterange = None
+    return entries
+
+
+class MediaPlaylist:
+    def __init__(self, path, playlist_type="VOD", window_size=None, version=3):
+        """
+        Args:
+            path (str): 書き出すm3u8ファイルのパス。
+            playlist_type (str): "VOD"、"EVENT"、またはNone（ライブのスライディングウィンドウ）。
+            window_size (int): ライブの場合にプレイリストへ残すセグメント数。Noneの場合は全て残す。
+            version (int): EXT-X-VERSION。
+        """
+        self.path = path
+        self.playlist_type = playlist_type
+        self.window_size = window_size
+        self.version = version
+        self.media_sequence = 0
+        self.target_duration = 0
+        self.ended = False
+        self.total_duration = 0.0  # ウィンドウ外に出たものを含む、追加したセグメントの長さの合計
+        self.map_uri = None  # 直近のEXT-X-MAP
+        self.entries = []  # (uri, duration) または (uri, duration, byterange, map_uri)
+        self._lines = []  # entriesに対応する書き出し済みの行
+
+    @classmethod
+    def load(cls, path, playlist_type="VOD", window_size=None):
+        """
+        既存のm3u8ファイルを読み込んでプレイリストを復元する。ファイルがなければ空で作成する。
+        """
+        playlist = cls(path, playlist_type, window_size)
+        if not os.path.exists(path):
+            return playlist
+        with open(path, "r") as f:
+            for line in f:
+                if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                    playlist.media_sequence = int(line.split(":")[1])
+        playlist.extend(
+            (uri, duration, byterange, map_uri) if byterange or map_uri else (uri, duration)
+            for uri, duration, byterange, map_uri in read_media_segments(path)
+        )
+        return playlist
+
+    def append(self, uri, duration, byterange=None, map_uri=None):
+        """
+        セグメントを1つ追加する（書き出しはwrite()で行う）。
+
+        Args:
+            uri (str): セグメントのURI。
+            duration (float): セグメントの長さ（秒）。
+            byterange (tuple): (length, offset)。単一ファイル内の範囲を指す場合に指定する。
+            map_uri (str): 初期化セグメントのURI（fMP4）。
+        """
+        line = ""
+        if map_uri and map_uri != self.map_uri:
+            line += f'#EXT-X-MAP:URI="{map_uri}"\n'
+            self.map_uri = map_uri
+        line += f"#EXTINF:{duration:.6f},\n"
+        if byterange:
+            length, offset = byterange
+            line += f"#EXT-X-BYTERANGE:{length}@{offset}\n"
+        if byterange or map_uri:
+            # EXT-X-BYTERANGEはバージョン4、メディアプレイリストのEXT-X-MAPは6以上が必要
+            self.version = max(self.version, 7)
+            self.entries.append((uri, duration, tuple(byterange) if byterange else None, map_uri))
+        else:
+            self.entries.append((uri, duration))
+        self._lines.append(line + f"{uri}\n")
+        self.target_duration = max(self.target_duration, math.ceil(duration))
+        self.total_duration += duration
+        self.ended = False
+
+        # ライブの場合は古いセグメントをウィンドウ外に出す
+        if self.playlist_type is None and self.window_size and len(self.entries) > self.window_size:
+            drop = len(self.entries) - self.window_size
+            del self.entries[:drop]
+            del self._lines[:drop]
+            self.media_sequence += drop
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(*entry)
+
+    def end(self):
+        """
+        EXT-X-ENDLISTを付けて書き出す。
+        """
+        self.ended = True
+        self.write()
+
+    def render(self):
+        header = [
+            "#EXTM3U\n",
+            f"#EXT-X-VERSION:{self.version}\n",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}\n",
+            f"#EXT-X-MEDIA-SEQUENCE:{self.media_sequence}\n",
+        ]
+        if self.playlist_type:
+            header.append(f"#EXT-X-PLAYLIST-TYPE:{self.playlist_type}\n")
+        # 先頭のEXT-X-MAPがウィンドウ外に出た場合は補う
+        if self.entries and len(self.entries[0]) > 2 and self.entries[0][3] \
+                and not self._lines[0].startswith("#EXT-X-MAP:"):
+            header.append(f'#EXT-X-MAP:URI="{self.entries[0][3]}"\n')
+        # VODは常に完結しているのでENDLISTを付ける
+        footer = ["#EXT-X-ENDLIST\n"] if self.ended or self.playlist_type == "VOD" else []
+        return "".join(header + self._lines + footer)
+
+    def write(self):
+        """
+        プレイリストをアトミックに書き出す。
+        """
+        write_atomic(self.path, self.render())
@@ -0,0 +1,350 @@
+"""
+ソースセグメント（MP4）とレンディションのセグメント（HLS）を記録する組み込みのインデックス。
+
+SQLiteのWALモードで、セグメントごとに再生順の番号・長さ・バイト数・ビットレート・チェックサムを保存する。
+ディレクトリの走査やファイル名の解析の代わりに、パッケージング・プレイリストの生成・HLSサーバーが
+主キーとインデックスで参照する。
+
+・セグメント番号: 解像度ごとの「次に使用する番号」をトランザクション内で予約するため、
+  複数のプロセスが同じ出力ディレクトリに書き込んでも番号が重複しない。
+・プレイリスト: 記録されたセグメントから再生順にm3u8を再生成できる（数万セグメントでも一度の問い合わせ）。
+・HLSサーバー: セグメントのサイズとチェックサムを引き、ETagと条件付きリクエスト(304)に使う。
+
+WALモードでは読み込みが書き込みを待たないため、配信中のサーバーとパッケージャが同じファイルを共有できる。
+接続はスレッドごとに作成する（sqlite3の接続はスレッド間で共有できない）。
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from src.server.media_probe import get_video_duration
+
+SEGMENT_INDEX_PATH = "segments/segment_index.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS source_segments (
+    segment_dir TEXT NOT NULL,
+    sequence INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    duration REAL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    bitrate INTEGER,
+    checksum TEXT NOT NULL,
+    PRIMARY KEY (segment_dir, sequence)
+);
+CREATE TABLE IF NOT EXISTS rendition_segments (
+    output_dir TEXT NOT NULL,
+    level TEXT NOT NULL,
+    sequence INTEGER NOT NULL,
+    uri TEXT NOT NULL,
+    duration REAL NOT NULL,
+    byte_length INTEGER,
+    byte_offset INTEGER,
+    map_uri TEXT,
+    size INTEGER,
+    bitrate INTEGER,
+    checksum TEXT,
+    PRIMARY KEY (output_dir, level, sequence)
+);
+CREATE INDEX IF NOT EXISTS rendition_segments_uri ON rendition_segments (output_dir, level, uri);
+CREATE TABLE IF NOT EXISTS segment_numbers (
+    output_dir TEXT NOT NULL,
+    level TEXT NOT NULL,
+    next_number INTEGER NOT NULL,
+    PRIMARY KEY (output_dir, level)
+);
+"""
+
+
+def file_checksum(path, offset=0, length=None):
+    """
+    ファイル（またはその範囲）のSHA-256を計算する。
+
+    Args:
+        path (str): ファイルのパス。
+        offset (int): 範囲の先頭。
+        length (int): 範囲の長さ。Noneの場合は末尾まで。
+
+    Returns:
+        str: SHA-256の16進文字列。
+    """
+    digest = hashlib.sha256()
+    remaining = length
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while remaining is None or remaining > 0:
+            chunk = f.read(1024 * 1024 if remaining is None else min(1024 * 1024, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+class SegmentIndex:
+    def __init__(self, path=SEGMENT_INDEX_PATH, timeout=30.0):
+        """
+        Args:
+            path (str): データベースファイルのパス。
+            timeout (float): 他のプロセスの書き込みを待つ最大時間（秒）。
+        """
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # 自動コミットにして、トランザクションはBEGIN IMMEDIATEで明示的に開始する
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """
+        書き込みロックを取得してトランザクションを実行する（他のプロセスの書き込みとは直列化される）。
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # --- セグメント番号 ---
+
+    def next_number(self, output_dir, level):
+        """
+        解像度の次に使用するセグメント番号を返す（予約はしない）。
+
+        Returns:
+            int: 次の番号。番号を記録していない場合はNone。
+        """
+        row = self._connection().execute(
+            "SELECT next_number FROM segment_numbers WHERE output_dir = ? AND level = ?",
+            (os.path.abspath(output_dir), level)
+        ).fetchone()
+        return row[0] if row else None
+
+    def reserve_numbers(self, output_dir, levels, count):
+        """
+        全解像度で共通のセグメント番号をcount個予約する。
+
+        Args:
+            output_dir (str): HLSの出力ディレクトリ。
+            levels (list): 解像度名のリスト。
+            count (int): 予約する番号の数。
+
+        Returns:
+            int: 予約した最初の番号（全解像度の次の番号の最大値）。
+        """
+        output_dir = os.path.abspath(output_dir)
+        with self._transaction() as conn:
+            start = 0
+            for level in levels:
+                row = conn.execute(
+                    "SELECT next_number FROM segment_numbers WHERE output_dir = ? AND level = ?", (output_dir, level)
+                ).fetchone()
+                if row:
+                    start = max(start, row[0])
+            conn.executemany(
+                "INSERT OR REPLACE INTO segment_numbers (output_dir, level, next_number) VALUES (?, ?, ?)",
+                [(output_dir, level, start + count) for level in levels]
+            )
+        return start
+
+    def advance_numbers(self, output_dir, level, next_number):
+        """
+        次に使用する番号をnext_number以上にする（予約より多くのセグメントが生成された場合）。
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO segment_numbers (output_dir, level, next_number) VALUES (?, ?, ?) "
+                "ON CONFLICT (output_dir, level) DO UPDATE SET next_number = MAX(next_number, excluded.next_number)",
+                (os.path.abspath(output_dir), level, next_number)
+            )
+
+    # --- ソースセグメント ---
+
+    def record_source_segments(self, segment_dir, segment_paths):
+        """
+        ソースセグメント（MP4）を再生順に記録する。既存の記録は置き換える。
+
+        Args:
+            segment_dir (str): セグメントのディレクトリ。
+            segment_paths (list): 再生順に並んだセグメントのパス。
+        """
+        rows = []
+        for sequence, path in enumerate(segment_paths):
+            stat = os.stat(path)
+            duration = get_video_duration(path)
+            bitrate = int(stat.st_size * 8 / duration) if duration else None
+            rows.append((os.path.abspath(segment_dir), sequence, os.path.basename(path), duration,
+                         stat.st_size, stat.st_mtime_ns, bitrate, file_checksum(path)))
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM source_segments WHERE segment_dir = ?", (os.path.abspath(segment_dir),))
+            conn.executemany("INSERT INTO source_segments VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def clear_source_segments(self, segment_dir):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM source_segments WHERE segment_dir = ?", (os.path.abspath(segment_dir),))
+
+    def source_segments(self, segment_dir):
+        """
+        記録されたソースセグメントを再生順に返す。
+
+        Returns:
+            list: (path, duration) のリスト。記録がない場合や、ファイルが記録後に変更・削除された場合はNone
+                （ディレクトリを走査する方法に戻す）。
+        """
+        segment_dir = os.path.abspath(segment_dir)
+        rows = self._connection().execute(
+            "SELECT name, duration, size, mtime_ns FROM source_segments WHERE segment_dir = ? ORDER BY sequence",
+            (segment_dir,)
+        ).fetchall()
+        if not rows:
+            return None
+        segments = []
+        for name, duration, size, mtime_ns in rows:
+            path = os.path.join(segment_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                return None
+            segments.append((path, duration))
+        return segments
+
+    # --- レンディションのセグメント ---
+
+    def record_rendition_segments(self, output_dir, level, entries):
+        """
+        プレイリストに追記したセグメントを再生順に記録する。
+
+        Args:
+            output_dir (str): HLSの出力ディレクトリ。
+            level (str): 解像度名。
+            entries (list): (uri, duration) または (uri, duration, byterange, map_uri) のリスト。
+        """
+        output_dir = os.path.abspath(output_dir)
+        rows = []
+        for entry in entries:
+            uri, duration = entry[0], entry[1]
+            byterange = entry[2] if len(entry) > 2 else None
+            map_uri = entry[3] if len(entry) > 3 else None
+            path = os.path.join(output_dir, level, uri)
+            length, offset = byterange if byterange else (None, None)
+            try:
+                size = length if byterange else os.path.getsize(path)
+                checksum = file_checksum(path, offset or 0, length)
+            except OSError:
+                size, checksum = None, None
+            bitrate = int(size * 8 / duration) if size is not None and duration > 0 else None
+            rows.append((uri, duration, length, offset, map_uri, size, bitrate, checksum))
+
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT MAX(sequence) FROM rendition_segments WHERE output_dir = ? AND level = ?", (output_dir, level)
+            ).fetchone()
+            first = row[0] + 1 if row[0] is not None else 0
+            conn.executemany(
+                "INSERT INTO rendition_segments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(output_dir, level, first + i, *row) for i, row in enumerate(rows)]
+            )
+
+    def rendition_segments(self, output_dir, level):
+        """
+        記録されたセグメントを再生順に返す。
+
+        Returns:
+            list: (uri, duration) または (uri, duration, byterange, map_uri) のリスト（MediaPlaylist.extend用）。
+        """
+        rows = self._connection().execute(
+            "SELECT uri, duration, byte_length, byte_offset, map_uri FROM rendition_segments "
+            "WHERE output_dir = ? AND level = ? ORDER BY sequence",
+            (os.path.abspath(output_dir), level)
+        ).fetchall()
+        return [
+            (uri, duration, (length, offset) if length is not None else None, map_uri)
+            if length is not None or map_uri else (uri, duration)
+            for uri, duration, length, offset, map_uri in rows
+        ]
+
+    def levels(self, output_dir):
+        """
+        セグメントが記録されている解像度名の一覧を返す。
+        """
+        rows = self._connection().execute(
+            "SELECT DISTINCT level FROM rendition_segments WHERE output_dir = ?", (os.path.abspath(output_dir),)
+        ).fetchall()
+        return [level for level, in rows]
+
+    def bandwidth(self, output_dir, level):
+        """
+        記録されたセグメントのサイズと長さから帯域幅を求める。
+
+        Returns:
+            tuple: (ピーク(bps), 平均(bps))。記録がない場合はNone。
+        """
+        row = self._connection().execute(
+            "SELECT MAX(size * 8.0 / duration), SUM(size) * 8.0, SUM(duration) FROM rendition_segments "
+            "WHERE output_dir = ? AND level = ? AND size IS NOT NULL AND duration > 0",
+            (os.path.abspath(output_dir), level)
+        ).fetchone()
+        peak, total_bits, total_duration = row
+        if not total_duration:
+            return None
+        return peak, total_bits / total_duration
+
+    def lookup(self, path):
+        """
+        セグメントファイル（<output_dir>/<level>/<uri>）の記録を返す。単一ファイル内の範囲は対象外。
+
+        Returns:
+            tuple: (size, checksum)。記録がない場合はNone。
+        """
+        path = os.path.abspath(path)
+        level_dir, uri = os.path.split(path)
+        output_dir, level = os.path.split(level_dir)
+        return self._connection().execute(
+            "SELECT size, checksum FROM rendition_segments "
+            "WHERE output_dir = ? AND level = ? AND uri = ? AND byte_length IS NULL AND checksum IS NOT NULL",
+            (output_dir, level, uri)
+        ).fetchone()
+
+    def clear_renditions(self, output_dir):
+        """
+        出力ディレクトリのセグメントと番号の記録を削除する。
+        """
+        output_dir = os.path.abspath(output_dir)
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM rendition_segments WHERE output_dir = ?", (output_dir,))
+            conn.execute("DELETE FROM segment_numbers WHERE output_dir = ?", (output_dir,))
+
+
+def load_segment_index(config):
+    """
+    config.jsonの"segment_index"設定からSegmentIndexを作成する。
+
+    Args:
+        config (dict): 設定値。
+
+    Returns:
+        SegmentIndex: インデックスが無効化されている場合はNone。
+    """
+    index_config = config.get("segment_index", {})
+    if not index_config.get("enabled", True):
+        return None
+    return SegmentIndex(path=index_config.get("path", SEGMENT_INDEX_PATH))
@@ -5,8 +5,17 @@
 
 import cv2
 import os
-from src.server.server_function import get_video_bitrate
-from src.server.server_function import frame_segmented
+from src.server.media_probe import get_video_bitrate
+from src.server.pipeline import StreamingPipeline
+from src.server.ll_hls import LowLatencyHLSSession
+from src.server.ladder import build_ladder
+from src.server.encode_governor import EncodeGovernor
+from src.server.frame_ring import pump_frames
+from src.server.playlist import add_write_listener
+from src.server.hls_server import use_segment_index
+from src.server.segment_index import load_segment_index
+from src.client.segment_cache import CacheInvalidationNotifier
+from src.utils import load_config, hls_server_port
 from src.client.playback.logger import VideoLogger
 from src.bar_making import ProgressBar
 
@@ -27,20 +36,79 @@ class VideoStreaming:
         self.frame_counter = 0
 
         self.video_bitrate = get_video_bitrate(res_path)
+
+        # HLSの出力モード ("standard" または "ll-hls")
+        config = load_config()
+        self.hls_config = config.get("hls_mode", {})
+        self.hls_mode = self.hls_config.get("mode", "standard")
+
+        # デコード済みフレームを保持するリングバッファのメモリ上限
+        self.frame_buffer_bytes = config.get("frame_buffer", {}).get("max_bytes", 256 * 1024 ** 2)
+        self.pipeline_config = config.get("pipeline", {})
+        self.packaging_config = config.get("hls_packaging", {})
+
+        # タイトルごとのラダー (config.jsonの"ladder"が"per-title"の場合のみ)
+        self.renditions = build_ladder(res_path, config.get("ladder", {}))
+
+        # エンコード速度に応じてプリセット・スレッド数・レンディションを調整する
+        self.governor = EncodeGovernor.from_config(config.get("encode_governor", {}))
+
+        # セグメント番号とプレイリストをインデックスで管理する（配信中のサーバーと共有）
+        use_segment_index(load_segment_index(config))
+
+        # HLSサーバーのキャッシュを書き込み通知で無効化する場合
+        if config.get("segment_cache", {}).get("playlist_validation") == "notify":
+            # 通知はネットワーク制限プロキシを経由せずにHLSサーバーへ直接送る
+            add_write_listener(CacheInvalidationNotifier(
+                f"http://localhost:{hls_server_port(config)}/_cache/invalidate"
+            ))
     
     def run(self):
-        while self.frame_counter < self.input_frame:
-            ret, frame = self.cap.read()
+        if self.hls_mode == "ll-hls":
+            self.run_low_latency()
+            return
 
-            if not (ret):
-                break
+        # デコード・エンコード・HLS生成を別々のステージで並行に実行する
+        # (末尾のフレームの書き出しと配信終了の通知もパイプラインが行う)
+        pipeline = StreamingPipeline(
+            self.video_bitrate, self.fps, self.segment_dir,
+            frame_buffer_bytes=self.frame_buffer_bytes,
+            package_queue_size=self.pipeline_config.get("package_queue_size", 2),
+            report_interval=self.pipeline_config.get("report_interval", 5.0),
+            renditions=self.renditions,
+            governor=self.governor,
+            segment_format=self.packaging_config.get("segment_format", "ts")
+        )
+        try:
+            self.frame_counter = pipeline.run(self.cap, self.input_frame)
+        finally:
+            self.cap.release()
 
-            frame_segmented(frame, self.input_frame, self.video_bitrate, self.fps, self.segment_dir)
+    def run_low_latency(self):
+        """
+        LL-HLSモード: 30秒のチャンクを待たずに、エンコードしたパーシャルセグメントを順次公開する。
+        """
+        session = None
 
-            self.frame_counter += 1
-            #self.progress_bar.update(self.frame_counter)
+        def write_frame(frame):
+            nonlocal session
+            if session is None:
+                height, width, _ = frame.shape
+                session = LowLatencyHLSSession(
+                    "segments/hls_file", [(640, 360), (1280, 720), (1920, 1080)], self.video_bitrate,
+                    width, height, self.fps,
+                    part_duration=self.hls_config.get("part_duration", 1.0),
+                    parts_per_segment=self.hls_config.get("parts_per_segment", 4),
+                    renditions=self.renditions
+                )
+            session.write(frame)
 
-        self.cap.release()
+        try:
+            self.frame_counter = pump_frames(self.cap, write_frame, self.input_frame, self.frame_buffer_bytes)
+        finally:
+            if session is not None:
+                session.close()
+            self.cap.release()
 
 
 def start_video_streaming(input_video, input_flame, res_path, window_width, window_height):
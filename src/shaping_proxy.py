@@ -0,0 +1,371 @@
+"""
+プレイヤーとHLSサーバーの間に置く、ユーザー空間のネットワーク制限プロキシ。
+
+tc/netshのような管理者権限を必要とせず、次の制限をTCP接続単位で再現する。
+・帯域幅: トークンバケットでサーバー→プレイヤー方向の送信速度を制限する。
+・遅延: 応答データを指定時間遅らせて転送する（RTTが delay だけ増える）。
+・パケットロス: TCPではデータは失われないため、再送待ちによる停止として再現する。
+  転送するデータをMSS単位のパケットとみなし、いずれかが損失した場合は loss_stall 秒停止する。
+
+帯域幅・遅延・損失率は時間とともに変化させることができ（トレース）、
+例えば「1 Mbpsを30秒、その後5 Mbps」のような条件を繰り返し同じように再現できる。
+
+単体で起動する場合:
+    python -m src.shaping_proxy --listen 8080 --upstream 8090 --rate 1mbps --delay 50ms --loss 1%
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+
+CHUNK_SIZE = 64 * 1024
+MSS = 1448
+
+RATE_UNITS = {"": 1, "k": 1e3, "m": 1e6, "g": 1e9}
+
+
+def parse_rate(value):
+    """
+    帯域幅の指定をビット/秒に変換する。"5kbps", "1.5 Mbps", "5mbit" はいずれもビット単位として扱う。
+
+    Returns:
+        float: ビット/秒。Noneまたは0の場合は制限なし(None)。
+    """
+    if value in (None, "", 0):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kmg]?)(?:bps|bit|b/s|bits?)?\s*", str(value).lower())
+    if not match:
+        raise ValueError(f"Invalid rate: {value}")
+    return float(match.group(1)) * RATE_UNITS[match.group(2)]
+
+
+def parse_delay(value):
+    """遅延の指定 ("250ms", "0.25s", 250) を秒に変換する。数値はミリ秒として扱う。"""
+    if value in (None, ""):
+        return 0.0
+    if isinstance(value, (int, float)):
+        return value / 1000
+    match = re.fullmatch(r"\s*([\d.]+)\s*(ms|s)?\s*", str(value).lower())
+    if not match:
+        raise ValueError(f"Invalid delay: {value}")
+    return float(match.group(1)) / (1 if match.group(2) == "s" else 1000)
+
+
+def parse_loss(value):
+    """損失率の指定 ("10%", 10) を0〜1の割合に変換する。数値はパーセントとして扱う。"""
+    if value in (None, ""):
+        return 0.0
+    return float(str(value).strip().rstrip("%")) / 100
+
+
+class ShapingSchedule:
+    """
+    時刻ごとの制限条件。traceがない場合は常に基本の条件を返す。
+
+    traceは区間のリスト [{"duration": 30, "rate": "1mbps"}, {"duration": 30, "rate": "5mbps", "delay": "20ms"}]。
+    区間で省略した項目は基本の条件を使う。loop=Trueの場合は最後の区間の後に先頭に戻る。
+    """
+
+    def __init__(self, rate=None, delay=None, loss=None, trace=None, loop=True):
+        self.base = (parse_rate(rate), parse_delay(delay), parse_loss(loss))
+        self.loop = loop
+        self.intervals = []
+        for entry in trace or []:
+            self.intervals.append((
+                float(entry["duration"]),
+                parse_rate(entry["rate"]) if "rate" in entry else self.base[0],
+                parse_delay(entry["delay"]) if "delay" in entry else self.base[1],
+                parse_loss(entry["loss"]) if "loss" in entry else self.base[2],
+            ))
+        self.period = sum(interval[0] for interval in self.intervals)
+        self.started_at = time.monotonic()
+
+    def restart(self):
+        self.started_at = time.monotonic()
+
+    def current(self, now=None):
+        """
+        Returns:
+            tuple: (帯域幅(ビット/秒)またはNone, 遅延(秒), 損失率(0〜1))
+        """
+        if not self.intervals or self.period <= 0:
+            return self.base
+        elapsed = (now if now is not None else time.monotonic()) - self.started_at
+        if self.loop:
+            elapsed %= self.period
+        for duration, rate, delay, loss in self.intervals:
+            if elapsed < duration:
+                return rate, delay, loss
+            elapsed -= duration
+        # ループしない場合は最後の区間の条件を維持する
+        return self.intervals[-1][1:]
+
+
+class TokenBucket:
+    def __init__(self, burst_bytes=64 * 1024):
+        """
+        Args:
+            burst_bytes (int): バケットの容量（一度に送信できる最大バイト数）。
+        """
+        self.burst_bytes = burst_bytes
+        self.tokens = burst_bytes
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def consume(self, size, rate_bps):
+        """
+        sizeバイト分のトークンが貯まるまで待機する。rate_bpsがNoneの場合は待たない。
+        """
+        if rate_bps is None:
+            return
+        rate = rate_bps / 8
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst_bytes, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= size
+            if self.tokens < 0:
+                # 不足分が貯まるまで待つ（トークンは前借りしているので、待った後は0になる）
+                await asyncio.sleep(-self.tokens / rate)
+                self.tokens = 0.0
+                self.updated = time.monotonic()
+
+
+class ShapingProxy:
+    def __init__(self, schedule, listen_host="0.0.0.0", listen_port=8080, upstream_host="127.0.0.1",
+                 upstream_port=8090, shared=False, burst_bytes=64 * 1024, loss_stall=0.2, seed=None):
+        """
+        Args:
+            schedule (ShapingSchedule): 制限条件。
+            listen_host (str): プレイヤーからの接続を受け付けるアドレス。
+            listen_port (int): プレイヤーからの接続を受け付けるポート。
+            upstream_host (str): HLSサーバーのアドレス。
+            upstream_port (int): HLSサーバーのポート。
+            shared (bool): Trueの場合は全接続で1つの帯域幅を共有する（リンク全体の制限）。
+                Falseの場合は接続ごとに制限する。
+            burst_bytes (int): トークンバケットの容量。
+            loss_stall (float): パケットロス1回あたりの停止時間（秒、再送タイムアウトに相当）。
+            seed (int): 損失の乱数のシード（同じ条件を再現する場合に指定）。
+        """
+        self.schedule = schedule
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.shared = shared
+        self.burst_bytes = burst_bytes
+        self.loss_stall = loss_stall
+        self.random = random.Random(seed)
+        self.shared_bucket = None
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+        self.connections = 0
+        self.bytes_forwarded = 0
+        self.stalls = 0
+
+    def start(self):
+        """バックグラウンドスレッドでプロキシを起動する。"""
+        ready = threading.Event()
+        errors = []
+        self.thread = threading.Thread(target=asyncio.run, args=(self._main(ready, errors),),
+                                       name="shaping-proxy", daemon=True)
+        self.thread.start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+        rate, delay, loss = self.schedule.current()
+        print(f"Shaping proxy listening on {self.listen_host}:{self.listen_port} -> "
+              f"{self.upstream_host}:{self.upstream_port} (rate {rate or 'unlimited'} bps, "
+              f"delay {delay * 1000:.0f} ms, loss {loss * 100:.1f}%"
+              f"{', trace' if self.schedule.intervals else ''})")
+
+    def stop(self):
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    async def _main(self, ready, errors):
+        self.loop = asyncio.get_running_loop()
+        self.shared_bucket = TokenBucket(self.burst_bytes)
+        try:
+            self.server = await asyncio.start_server(self._handle, self.listen_host, self.listen_port)
+        except OSError as e:
+            errors.append(e)
+            ready.set()
+            return
+        self.schedule.restart()
+        ready.set()
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    async def _handle(self, client_reader, client_writer):
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(self.upstream_host, self.upstream_port)
+        except OSError:
+            client_writer.close()
+            return
+
+        self.connections += 1
+        bucket = self.shared_bucket if self.shared else TokenBucket(self.burst_bytes)
+        try:
+            # リクエスト方向はそのまま転送し、応答方向に帯域幅・遅延・損失を適用する
+            await asyncio.gather(
+                self._pipe(client_reader, upstream_writer, None),
+                self._pipe(upstream_reader, client_writer, bucket),
+            )
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for writer in (client_writer, upstream_writer):
+                writer.close()
+
+    async def _pipe(self, reader, writer, bucket):
+        if bucket is None:
+            try:
+                while True:
+                    chunk = await reader.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    await writer.drain()
+            finally:
+                self._write_eof(writer)
+            return
+
+        # 受信と送信を分け、遅延中も次のデータの受信を進める（遅延でスループットが下がらないように）
+        pending = asyncio.Queue(maxsize=64)
+
+        async def receive():
+            try:
+                while True:
+                    chunk = await reader.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await pending.put((time.monotonic(), chunk))
+            except OSError:
+                pass
+            await pending.put(None)
+
+        receiver = asyncio.create_task(receive())
+        try:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    break
+                arrived, chunk = item
+                rate, delay, loss = self.schedule.current()
+
+                wait = arrived + delay - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+                for start in range(0, len(chunk), self.burst_bytes):
+                    piece = chunk[start:start + self.burst_bytes]
+                    if loss > 0 and self._lost(len(piece), loss):
+                        self.stalls += 1
+                        await asyncio.sleep(self.loss_stall)
+                    await bucket.consume(len(piece), rate)
+                    writer.write(piece)
+                    await writer.drain()
+                    self.bytes_forwarded += len(piece)
+        finally:
+            receiver.cancel()
+            self._write_eof(writer)
+
+    def _lost(self, size, loss):
+        """sizeバイトをMSS単位のパケットとみなし、1つでも損失するかを判定する。"""
+        packets = -(-size // MSS)
+        return self.random.random() < 1 - (1 - loss) ** packets
+
+    @staticmethod
+    def _write_eof(writer):
+        try:
+            if writer.can_write_eof():
+                writer.write_eof()
+        except OSError:
+            pass
+
+
+def load_trace(trace):
+    """
+    トレースの指定（区間のリスト、またはJSONファイルのパス）を区間のリストにする。
+    """
+    if isinstance(trace, str):
+        with open(trace, "r") as f:
+            return json.load(f)
+    return trace
+
+
+def create_shaping_proxy(config, rate=None, delay=None, loss=None):
+    """
+    config.jsonの "network_shaping" から ShapingProxy を作成する。
+
+    Args:
+        config (dict): load_config() の結果。
+        rate, delay, loss: 基本の制限条件（省略時は config の rate / delay / loss）。
+
+    Returns:
+        ShapingProxy: 作成したプロキシ（未起動）。
+    """
+    shaping = config.get("network_shaping", {})
+    schedule = ShapingSchedule(
+        rate=rate if rate is not None else config.get("rate"),
+        delay=delay if delay is not None else config.get("delay"),
+        loss=loss if loss is not None else config.get("loss"),
+        trace=load_trace(shaping.get("trace")),
+        loop=shaping.get("trace_loop", True),
+    )
+    return ShapingProxy(
+        schedule,
+        listen_port=shaping.get("listen_port", 8080),
+        upstream_port=shaping.get("upstream_port", 8090),
+        shared=shaping.get("shared", False),
+        burst_bytes=shaping.get("burst_bytes", 64 * 1024),
+        loss_stall=shaping.get("loss_stall", 0.2),
+        seed=shaping.get("seed"),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Userspace bandwidth/delay/loss shaping proxy for the HLS server.")
+    parser.add_argument("--listen", type=int, default=8080)
+    parser.add_argument("--upstream", type=int, default=8090)
+    parser.add_argument("--upstream-host", default="127.0.0.1")
+    parser.add_argument("--rate", default=None, help="e.g. 1mbps, 500kbps")
+    parser.add_argument("--delay", default=None, help="e.g. 50ms")
+    parser.add_argument("--loss", default=None, help="e.g. 1%%")
+    parser.add_argument("--trace", default=None, help="JSON file with [{\"duration\": s, \"rate\": ...}, ...]")
+    parser.add_argument("--no-loop", action="store_true", help="Hold the last trace interval instead of looping.")
+    parser.add_argument("--shared", action="store_true", help="Share one bandwidth limit across connections.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    schedule = ShapingSchedule(args.rate, args.delay, args.loss, load_trace(args.trace), loop=not args.no_loop)
+    proxy = ShapingProxy(schedule, listen_port=args.listen, upstream_host=args.upstream_host,
+                         upstream_port=args.upstream, shared=args.shared, seed=args.seed)
+    proxy.start()
+    try:
+        while True:
+            time.sleep(5)
+            rate, delay, loss = schedule.current()
+            print(f"[shaping] {proxy.connections} connections, {proxy.bytes_forwarded / 1024 ** 2:.1f} MB, "
+                  f"{proxy.stalls} stalls | now rate {rate or 'unlimited'} bps, delay {delay * 1000:.0f} ms, "
+                  f"loss {loss * 100:.1f}%")
+    except KeyboardInterrupt:
+        proxy.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+インターフェース単位のスループットを高頻度でサンプリングするモジュール。
+
+psutil.net_io_counters(pernic=True) から指定インターフェースのカウンタだけを読むため、
+他のインターフェースの通信は含まれない。サンプリングは専用スレッドで行い、
+サンプルごとの値は保持せず、ウィンドウごとの合計と最大値だけを更新する（メモリと処理量が一定）。
+1秒単位の平均では見えない、セグメント取得時のバーストをピーク値として確認できる。
+"""
+
+import threading
+import time
+import psutil
+
+
+def resolve_interface(interface, counters):
+    """
+    ユーザーが選んだインターフェース名を psutil のインターフェース名に対応付ける。
+
+    Args:
+        interface (str): インターフェース名（ip link / netsh の表示名）。
+        counters (dict): psutil.net_io_counters(pernic=True) の結果。
+
+    Returns:
+        str: psutil のインターフェース名。見つからない場合はNone。
+    """
+    if interface in counters:
+        return interface
+    lowered = interface.lower()
+    for name in counters:
+        if name.lower() == lowered:
+            return name
+    # netshの表示では空白を含む名前の末尾しか取得できないため、末尾一致も許容する
+    for name in counters:
+        if name.lower().endswith(lowered):
+            return name
+    return None
+
+
+class ThroughputSampler:
+    def __init__(self, interface, sample_rate=20.0):
+        """
+        Args:
+            interface (str): 計測するネットワークインターフェース名。
+            sample_rate (float): 1秒あたりのサンプリング回数（10〜100程度）。
+        """
+        self.sample_rate = max(1.0, sample_rate)
+        self.interface = resolve_interface(interface, psutil.net_io_counters(pernic=True)) if interface else None
+        if self.interface is None:
+            print(f"Warning: interface '{interface}' not found in psutil counters. Falling back to all interfaces.")
+
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self._reset_window(time.perf_counter())
+
+    def _read(self):
+        if self.interface is None:
+            counters = psutil.net_io_counters()
+        else:
+            counters = psutil.net_io_counters(pernic=True).get(self.interface)
+            if counters is None:
+                return None
+        return counters.bytes_sent, counters.bytes_recv
+
+    def _reset_window(self, now):
+        self.window_start = now
+        self.sent_bytes = 0
+        self.recv_bytes = 0
+        self.sent_peak = 0.0
+        self.recv_peak = 0.0
+        self.samples = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._sample_loop, name="throughput-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _sample_loop(self):
+        interval = 1.0 / self.sample_rate
+        previous = self._read()
+        previous_time = time.perf_counter()
+        next_at = previous_time + interval
+
+        while self.running:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_at += interval
+
+            current = self._read()
+            now = time.perf_counter()
+            elapsed = now - previous_time
+            if current is not None and previous is not None and elapsed > 0:
+                sent = current[0] - previous[0]
+                recv = current[1] - previous[1]
+                # カウンタのリセットや巻き戻りがあった区間は捨てる
+                if sent >= 0 and recv >= 0:
+                    with self.lock:
+                        self.sent_bytes += sent
+                        self.recv_bytes += recv
+                        self.sent_peak = max(self.sent_peak, sent / elapsed)
+                        self.recv_peak = max(self.recv_peak, recv / elapsed)
+                        self.samples += 1
+            previous, previous_time = current, now
+
+            if next_at < now:
+                # 処理が遅れた場合は遅れを取り戻さずに次の周期から再開する
+                next_at = now + interval
+
+    def collect(self):
+        """
+        前回の呼び出しからのウィンドウの集計を返し、新しいウィンドウを開始する。
+
+        Returns:
+            dict: send_avg, send_peak, recv_avg, recv_peak（いずれもkB/s）, samples（サンプル数）, window（秒）。
+        """
+        now = time.perf_counter()
+        with self.lock:
+            window = now - self.window_start
+            result = {
+                "send_avg": self.sent_bytes / window / 1024 if window > 0 else 0.0,
+                "send_peak": self.sent_peak / 1024,
+                "recv_avg": self.recv_bytes / window / 1024 if window > 0 else 0.0,
+                "recv_peak": self.recv_peak / 1024,
+                "samples": self.samples,
+                "window": window,
+            }
+            self._reset_window(now)
+        return result
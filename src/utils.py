@@ -4,11 +4,49 @@ get_network_interfaces 関数:
 ・システム上のすべてのネットワークインターフェースをリストとして返します。
 ・対応OS: Linux（ip link show）および Windows（netsh interface show interface）。
 ・日本語環境でのインターフェース検出にも対応。
+load_config 関数:
+・src/config.json の設定値を辞書として返します。
+hls_server_port 関数:
+・HLSサーバーが待ち受けるポートを返します（ネットワーク制限プロキシを使う場合はプロキシの転送先）。
+hls_public_url 関数:
+・プレイヤーが接続するURLを返します（ネットワーク制限プロキシを使う場合はプロキシ）。
 """
 
+import json
 import platform
 import subprocess
 
+CONFIG_PATH = "src/config.json"
+
+def load_config(config_path=CONFIG_PATH):
+    """
+    設定ファイル(config.json)を読み込む。
+    """
+    with open(config_path, "r") as config_file:
+        return json.load(config_file)
+
+def hls_server_port(config=None):
+    """
+    HLSサーバーが待ち受けるポートを返す。
+    ネットワーク制限プロキシが有効な場合、プレイヤーはプロキシ(listen_port)に接続し、
+    HLSサーバーはプロキシの転送先(upstream_port)で待ち受ける。
+    """
+    config = config if config is not None else load_config()
+    shaping = config.get("network_shaping", {})
+    if shaping.get("enabled", False):
+        return shaping.get("upstream_port", 8090)
+    return 8080
+
+def hls_public_url(path="", config=None):
+    """
+    プレイヤーが接続するURLを返す。
+    ネットワーク制限プロキシが有効な場合はプロキシ(listen_port)、無効な場合はHLSサーバーのURL。
+    """
+    config = config if config is not None else load_config()
+    shaping = config.get("network_shaping", {})
+    port = shaping.get("listen_port", 8080) if shaping.get("enabled", False) else hls_server_port(config)
+    return f"http://localhost:{port}/{path}"
+
 def get_network_interfaces():
     interfaces = []
     try: